@@ -1,24 +1,25 @@
 import os
-import zipfile
 import uuid
 import shutil
-from fastapi import FastAPI, File, UploadFile, WebSocket, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, WebSocket, WebSocketDisconnect, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import asyncio
 import json
 import time
 
-import librosa
-import soundfile as sf
-import numpy as np
-from Tonal_Fragment import Tonal_Fragment
-from wonky_sampler import main as wonky_sampler
-
 # Import custom modules
-from perc_splitter import process_song, extract_drum_hits, extract_harmonic_samples, get_key_of_sample, create_percussive_loops_from_original
-from wonky_sampler import main as wonky_sampler
+from archive import stream_archive
+from audio_output import check_format
+from quality import check_quality
+from job_api import router as jobs_router
+from job_executor import PROCESS_SONG, JobExecutor
+from metrics import metrics
+from storage import results_storage, storage
+from uploads import receive_upload
 
 app = FastAPI()
+executor = JobExecutor()
 
 # Add CORS middleware
 app.add_middleware(
@@ -29,33 +30,117 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-
-
+# POST /jobs, GET /jobs/{id}, GET /jobs/{id}/result and DELETE /jobs/{id}
+app.include_router(jobs_router)
+
+
+# the worker processes import the pipeline and warm it up while the server starts, the
+# server process itself never imports it
+@app.on_event("startup")
+def start_executor():
+    metrics.reset()
+    executor.start()
+    storage.start()
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    executor.shutdown()
+    storage.stop()
+
+# Prometheus metrics of this server and its worker processes
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# bytes and directories of the results, uploads and jobs, as of the last collection
+@app.get("/storage")
+def get_storage():
+    return storage.usage()
+
+# types of the binary messages of /ws?samples=1, the first byte of every message
+ZIP_CHUNK = 1
+SAMPLE = 2
+
+# binary message of a sample sent by the pipeline: the type, the length of the json header
+# (4 bytes, big endian), the header and the audio file; the header has the "stage", "category",
+# "name", "bpm" and "key" of the sample and its "path" inside the samplebox zip
+def sample_frame(message, path):
+    header = {key: value for key, value in message.items() if key not in ("status", "audio")}
+    header = json.dumps(dict(header, path=path)).encode()
+    return bytes([SAMPLE]) + len(header).to_bytes(4, byteorder='big') + header + message["audio"]
+
+# /ws takes songs with the framed upload protocol of uploads.py (a header, acknowledged
+# chunks and an end message, resumable after a reconnect), or from older clients as a single
+# binary message of a 4 byte filename length, the filename and the file
+# the samplebox zip is sent back in binary messages as it grows; with /ws?samples=1 every
+# sample is also sent on its own as soon as its stage wrote it, and binary messages start
+# with their type (see sample_frame), with /ws?samples=1&zip=0 only the samples are sent
+# /ws?format=flac (or wav16, wav24, ogg) selects the format of the samples, /ws?quality=preview
+# (or standard, high) the analysis quality: a preview is ready in a fraction of the time, and
+# the song can be sent again at standard quality once the preview sounds promising
+# with /ws?timings=1 the completion message carries the timing breakdown of the request
+# and of every pipeline stage
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    try:
+        output_format = check_format(websocket.query_params.get("format"))
+        quality = check_quality(websocket.query_params.get("quality"))
+    except ValueError as e:
+        await websocket.send_text(json.dumps({"status": "error", "message": str(e)}))
+        await websocket.close()
+        return
+    send_timings = websocket.query_params.get("timings") in ("1", "true")
+    stream_samples = websocket.query_params.get("samples") in ("1", "true")
+    send_zip = not stream_samples or websocket.query_params.get("zip") not in ("0", "false")
     while True:
+        upload = None
+        results_dir1 = None
+        job = None
         try:
-            data = await websocket.receive_bytes()
-
-            # Extract filename length (first 4 bytes)
-            filename_length = int.from_bytes(data[:4], byteorder='big')
-
-            # Extract filename
-            filename = data[4:4+filename_length].decode('utf-8')
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if storage.is_full():
+                raise RuntimeError("Server storage is full, try again later")
+            timings = {}
+            start = time.perf_counter()
+
+            if message.get("text") is not None:
+                upload = await receive_upload(websocket, json.loads(message["text"]))
+                filename = upload.filename
+                phase = "upload"
+            else:
+                data = message["bytes"]
+
+                # Extract filename length (first 4 bytes)
+                filename_length = int.from_bytes(data[:4], byteorder='big')
+
+                # Extract filename
+                filename = data[4:4+filename_length].decode('utf-8')
+
+                # Extract file data
+                file_data = data[4+filename_length:]
+                phase = "save"
             filename = str(filename).replace(".mp3", "").replace(".wav", "")
 
-            # Extract file data
-            file_data = data[4+filename_length:]
-
             async def send_message(message):
+                if message.get("status") == "profile":
+                    # the pipeline's timing breakdown, sent with the completion message
+                    timings["pipeline"] = message["profile"]
+                    return
+                if message.get("status") == "sample":
+                    timings.setdefault("first_sample", time.perf_counter() - start)
+                    path = f"{upload_uuid}/{filename}/{message['category']}/{message['name']}"
+                    await websocket.send_bytes(sample_frame(message, path))
+                    return
                 await websocket.send_text(json.dumps(message))
             
             # Generate a unique UUID for this upload
             upload_uuid = str(uuid.uuid4())
             
-            # Create the results directory
-            results_dir1 = os.path.join("results", upload_uuid)
+            # Create the results directory, deleted by the storage manager once the song is sent
+            results_dir1 = results_storage.create(upload_uuid)
             results_dir = os.path.join(results_dir1, upload_uuid)
             os.makedirs(results_dir, exist_ok=True)
 
@@ -63,102 +148,57 @@ async def websocket_endpoint(websocket: WebSocket):
             
             # Save the uploaded file
             input_file_path = os.path.join(f"{results_dir}/{filename}/stems", f"{filename}.wav")
-            with open(input_file_path, "wb") as buffer:
-                buffer.write(file_data)
+            if upload is not None:
+                shutil.move(upload.path, input_file_path)
+            else:
+                with open(input_file_path, "wb") as buffer:
+                    buffer.write(file_data)
+            timings[phase] = time.perf_counter() - start
             
             # Send progress update
             await send_message({"status": "processing", "message": "File received and saved"})
 
-            # Process the song and generate samples
-            # await process_song(input_file_path, results_dir, send_message)
-            input_file = input_file_path
-            output_dir = results_dir
-            # Create results directory
-            filename = os.path.basename(input_file).replace(".wav", "").replace(".mp3", "")
-            results_dir = os.path.join(output_dir, filename)
-            os.makedirs(results_dir, exist_ok=True)
-
-            # Load the audio file
-            y, sr = librosa.load(input_file)
-            
-            # Get the song key
-            song_key = get_key_of_sample(y, sr)
-            print(f"Song key: {song_key}")
-            await asyncio.sleep(0.5)
-            await send_message({"status": "processing", "message": "Extracting stems ..."})
-
-            # Separate harmonic and percussive components
-            y_harmonic, y_percussive = librosa.effects.hpss(y)
-            stems_dir = os.path.join(results_dir, "stems")
-            os.makedirs(stems_dir, exist_ok=True)
-
-            sf.write(os.path.join(stems_dir, "harmonics.wav"), y_harmonic, sr)
-            sf.write(os.path.join(stems_dir, "percs.wav"), y_percussive, sr)
-            print("Extracted harmonic and percussive components")
-            await asyncio.sleep(0.5)
-            await send_message({"status": "processing", "message": "Creating percussion loops ..."})
-            # Create drum loops
-            percussive_loops_dir = os.path.join(results_dir, "percussions")
-            os.makedirs(percussive_loops_dir, exist_ok=True)
-
-            percs_file = os.path.join(stems_dir, "percs.wav")
-            create_percussive_loops_from_original(percs_file, percussive_loops_dir)
-            await asyncio.sleep(0.5)
-            await send_message({"status": "processing", "message": "Extracting drum hits ..."})
-            # Extract drum hits
-            drum_dir = os.path.join(results_dir, "drums")
-            os.makedirs(drum_dir, exist_ok=True)
-            extract_drum_hits(os.path.join(stems_dir, "percs.wav"), drum_dir, amplitude_threshold=0.1)
-            await asyncio.sleep(0.5)
-            await send_message({"status": "processing", "message": "Getting harmonic loops ..."})
-            # Extract melodic samples
-            melodic_dir = os.path.join(results_dir, "harmonic stuff")
-            os.makedirs(melodic_dir, exist_ok=True)
-            extract_harmonic_samples(os.path.join(stems_dir, "harmonics.wav"), melodic_dir)
-            await asyncio.sleep(0.5)
-            await send_message({"status": "processing", "message": "Generating wonky loops from original audio ..."})
-            # Generate wonky samples
-            melody_sample = os.path.join(stems_dir, "harmonics.wav")
-            instrumental_wonky_output_folder = os.path.join(results_dir, "wonky stuff")
-            original_wonky_output_folder = os.path.join(results_dir, "wonky stuff")
-
-            wonky_sampler(input_file, original_wonky_output_folder, song_key=song_key)
-            await asyncio.sleep(0.5)
-            await send_message({"status": "processing", "message": "Generating wonky loops from harmonics ... (this gon take a min)"})
-            wonky_sampler(melody_sample, instrumental_wonky_output_folder, song_key=song_key)
-
-            print(f"Processed song and generated samples in {results_dir}")
-            
-            # Send progress update
-            await websocket.send_text(json.dumps({"status": "processing", "message": "Samples generated"}))
-            time.sleep(5)
-            # Create a zip file containing all generated samples
-            zip_path = os.path.join(results_dir, f"{upload_uuid}_samplebox.zip")
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                for root, _, files in os.walk(results_dir1):
-                    for file in files:
-                        if file.endswith('.zip'):
-                            continue
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, results_dir1)
-                        zipf.write(file_path, arcname)
-            
-            # Send the zip file
-            with open(zip_path, "rb") as zip_file:
-                zip_data = zip_file.read()
-                await websocket.send_bytes(zip_data)
+            # Process the song in a worker process, relaying its progress (and samples); the
+            # worker writes the samplebox zip stage by stage and we send it on in chunks as it grows
+            # an upload was hashed, and maybe decoded, while it arrived, the worker reuses both
+            options = {"stream_samples": stream_samples, "output_format": output_format, "quality": quality}
+            if upload is not None:
+                options.update(decoded_file=upload.decoded_path, content_hash=upload.content_hash)
+            if send_zip:
+                zip_path = os.path.join(results_dir1, f"{upload_uuid}_samplebox.zip")
+                job = asyncio.create_task(executor.run(PROCESS_SONG, input_file_path, results_dir, on_progress=send_message,
+                                                       archive_path=zip_path, archive_root=results_dir1, **options))
+                async for chunk in stream_archive(zip_path, job):
+                    await websocket.send_bytes(bytes([ZIP_CHUNK]) + chunk if stream_samples else chunk)
+            else:
+                await executor.run(PROCESS_SONG, input_file_path, results_dir, on_progress=send_message, **options)
+            timings["process"] = time.perf_counter() - start - timings[phase]
+            for name in (phase, "process", "first_sample"):
+                if name in timings:
+                    metrics.observe("samplebox_request_seconds", timings[name], endpoint="/ws", phase=name)
             
             # Send completion message
-            await websocket.send_text(json.dumps({"status": "complete", "message": "Sample box generated and sent"}))
-            
-            time.sleep(5)
-            
-            # Cleanup
-            shutil.rmtree(results_dir1)
-            
+            message = {"status": "complete", "message": "Sample box generated and sent"}
+            if send_timings:
+                message["timings"] = timings
+            await websocket.send_text(json.dumps(message))
+
+        except WebSocketDisconnect:
+            # an unfinished upload stays on disk, the client resumes it after reconnecting
+            break
         except Exception as e:
             await websocket.send_text(json.dumps({"status": "error", "message": str(e)}))
             break
+        finally:
+            if job is not None and not job.done():
+                # the client left while the zip was streamed: stop the job and wait until it
+                # ended, its worker writes into results_dir1 until then
+                job.cancel()
+                await asyncio.gather(job, return_exceptions=True)
+            if upload is not None:
+                await upload.remove()
+            if results_dir1 is not None:
+                results_storage.remove(results_dir1)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,7 +1,7 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import librosa
-import librosa.display
+import feature_cache
+from key_detector import KEYS, PITCHES, key_detector
 
 # class that uses the librosa library to analyze the key that an mp3 is in
 # arguments:
@@ -20,36 +20,20 @@ class Tonal_Fragment(object):
         if self.tend is not None:
             self.tend = librosa.time_to_samples(self.tend, sr=self.sr)
         self.y_segment = self.waveform[self.tstart:self.tend]
-        self.chromograph = librosa.feature.chroma_cqt(y=self.y_segment, sr=self.sr, bins_per_octave=24)
+        self.chromograph = feature_cache.chroma_cqt(self.y_segment, self.sr, bins_per_octave=24)
         
         # chroma_vals is the amount of each pitch class present in this time interval
-        self.chroma_vals = []
-        for i in range(12):
-            self.chroma_vals.append(np.sum(self.chromograph[i]))
-        pitches = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
+        self.chroma_vals = list(np.sum(self.chromograph, axis=1))
         # dictionary relating pitch names to the associated intensity in the song
-        self.keyfreqs = {pitches[i]: self.chroma_vals[i] for i in range(12)} 
-        
-        keys = [pitches[i] + ' major' for i in range(12)] + [pitches[i] + ' minor' for i in range(12)]
+        self.keyfreqs = {PITCHES[i]: self.chroma_vals[i] for i in range(12)} 
 
         # use of the Krumhansl-Schmuckler key-finding algorithm, which compares the chroma
-        # data above to typical profiles of major and minor keys:
-        maj_profile = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
-        min_profile = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
-
-        # finds correlations between the amount of each pitch class in the time interval and the above profiles,
-        # starting on each of the 12 pitches. then creates dict of the musical keys (major/minor) to the correlation
-        self.min_key_corrs = []
-        self.maj_key_corrs = []
-        for i in range(12):
-            key_test = [self.keyfreqs.get(pitches[(i + m)%12]) for m in range(12)]
-            # correlation coefficients (strengths of correlation for each key)
-            self.maj_key_corrs.append(round(np.corrcoef(maj_profile, key_test)[1,0], 3))
-            self.min_key_corrs.append(round(np.corrcoef(min_profile, key_test)[1,0], 3))
-
-        # names of all major and minor keys
-        self.key_dict = {**{keys[i]: self.maj_key_corrs[i] for i in range(12)}, 
-                         **{keys[i+12]: self.min_key_corrs[i] for i in range(12)}}
+        # data above to typical profiles of major and minor keys, see KeyDetector;
+        # creates dict of the musical keys (major/minor) to the correlation
+        key_corrs = key_detector.scores(self.chroma_vals)[0]
+        self.maj_key_corrs = list(key_corrs[:12])
+        self.min_key_corrs = list(key_corrs[12:])
+        self.key_dict = dict(zip(KEYS, key_corrs))
         
         # this attribute represents the key determined by the algorithm
         self.key = max(self.key_dict, key=self.key_dict.get)
@@ -84,9 +68,13 @@ class Tonal_Fragment(object):
     
     # prints a chromagram of the file, showing the intensity of each pitch class over time
     def chromagram(self, title=None):
-        C = librosa.feature.chroma_cqt(y=self.waveform, sr=sr, bins_per_octave=24)
+        # imported here, matplotlib is only needed for plotting and slow to import
+        import matplotlib.pyplot as plt
+        import librosa.display
+
+        C = librosa.feature.chroma_cqt(y=self.waveform, sr=self.sr, bins_per_octave=24)
         plt.figure(figsize=(12,4))
-        librosa.display.specshow(C, sr=sr, x_axis='time', y_axis='chroma', vmin=0, vmax=1)
+        librosa.display.specshow(C, sr=self.sr, x_axis='time', y_axis='chroma', vmin=0, vmax=1)
         if title is None:
             plt.title('Chromagram')
         else:
@@ -1,16 +1,18 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Query
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import os
 import shutil
 import tempfile
 import uuid
-import librosa
-from Tonal_Fragment import Tonal_Fragment
-from wonky_sampler import main as wonky_sampler
-import time
+from job_executor import JobExecutor, QueueFullError
+from quality import check_quality
+from storage import results_storage, storage
+from uploads import uploads_storage
 
 app = FastAPI()
+executor = JobExecutor()
 
 # Add CORS middleware
 app.add_middleware(
@@ -21,27 +23,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-UPLOAD_DIR = "uploads"
-RESULTS_DIR = "results"
+# the worker processes import the pipeline and warm it up while the server starts, the
+# server process itself never imports it
+@app.on_event("startup")
+def start_executor():
+    executor.start()
+    storage.start()
 
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(RESULTS_DIR, exist_ok=True)
+@app.on_event("shutdown")
+def shutdown_executor():
+    executor.shutdown()
+    storage.stop()
 
+# the upload and results of a request are deleted in the background by the storage manager
 def cleanup_dirs(upload_dir: str, results_dir: str):
-    time.sleep(2)
-    shutil.rmtree(upload_dir, ignore_errors=True)
-    shutil.rmtree(results_dir, ignore_errors=True)
+    uploads_storage.remove(upload_dir)
+    results_storage.remove(results_dir)
 
+# ?quality=preview (or standard, high) selects the analysis quality
 @app.post("/sample")
-async def create_wonky_samples(background_tasks: BackgroundTasks, file: UploadFile = File(...) ):
+async def create_wonky_samples(background_tasks: BackgroundTasks, file: UploadFile = File(...), quality: str = Query(None)):
+    try:
+        quality = check_quality(quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     # Generate UUID for this process
     process_id = str(uuid.uuid4())
     
     # Create directories
-    upload_dir = os.path.join(UPLOAD_DIR, process_id)
-    results_dir = os.path.join(RESULTS_DIR, process_id)
-    os.makedirs(upload_dir, exist_ok=True)
-    os.makedirs(results_dir, exist_ok=True)
+    if storage.is_full():
+        raise HTTPException(status_code=503, detail="Server storage is full, try again later")
+    upload_dir = uploads_storage.create(process_id)
+    results_dir = results_storage.create(process_id)
     
     # Save uploaded file
     file_path = os.path.join(upload_dir, file.filename)
@@ -49,28 +63,24 @@ async def create_wonky_samples(background_tasks: BackgroundTasks, file: UploadFi
         shutil.copyfileobj(file.file, buffer)
     
     try:
-        # Determine song key
-        y, sr = librosa.load(file_path)
-        tonal_fragment = Tonal_Fragment(y, sr)
-        song_key = tonal_fragment.key.replace(" minor", "m").replace(" major", "")
-        
-        # Create wonky samples
+        # Create wonky samples in a worker process, the event loop keeps serving meanwhile
         wonky_output_folder = os.path.join(results_dir, "wonky_samples")
         os.makedirs(wonky_output_folder, exist_ok=True)
-        wonky_sampler(file_path, wonky_output_folder, song_key=song_key)
-        
-        # Prepare results
-        wonky_samples = os.listdir(wonky_output_folder)
+        await executor.run("wonky_sampler:sample_song", file_path, wonky_output_folder, quality=quality)
         
         # Create a zip file of the results
         zip_path = os.path.join(results_dir, "wonky_samples.zip")
-        shutil.make_archive(zip_path[:-4], 'zip', wonky_output_folder)
+        await asyncio.to_thread(shutil.make_archive, zip_path[:-4], 'zip', wonky_output_folder)
         
         background_tasks.add_task(cleanup_dirs, upload_dir, results_dir)
         
         return FileResponse(zip_path, filename="wonky_samples.zip")
     
+    except QueueFullError as e:
+        cleanup_dirs(upload_dir, results_dir)
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
+        cleanup_dirs(upload_dir, results_dir)
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
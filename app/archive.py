@@ -0,0 +1,78 @@
+import asyncio
+import os
+import threading
+import zipfile
+
+
+# file that zipfile cannot tell() or seek() in: zipfile then writes every entry strictly
+# sequentially (sizes and CRC go into a data descriptor after the data instead of being
+# patched into the header), so bytes already on disk never change and the archive can be
+# streamed to the client while it is still being written
+class _AppendOnlyFile(object):
+    def __init__(self, path):
+        self._f = open(path, "wb")
+
+    def write(self, data):
+        return self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+# zip archive that grows while the pipeline runs: each stage adds its output files as soon
+# as it finishes, with paths relative to root_dir
+# arguments:
+#     zip_path: where the archive is written
+#     root_dir: directory the paths inside the archive are relative to
+class StreamingZipWriter(object):
+    def __init__(self, zip_path, root_dir):
+        self.zip_path = zip_path
+        self.root_dir = root_dir
+        self._file = _AppendOnlyFile(zip_path)
+        self._zipf = zipfile.ZipFile(self._file, 'w')
+        self._added = set()
+        self._lock = threading.Lock()
+
+    # adds the files at paths (relative to directory); a path that is already in the archive
+    # is an error, the archive would no longer match the folder it mirrors
+    def add_files(self, directory, paths):
+        with self._lock:
+            for path in sorted(paths):
+                file_path = os.path.join(directory, path)
+                arcname = os.path.relpath(file_path, self.root_dir)
+                if arcname in self._added:
+                    raise ValueError(f"{arcname} is already in the archive")
+                self._zipf.write(file_path, arcname)
+                self._added.add(arcname)
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._zipf.close()
+            self._file.close()
+
+
+# yields the bytes of an archive that a StreamingZipWriter in another process is still
+# writing, in chunks of at most chunk_size, until job (the asyncio future of the pipeline
+# run) is done and the whole file has been read; re-raises the error of a failed job
+async def stream_archive(zip_path, job, chunk_size=256 * 1024):
+    while not os.path.exists(zip_path):
+        if job.done():
+            job.result()
+            return
+        await asyncio.wait([job], timeout=0.1)
+
+    with open(zip_path, "rb") as f:
+        while True:
+            finished = job.done()
+            chunk = f.read(chunk_size)
+            if chunk:
+                yield chunk
+                continue
+            if finished:
+                job.result()
+                return
+            await asyncio.wait([job], timeout=0.1)
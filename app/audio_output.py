@@ -0,0 +1,138 @@
+import collections
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# formats the generated samples can be written in: file extension, soundfile format and
+# subtype; wav16 is what the pipeline always wrote, flac is lossless at about half the size
+# for most material, ogg (vorbis) is lossy and about a tenth of the size
+OUTPUT_FORMATS = {
+    "wav16": (".wav", "WAV", "PCM_16"),
+    "wav24": (".wav", "WAV", "PCM_24"),
+    "flac": (".flac", "FLAC", "PCM_16"),
+    "ogg": (".ogg", "OGG", "VORBIS"),
+}
+DEFAULT_FORMAT = os.environ.get("SAMPLEBOX_OUTPUT_FORMAT", "wav16")
+
+# threads encoding samples in every process that writes them
+ENCODERS = int(os.environ.get("SAMPLEBOX_ENCODERS", os.cpu_count() or 1))
+
+
+# the format name, checked, for values coming from requests
+def check_format(name):
+    name = name or DEFAULT_FORMAT
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {name}, expected one of {', '.join(OUTPUT_FORMATS)}")
+    return name
+
+
+# format the SampleWriters of this process use unless given one, see use_output_format
+_format = DEFAULT_FORMAT
+
+
+def current_format():
+    return _format
+
+
+# writes the samples of the block in format name, in this process and in the stage
+# processes forked from it
+@contextmanager
+def use_output_format(name):
+    global _format
+    previous, _format = _format, check_format(name)
+    try:
+        yield
+    finally:
+        _format = previous
+
+
+# writes y to file (a path or a file object) in format name, block by block: a long y (a
+# memory mapped stem say) is never converted all at once, and the vorbis encoder of
+# libsndfile crashes on single writes of a few million frames
+def _write_blocks(file, y, sr, name, block_size=1024 * 1024):
+    # imported here, so the API server can check formats without loading the audio stack
+    import soundfile as sf
+
+    _, file_format, subtype = OUTPUT_FORMATS[name]
+    channels = 1 if y.ndim == 1 else y.shape[1]
+    with sf.SoundFile(file, "w", samplerate=sr, channels=channels, format=file_format, subtype=subtype) as f:
+        for start in range(0, len(y), block_size):
+            f.write(y[start:start + block_size])
+
+
+# the file of y encoded in format, encoded in memory and written with a single write
+def encode(y, sr, name):
+    buffer = io.BytesIO()
+    _write_blocks(buffer, y, sr, name)
+    return buffer.getvalue()
+
+
+def _encode_to_file(path, y, sr, name):
+    data = encode(y, sr, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _stream_to_file(path, y, sr, name):
+    _write_blocks(path, y, sr, name)
+    return path
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# the encoder threads of this process; a forked child starts threads of its own
+def _get_pool():
+    with _pools_lock:
+        pid = os.getpid()
+        if pid not in _pools:
+            _pools[pid] = ThreadPoolExecutor(max_workers=ENCODERS, thread_name_prefix="encoder")
+        return _pools[pid]
+
+
+# writes samples on the encoder threads, so a stage goes on cutting the next sample while
+# the previous ones are encoded (libsndfile releases the GIL while it encodes); every sample
+# is reported with sample_written once it is on disk, on the thread calling write, in the
+# order the samples were written; leaving the with block waits for all of them
+# arguments:
+#     name: output format, the one set with use_output_format by default
+class SampleWriter(object):
+    def __init__(self, name=None):
+        self.name = check_format(name or _format)
+        self._pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            for future, _ in self._pending:
+                future.cancel()
+            return
+        self._report(wait=True)
+
+    # writes y at path with the extension of the format, returns the path written
+    def write(self, path, y, sr, metadata=None):
+        return self._submit(_encode_to_file, path, y, sr, metadata)
+
+    # like write, but for whole stems: y is written to the file block by block instead of
+    # being encoded in memory first
+    def write_stream(self, path, y, sr, metadata=None):
+        return self._submit(_stream_to_file, path, y, sr, metadata)
+
+    def _submit(self, encode_fn, path, y, sr, metadata):
+        path = os.path.splitext(path)[0] + OUTPUT_FORMATS[self.name][0]
+        self._report(wait=False)
+        self._pending.append((_get_pool().submit(encode_fn, path, y, sr, self.name), metadata))
+        return path
+
+    def _report(self, wait):
+        from sample_metadata import sample_written
+
+        while self._pending and (wait or self._pending[0][0].done()):
+            future, metadata = self._pending.popleft()
+            sample_written(future.result(), metadata)
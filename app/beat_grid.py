@@ -0,0 +1,69 @@
+import librosa
+import numpy as np
+
+import feature_cache
+
+
+# regular grid of beats fitted to the beats tracked in a song, the one place the samplers
+# get their bar boundaries from: the beat period is fitted over all tracked beats (not just
+# the first two), the grid starts at the first beat, and every chunk of a given size has
+# exactly the same length, so loops cut from it line up
+# arguments:
+#     period: length of a beat in samples (a float, so long songs do not drift)
+#     offset: sample of the first beat of the grid
+#     length: number of samples of the song
+#     sr: sampling rate of the song
+#     beats_per_bar: 4 for the 4/4 time signature all samplers assume
+class BeatGrid(object):
+    def __init__(self, period, offset, length, sr, beats_per_bar=4):
+        self.period = period
+        self.offset = offset
+        self.length = length
+        self.sr = sr
+        self.beats_per_bar = beats_per_bar
+
+    # fits the grid to the beats tracked in y, the tracked tempo is only used when fewer
+    # than two beats were found
+    @classmethod
+    def track(cls, y, sr, hop_length=512):
+        tempo, beat_frames = feature_cache.beat_track(y, sr, hop_length=hop_length)
+        beat_samples = librosa.frames_to_samples(beat_frames, hop_length=hop_length)
+        if len(beat_samples) >= 2:
+            period, phase = np.polyfit(np.arange(len(beat_samples)), beat_samples, 1)
+        else:
+            period = 60 * sr / float(np.atleast_1d(tempo)[0]) if np.any(tempo) else 0.0
+            phase = beat_samples[0] if len(beat_samples) else 0.0
+        offset = phase % period if period > 0 else 0.0
+        return cls(float(period), float(offset), len(y), sr)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def to_dict(self):
+        return {
+            "period": self.period,
+            "offset": self.offset,
+            "length": self.length,
+            "sr": self.sr,
+            "beats_per_bar": self.beats_per_bar,
+        }
+
+    @property
+    def tempo(self):
+        return 60 * self.sr / self.period if self.period > 0 else 0.0
+
+    # (starts, ends) sample arrays of all whole chunks of beats_per_chunk beats in the song
+    def chunks(self, beats_per_chunk=1):
+        if self.period <= 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        chunk_period = beats_per_chunk * self.period
+        chunk_length = int(round(chunk_period))
+        count = int((self.length - self.offset - chunk_length) // chunk_period) + 1
+        starts = np.round(self.offset + np.arange(max(count, 0)) * chunk_period).astype(int)
+        starts = starts[starts + chunk_length <= self.length]
+        return starts, starts + chunk_length
+
+    # (starts, ends) sample arrays of all whole chunks of bars_per_chunk bars in the song
+    def bars(self, bars_per_chunk=1):
+        return self.chunks(bars_per_chunk * self.beats_per_bar)
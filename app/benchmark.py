@@ -0,0 +1,374 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import soundfile as sf
+
+# reproducible benchmarks of the pipeline on synthetic songs: every fixture is generated
+# from a seed (drums at a known BPM plus a chord progression in a known key), so runs on
+# different commits process exactly the same audio and their results can be compared
+#
+#     python benchmark.py -o bench.json                       # run and save the results
+#     python benchmark.py -o new.json --baseline bench.json   # compare with an earlier run
+#
+# each benchmark reports the best wall time of its repeats, the throughput in seconds of
+# audio per wall second and the peak of memory allocated while it runs (traced in an extra
+# untimed run, after a warm-up run that imports the modules and compiles the numba kernels);
+# the /ws flow runs in freshly warmed worker processes, its peak memory is the highest peak
+# RSS the pipeline reports for its stages
+
+SR = 22050
+
+# (tonic, mode) of the fixture key -> its chords, one per bar, as semitones above the tonic
+PROGRESSIONS = {
+    "major": [(0, 4, 7), (7, 11, 14), (9, 12, 16), (5, 9, 12)],     # I V vi IV
+    "minor": [(0, 3, 7), (8, 12, 15), (3, 7, 10), (10, 14, 17)],    # i VI III VII
+}
+
+
+# deterministic synthetic song of the given length: a drum pattern (kicks on 1 and 3, snares
+# on 2 and 4, hi-hats on every eighth) at bpm and a chord progression in key (e.g. "A minor")
+# with one chord per bar; returns the mix and its two parts
+def synth_song(seconds, bpm=120, key="A minor", sr=SR, seed=0):
+    rng = np.random.default_rng(seed)
+    length = int(seconds * sr)
+    beat = 60.0 / bpm
+    drums = np.zeros(length, dtype=np.float32)
+    harmonic = np.zeros(length, dtype=np.float32)
+
+    def add(signal, start, sound):
+        start = int(round(start * sr))
+        if start < length:
+            end = min(length, start + len(sound))
+            signal[start:end] += sound[:end - start]
+
+    t = np.arange(int(0.4 * sr)) / sr
+    kick = np.sin(2 * np.pi * (50 * t + 70 * 0.04 * (1 - np.exp(-t / 0.04)))) * np.exp(-t / 0.12)
+    snare = (0.6 * rng.standard_normal(len(t)) + 0.4 * np.sin(2 * np.pi * 180 * t)) * np.exp(-t / 0.05)
+    noise = rng.standard_normal(len(t))
+    hat = np.diff(noise, prepend=0) * np.exp(-t / 0.015) * 0.3
+    for i in range(int(seconds / beat) + 1):
+        add(drums, i * beat, kick if i % 2 == 0 else snare)
+        add(drums, i * beat, hat)
+        add(drums, (i + 0.5) * beat, hat)
+
+    tonic, mode = key.split()
+    root = 48 + ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"].index(tonic)
+    bar = 4 * beat
+    t = np.arange(int(bar * sr)) / sr
+    envelope = np.minimum(1, t / 0.02) * np.exp(-t / (2 * bar))
+    for i in range(int(seconds / bar) + 1):
+        chord = PROGRESSIONS[mode][i % len(PROGRESSIONS[mode])]
+        tones = sum(np.sin(2 * np.pi * 440 * 2 ** ((root + note - 69) / 12) * t * k) / k
+                    for note in chord for k in (1, 2, 3))
+        add(harmonic, i * bar, 0.15 * tones * envelope)
+
+    mix = 0.5 * drums + harmonic
+    scale = 0.9 / max(np.max(np.abs(mix)), 1e-9)
+    return (mix * scale).astype(np.float32), (drums * 0.5 * scale).astype(np.float32), (harmonic * scale).astype(np.float32)
+
+
+# the fixture of one length, with fresh SongContexts for every run so nothing computed by an
+# earlier run (beat grid, stems, key) is reused
+class Fixture(object):
+    def __init__(self, seconds, bpm, key, work_dir):
+        self.seconds = seconds
+        self.bpm = bpm
+        self.key = key
+        self.mix, self.drums, self.harmonic = synth_song(seconds, bpm, key)
+        self.path = os.path.join(work_dir, f"synthetic_{seconds:g}s.wav")
+        sf.write(self.path, self.mix, SR)
+
+    def contexts(self):
+        from song_context import SongContext
+
+        song = SongContext(self.mix, SR)
+        return song, SongContext(self.drums, SR, parent=song), SongContext(self.harmonic, SR, parent=song)
+
+
+# measures the part of a benchmark inside its with block, so setup is not timed
+class Timer(object):
+    def __init__(self, traced=False):
+        self.traced = traced
+        self.seconds = None
+        self.peak = None
+
+    def __enter__(self):
+        if self.traced:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._start
+        if self.traced:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def tempos_from_names(out_dir):
+    return sorted({name.split("_")[0] for name in os.listdir(out_dir)})
+
+
+def bench_drum_hits(fixture, out_dir, timer):
+    from perc_splitter import extract_drum_hits
+
+    _, drums, _ = fixture.contexts()
+    with timer:
+        hits = extract_drum_hits(drums, out_dir)
+    return {drum_type: len(samples) for drum_type, samples in hits.items()}
+
+
+def bench_harmonic_samples(fixture, out_dir, timer):
+    from perc_splitter import extract_harmonic_samples
+
+    _, _, harmonic = fixture.contexts()
+    with timer:
+        extract_harmonic_samples(harmonic, out_dir)
+    return {"samples": len(os.listdir(out_dir))}
+
+
+def bench_percussive_loops(fixture, out_dir, timer):
+    from perc_splitter import create_percussive_loops_from_original
+
+    _, drums, _ = fixture.contexts()
+    with timer:
+        create_percussive_loops_from_original(drums, out_dir)
+    return {"tempos": tempos_from_names(out_dir), "expected_tempo": fixture.bpm}
+
+
+def bench_wonky_sampler(fixture, out_dir, timer):
+    from wonky_sampler import main as wonky_sampler
+
+    song, _, _ = fixture.contexts()
+    with timer:
+        wonky_sampler(song, out_dir)
+    return {"samples": len(os.listdir(out_dir))}
+
+
+def bench_tonal_fragment(fixture, out_dir, timer):
+    from Tonal_Fragment import Tonal_Fragment
+
+    with timer:
+        key = Tonal_Fragment(fixture.mix, SR).key
+    return {"key": key, "expected_key": fixture.key, "correct": key == fixture.key}
+
+
+# the whole websocket flow of 3main.py: chunked upload, processing in the worker pool,
+# streaming of every sample and of the samplebox zip; every run gets a new server, whose
+# workers are warmed up before the timer starts, and an empty result cache, so every stage
+# runs
+def bench_ws(fixture, out_dir, timer):
+    from fastapi.testclient import TestClient
+    from result_cache import result_cache
+
+    server = importlib.import_module("3main")
+    result_cache.clear()
+    with open(fixture.path, "rb") as f:
+        data = f.read()
+
+    received = 0
+    samples = 0
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        with TestClient(server.app) as client:
+            # the workers run init_worker before their first task
+            pool = server.executor._get_pool()
+            for future in [pool.submit(os.getpid) for _ in range(server.executor.max_workers)]:
+                future.result()
+            with timer, client.websocket_connect("/ws?timings=1&samples=1") as websocket:
+                _upload(websocket, os.path.basename(fixture.path), data)
+                while True:
+                    message = websocket.receive()
+                    if message.get("bytes"):
+                        if message["bytes"][0] == server.SAMPLE:
+                            samples += 1
+                        else:
+                            received += len(message["bytes"]) - 1
+                    elif message.get("text"):
+                        status = json.loads(message["text"])
+                        if status["status"] == "error":
+                            raise RuntimeError(status["message"])
+                        if status["status"] == "complete":
+                            break
+    finally:
+        os.chdir(cwd)
+    pipeline = status.get("timings", {}).get("pipeline", {})
+    profiles = list(pipeline.get("stages", {}).values()) + list(pipeline.get("resources", {}).values())
+    return {
+        "zip_bytes": received,
+        "samples": samples,
+        "first_sample_seconds": status.get("timings", {}).get("first_sample"),
+        "pipeline_seconds": pipeline.get("seconds"),
+        "peak_rss_bytes": max((profile.get("peak_rss", 0) for profile in profiles), default=None),
+    }
+
+
+# sends data with the upload protocol of uploads.py, keeping window chunks in flight
+def _upload(websocket, filename, data):
+    websocket.send_text(json.dumps({"type": "upload", "filename": filename, "size": len(data)}))
+    ready = json.loads(websocket.receive_text())
+    chunk_size = ready["chunk_size"]
+    chunks = [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+    acked = 0
+    for seq, chunk in enumerate(chunks):
+        if seq - acked >= ready["window"]:
+            websocket.receive_text()
+            acked += 1
+        websocket.send_bytes(seq.to_bytes(4, "big") + chunk)
+    for _ in range(acked, len(chunks)):
+        websocket.receive_text()
+    websocket.send_text(json.dumps({"type": "end"}))
+
+
+# name -> (function, runs in this process); the functions get the fixture, an empty output
+# directory and the Timer to measure the benchmarked call with, and return values that are
+# recorded with the timings (counts, detected tempos and keys), so a speedup that changes
+# the results shows up next to its timing
+BENCHMARKS = {
+    "extract_drum_hits": (bench_drum_hits, True),
+    "extract_harmonic_samples": (bench_harmonic_samples, True),
+    "create_percussive_loops_from_original": (bench_percussive_loops, True),
+    "wonky_sampler": (bench_wonky_sampler, True),
+    "Tonal_Fragment": (bench_tonal_fragment, True),
+    "ws": (bench_ws, False),
+}
+
+
+def run_once(fn, fixture, work_dir, seed, traced=False):
+    import feature_cache
+
+    feature_cache.feature_cache.clear()
+    random.seed(seed)
+    np.random.seed(seed)
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    timer = Timer(traced)
+    try:
+        checks = fn(fixture, out_dir, timer)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return timer.seconds, timer.peak, checks
+
+
+def run_benchmark(name, fixture, work_dir, repeat, seed):
+    fn, in_process = BENCHMARKS[name]
+    if in_process:
+        run_once(fn, fixture, work_dir, seed)
+        _, peak, _ = run_once(fn, fixture, work_dir, seed, traced=True)
+    runs = []
+    for _ in range(repeat):
+        seconds, _, checks = run_once(fn, fixture, work_dir, seed)
+        runs.append(seconds)
+    if not in_process:
+        peak = checks.get("peak_rss_bytes")
+    best = min(runs)
+    result = {
+        "benchmark": name,
+        "audio_seconds": fixture.seconds,
+        "wall_seconds": best,
+        "runs": runs,
+        "throughput": fixture.seconds / best if best > 0 else None,
+        "peak_memory_bytes": peak,
+        "peak_memory": "allocated" if in_process else "rss",
+        "checks": checks,
+    }
+    print(f"{name} on {fixture.seconds}s: {best:.2f}s, {result['throughput']:.1f}x realtime, "
+          f"peak {peak / 2 ** 20 if peak else 0:.0f} MB")
+    return result
+
+
+def environment():
+    import librosa
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "librosa": librosa.__version__,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+# prints the change of every benchmark against the baseline; returns the names of the ones
+# that got slower by more than tolerance (a fraction)
+def compare(results, baseline, tolerance):
+    base = {(result["benchmark"], result["audio_seconds"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = (result["benchmark"], result["audio_seconds"])
+        if key not in base:
+            continue
+        ratio = result["wall_seconds"] / base[key]["wall_seconds"]
+        marker = ""
+        if ratio > 1 + tolerance:
+            marker = "  REGRESSION"
+            regressions.append(f"{key[0]} on {key[1]}s")
+        if result["checks"] != base[key]["checks"]:
+            marker += "  (results changed)"
+        print(f"{key[0]} on {key[1]}s: {base[key]['wall_seconds']:.2f}s -> {result['wall_seconds']:.2f}s ({ratio:.2f}x){marker}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the samplebox pipeline on synthetic songs.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="file the results are written to")
+    parser.add_argument("--lengths", type=float, nargs="+", default=[30, 120], help="fixture lengths in seconds")
+    parser.add_argument("--bpm", type=float, default=120, help="tempo of the fixtures")
+    parser.add_argument("--key", default="A minor", help='key of the fixtures, e.g. "A minor" or "C major"')
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark, the best one counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="samplebox-benchmark-")
+    # nothing of an earlier run (or of the server) may be restored from a cache
+    os.environ["SAMPLEBOX_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    os.environ["SAMPLEBOX_METRICS_DIR"] = os.path.join(work_dir, "metrics")
+    # the /ws benchmark only needs the worker pool of the websocket server
+    os.environ["SAMPLEBOX_JOBS_DIR"] = os.path.join(work_dir, "jobs")
+    os.environ["SAMPLEBOX_QUEUE_WORKERS"] = "0"
+    try:
+        results = []
+        for seconds in args.lengths:
+            fixture = Fixture(seconds, args.bpm, args.key, work_dir)
+            for name in args.only or BENCHMARKS:
+                results.append(run_benchmark(name, fixture, work_dir, args.repeat, args.seed))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"environment": environment(), "settings": vars(args), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Slower than the baseline: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
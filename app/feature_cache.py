@@ -0,0 +1,204 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import librosa
+import numpy as np
+
+# in-process LRU cache for analysis features (STFTs, onset envelopes, RMS, chroma, ...)
+# keyed by the content hash of the signal plus the parameters used to compute the feature,
+# so that every stage asking for the same analysis of the same audio gets the cached array
+# arguments:
+#     max_bytes: total size of the cached arrays before the least recently used get evicted
+class FeatureCache(object):
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    # forgets every entry and the hit and miss counts, e.g. once a job is done
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 64
+
+
+# reduces values over [starts[i], ends[i]) along axis for every i with a single
+# ufunc.reduceat call; the segments may overlap since reduceat only looks at each
+# (start, end) pair, but every segment must be non-empty and end at most at the axis length
+def segment_reduce(ufunc, values, starts, ends, axis=-1):
+    indices = np.empty(2 * len(starts), dtype=np.intp)
+    indices[0::2] = starts
+    indices[1::2] = ends
+    # the padding keeps indices equal to the axis length valid
+    values = np.concatenate([values, np.take(values, [0], axis=axis)], axis=axis)
+    return np.take(ufunc.reduceat(values, indices, axis=axis), np.arange(0, len(indices), 2), axis=axis)
+
+
+# content hash of a signal, used as the first part of every cache key
+def signal_hash(y):
+    y = np.ascontiguousarray(y)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((y.shape, y.dtype.str)).encode())
+    digest.update(y.view(np.uint8))
+    return digest.hexdigest()
+
+
+feature_cache = FeatureCache()
+
+
+def stft(y, n_fft=2048, hop_length=512):
+    key = (signal_hash(y), "stft", n_fft, hop_length)
+    return feature_cache.get_or_compute(key, lambda: librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+
+
+def magnitude(y, n_fft=2048, hop_length=512):
+    key = (signal_hash(y), "magnitude", n_fft, hop_length)
+    return feature_cache.get_or_compute(key, lambda: np.abs(stft(y, n_fft=n_fft, hop_length=hop_length)))
+
+
+# log-power mel spectrogram, the input of every onset envelope below
+def mel_db(y, sr, n_fft=2048, hop_length=512):
+    def compute():
+        S = magnitude(y, n_fft=n_fft, hop_length=hop_length) ** 2
+        return librosa.power_to_db(librosa.feature.melspectrogram(S=S, sr=sr))
+
+    key = (signal_hash(y), "mel_db", sr, n_fft, hop_length)
+    return feature_cache.get_or_compute(key, compute)
+
+
+# aggregate is np.mean for onset detection and np.median for beat tracking, as in librosa
+def onset_envelope(y, sr, hop_length=512, aggregate=np.mean):
+    def compute():
+        S = mel_db(y, sr, hop_length=hop_length)
+        return librosa.onset.onset_strength(S=S, sr=sr, hop_length=hop_length, aggregate=aggregate)
+
+    key = (signal_hash(y), "onset_envelope", sr, hop_length, aggregate.__name__)
+    return feature_cache.get_or_compute(key, compute)
+
+
+def beat_track(y, sr, hop_length=512):
+    def compute():
+        env = onset_envelope(y, sr, hop_length=hop_length, aggregate=np.median)
+        return librosa.beat.beat_track(onset_envelope=env, sr=sr, hop_length=hop_length)
+
+    key = (signal_hash(y), "beat_track", sr, hop_length)
+    return feature_cache.get_or_compute(key, compute)
+
+
+def onset_detect(y, sr, hop_length=512, **kwargs):
+    def compute():
+        env = onset_envelope(y, sr, hop_length=hop_length)
+        return librosa.onset.onset_detect(onset_envelope=env, sr=sr, hop_length=hop_length, **kwargs)
+
+    key = (signal_hash(y), "onset_detect", sr, hop_length, tuple(sorted(kwargs.items())))
+    return feature_cache.get_or_compute(key, compute)
+
+
+def rms(y, hop_length=512):
+    key = (signal_hash(y), "rms", hop_length)
+    return feature_cache.get_or_compute(key, lambda: librosa.feature.rms(y=y, hop_length=hop_length))
+
+
+def chroma_cqt(y, sr, bins_per_octave=24, hop_length=512):
+    key = (signal_hash(y), "chroma_cqt", sr, bins_per_octave, hop_length)
+    return feature_cache.get_or_compute(key, lambda: librosa.feature.chroma_cqt(
+        y=y, sr=sr, bins_per_octave=bins_per_octave, hop_length=hop_length))
+
+
+# chromagram of the STFT of y, a fraction of the cost of the constant-Q one
+def chroma_stft(y, sr, hop_length=512):
+    key = (signal_hash(y), "chroma_stft", sr, hop_length)
+    return feature_cache.get_or_compute(key, lambda: librosa.feature.chroma_stft(y=y, sr=sr, hop_length=hop_length))
+
+
+# pitch shifting and time stretching are memoized like the analyses above, keyed by the
+# hash of the input and the transform, since the same (bar, semitones) and (bar, rate)
+# pairs keep coming back across the segments of a song; the results are shared, so callers
+# must not modify them in place. Transforms of signals that never come back (a whole
+# segment, say) call librosa directly instead of filling the cache
+def pitch_shift(y, sr, n_steps, n_fft=2048, res_type="soxr_hq"):
+    key = (signal_hash(y), "pitch_shift", sr, float(n_steps), n_fft, res_type)
+    return feature_cache.get_or_compute(key, lambda: librosa.effects.pitch_shift(
+        y, sr=sr, n_steps=n_steps, n_fft=n_fft, res_type=res_type))
+
+
+def time_stretch(y, rate, n_fft=2048):
+    key = (signal_hash(y), "time_stretch", float(rate), n_fft)
+    return feature_cache.get_or_compute(key, lambda: librosa.effects.time_stretch(y, rate=rate, n_fft=n_fft))
+
+
+# same as librosa.effects.hpss, but the STFT it separates is shared with the other features
+def hpss(y, n_fft=2048, kernel_size=31):
+    D = stft(y, n_fft=n_fft, hop_length=n_fft // 4)
+    D_harmonic, D_percussive = librosa.decompose.hpss(D, kernel_size=kernel_size)
+    y_harmonic = librosa.istft(D_harmonic, hop_length=n_fft // 4, dtype=y.dtype, length=len(y))
+    y_percussive = librosa.istft(D_percussive, hop_length=n_fft // 4, dtype=y.dtype, length=len(y))
+    return y_harmonic, y_percussive
+
+
+# runs every librosa analysis of the pipeline once on two seconds of synthetic clicks, so the
+# numba kernels behind them (beat tracking, peak picking, phase vocoder, ...) are compiled at
+# worker start instead of during the first song; bypasses the cache, nothing is kept
+def warm_up(sr=22050):
+    y = librosa.clicks(times=np.arange(0, 2, 0.5), sr=sr, length=2 * sr)
+    y = y + 0.01 * np.random.default_rng(0).standard_normal(len(y)).astype(y.dtype)
+    librosa.beat.beat_track(y=y, sr=sr)
+    librosa.onset.onset_detect(y=y, sr=sr, wait=1, pre_avg=1, post_avg=1, pre_max=1, post_max=1)
+    librosa.feature.rms(y=y)
+    librosa.feature.chroma_cqt(y=y, sr=sr, bins_per_octave=24)
+    librosa.feature.chroma_stft(y=y, sr=sr)
+    librosa.effects.pitch_shift(y, sr=sr, n_steps=1)
+    librosa.effects.time_stretch(y, rate=1.1)
+    librosa.effects.hpss(y)
@@ -0,0 +1,130 @@
+import os
+import shutil
+import uuid
+
+from fastapi import APIRouter, File, HTTPException, Query, UploadFile
+from fastapi.responses import FileResponse
+
+from audio_output import check_format
+from quality import check_quality
+from job_executor import PROCESS_SONG, QueueFullError
+from job_queue import ACTIVE_STATUSES, JobQueue, spawn_workers
+from storage import storage
+
+JOBS_DIR = os.environ.get("SAMPLEBOX_JOBS_DIR", "jobs")
+JOBS_DB = os.environ.get("SAMPLEBOX_JOBS_DB", os.path.join(JOBS_DIR, "jobs.db"))
+# worker processes this server starts for the queue; none by default, the jobs are run by a
+# dedicated worker deployment (samplebox worker) on the same database, so servers do not
+# start a second pool next to the one of their JobExecutor; while no worker is running,
+# new jobs are refused
+QUEUE_WORKERS = int(os.environ.get("SAMPLEBOX_QUEUE_WORKERS", 0))
+MAX_QUEUE = int(os.environ.get("SAMPLEBOX_MAX_QUEUE", 2 * (QUEUE_WORKERS or os.cpu_count() or 1)))
+JOB_TIMEOUT = float(os.environ.get("SAMPLEBOX_JOB_TIMEOUT", 900))
+# seconds the result of a job is kept after it ended (or was last downloaded)
+JOBS_TTL = float(os.environ.get("SAMPLEBOX_JOBS_TTL", 24 * 3600))
+
+router = APIRouter()
+queue = JobQueue(JOBS_DB, max_queue=MAX_QUEUE)
+workers = []
+
+
+# the work directory of a queued or running job is never evicted; the job of one that was
+# evicted, or deleted by the worker of the cancelled job, is forgotten
+def job_active(job_id):
+    job = queue.get(job_id)
+    return job is not None and job["status"] in ACTIVE_STATUSES
+
+
+jobs_storage = storage.add_area("jobs", JOBS_DIR, JOBS_TTL, in_use=job_active, on_evict=queue.delete)
+
+
+@router.on_event("startup")
+def start_workers():
+    if QUEUE_WORKERS:
+        workers.extend(spawn_workers(JOBS_DB, PROCESS_SONG, JOB_TIMEOUT, QUEUE_WORKERS))
+
+
+@router.on_event("shutdown")
+def stop_workers():
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+    workers.clear()
+
+
+def job_status(job):
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+
+def get_job_or_404(job_id):
+    job = queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+# ?format=flac (or wav16, wav24, ogg) selects the format of the samples, ?quality=preview
+# (or standard, high) the analysis quality
+@router.post("/jobs", status_code=202)
+async def create_job(file: UploadFile = File(...), output_format: str = Query(None, alias="format"),
+                     quality: str = Query(None)):
+    try:
+        options = {"output_format": check_format(output_format), "quality": check_quality(quality)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if storage.is_full():
+        raise HTTPException(status_code=503, detail="Server storage is full, try again later")
+    if not queue.live_workers():
+        raise HTTPException(status_code=503, detail="No job workers are running, try again later")
+
+    job_id = str(uuid.uuid4())
+    work_dir = jobs_storage.create(job_id)
+
+    # Save the uploaded file, process_song names the samplebox folder after it
+    input_path = os.path.join(work_dir, os.path.basename(file.filename))
+    with open(input_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+    try:
+        queue.enqueue(job_id, input_path, work_dir, options)
+    except QueueFullError as e:
+        jobs_storage.remove(work_dir)
+        raise HTTPException(status_code=503, detail=str(e))
+    # from here on the queue tells whether the job still needs it
+    jobs_storage.release(work_dir)
+    return job_status(queue.get(job_id))
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return job_status(get_job_or_404(job_id))
+
+
+@router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = get_job_or_404(job_id)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    jobs_storage.touch(job["work_dir"])
+    return FileResponse(job["result_path"], media_type="application/zip", filename=f"{job_id}_samplebox.zip")
+
+
+@router.delete("/jobs/{job_id}")
+async def delete_job(job_id: str):
+    job = get_job_or_404(job_id)
+    if job["status"] == "running":
+        # the worker notices at its next progress update, stops and removes the files
+        queue.update(job_id, status="cancelled", stage="Cancelled")
+    else:
+        queue.delete(job_id)
+        jobs_storage.remove(job["work_dir"])
+    return {"id": job_id, "status": "cancelled" if job["status"] == "running" else "deleted"}
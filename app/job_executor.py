@@ -0,0 +1,198 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import metrics
+
+# import path of the pipeline the API servers run; they hand this string to the workers
+# instead of the function, so only the worker processes import librosa, scipy, numba & co
+PROCESS_SONG = "perc_splitter:process_song"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+# runs CPU-bound pipeline jobs in a bounded pool of worker processes, so the event loop of
+# the API server stays free to serve other connections while songs are being processed
+# arguments:
+#     max_workers: number of worker processes, i.e. songs processed at the same time
+#     max_queue: number of jobs that may be running or waiting before new ones are refused
+#     timeout: seconds a single job may run before it is aborted
+class JobExecutor(object):
+    def __init__(self, max_workers=None, max_queue=None, timeout=None):
+        self.max_workers = max_workers or int(os.environ.get("SAMPLEBOX_WORKERS", os.cpu_count() or 1))
+        self.max_queue = max_queue or int(os.environ.get("SAMPLEBOX_MAX_QUEUE", 2 * self.max_workers))
+        self.timeout = timeout or float(os.environ.get("SAMPLEBOX_JOB_TIMEOUT", 900))
+        self.pending = 0
+        self._pool = None
+        self._manager = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker,
+                                             initargs=(self.max_workers,))
+        return self._pool
+
+    def _get_manager(self):
+        if self._manager is None:
+            self._manager = multiprocessing.Manager()
+        return self._manager
+
+    # starts the worker processes (and the manager) right away, so they import and warm up
+    # the pipeline while the server starts instead of on the first request
+    def start(self):
+        pool = self._get_pool()
+        self._get_manager()
+        for _ in range(self.max_workers):
+            pool.submit(os.getpid)
+
+    def is_full(self):
+        return self.pending >= self.max_queue
+
+    # runs fn(*args, send_message, **kwargs) in a worker process (fn may be an import path)
+    # and returns its result; every message the job sends is forwarded to on_progress (an
+    # async callable) while the job runs
+    # if the caller gives up on the job (the task is cancelled, or on_progress raises), the
+    # job is stopped in its worker and run only returns once it has ended, so the caller may
+    # remove the files of the job and the worker is free for the next one
+    async def run(self, fn, *args, on_progress=None, **kwargs):
+        if self.is_full():
+            metrics.inc("samplebox_jobs_total", status="rejected")
+            raise QueueFullError(f"Server is busy, {self.pending} songs are already queued")
+        self.pending += 1
+        start = time.perf_counter()
+        status = "error"
+        try:
+            progress = self._get_manager().Queue()
+            cancelled = self._get_manager().Event()
+            job = self._get_pool().submit(run_job, fn, args, progress, self.timeout, kwargs, cancelled)
+            future = asyncio.wrap_future(job)
+            try:
+                # the worker enforces the timeout itself, the grace period covers queueing delays
+                # only in the rare case a worker died without reporting back
+                result = await asyncio.wait_for(self._relay(future, progress, on_progress), self.timeout * 2)
+            except BaseException:
+                if not future.done():
+                    status = "cancelled"
+                    # a job still waiting for a worker is just dropped
+                    if not job.cancel():
+                        cancelled.set()
+                        await asyncio.wait([future], timeout=self.timeout)
+                        if future.done():
+                            future.exception()
+                raise
+            status = "done"
+            return result
+        finally:
+            self.pending -= 1
+            metrics.inc("samplebox_jobs_total", status=status)
+            metrics.observe("samplebox_job_seconds", time.perf_counter() - start)
+
+    async def _relay(self, future, progress, on_progress):
+        while True:
+            done = future.done()
+            while not progress.empty():
+                message = progress.get_nowait()
+                if on_progress is not None:
+                    await on_progress(message)
+            if done:
+                return future.result()
+            await asyncio.wait([future], timeout=0.2)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+# fn itself, or the function a "module:function" import path like PROCESS_SONG names
+def resolve(fn):
+    if isinstance(fn, str):
+        module, name = fn.split(":")
+        return getattr(importlib.import_module(module), name)
+    return fn
+
+
+# runs once in every worker process before its first job: imports the pipeline, compiles the
+# numba kernels of librosa and loads the models the jobs need, so no song pays for a cold start
+# concurrent_jobs is the number of jobs the pool of the worker runs at once (see
+# stage_graph.set_concurrent_jobs)
+def init_worker(concurrent_jobs=1):
+    import feature_cache
+    import stage_graph
+    import stem_separator
+
+    stage_graph.set_concurrent_jobs(concurrent_jobs)
+
+    resolve(PROCESS_SONG)
+    feature_cache.warm_up()
+    stem_separator.warm_up()
+
+
+def _on_timeout(signum, frame):
+    raise JobTimeoutError("Processing took too long and was aborted")
+
+
+def _on_cancel(signum, frame):
+    raise JobCancelledError("Processing was cancelled")
+
+
+# thread of run_job that interrupts the job with SIGUSR1 once cancelled (a manager Event) is
+# set, like the alarm does when it takes too long
+def _watch_cancel(cancelled, finished):
+    while not finished.is_set():
+        if cancelled.wait(0.5):
+            if not finished.is_set():
+                os.kill(os.getpid(), signal.SIGUSR1)
+            return
+
+
+# entry point inside the worker process, fn may be a plain function or a coroutine function,
+# or the import path of one; the job is aborted with JobCancelledError once cancelled (a
+# manager Event) is set
+def run_job(fn, args, progress, timeout, kwargs=None, cancelled=None):
+    fn = resolve(fn)
+    kwargs = kwargs or {}
+
+    def send_message(message):
+        progress.put(message)
+
+    async def send_message_async(message):
+        send_message(message)
+
+    finished = threading.Event()
+    if cancelled is not None:
+        signal.signal(signal.SIGUSR1, _on_cancel)
+        watcher = threading.Thread(target=_watch_cancel, args=(cancelled, finished), daemon=True)
+        watcher.start()
+    signal.signal(signal.SIGALRM, _on_timeout)
+    # a timer rather than alarm(), which takes whole seconds and turns a timeout under one
+    # second into no timeout at all
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        if asyncio.iscoroutinefunction(fn):
+            return asyncio.run(fn(*args, send_message_async, **kwargs))
+        return fn(*args, send_message, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        finished.set()
+        if cancelled is not None:
+            watcher.join()
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
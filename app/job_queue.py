@@ -0,0 +1,211 @@
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+
+from job_executor import JobCancelledError, QueueFullError, init_worker, run_job
+from metrics import metrics
+
+ACTIVE_STATUSES = ("queued", "running")
+# seconds between the heartbeats of a worker, see JobQueue.heartbeat
+HEARTBEAT_INTERVAL = 10
+
+
+# persistent job queue stored in a local SQLite database, shared by the API server and the
+# worker processes; a job survives dropped connections and server restarts
+# arguments:
+#     db_path: path of the SQLite database file, created on first use
+#     max_queue: number of queued or running jobs before enqueue refuses new ones
+class JobQueue(object):
+    def __init__(self, db_path, max_queue=16):
+        self.db_path = db_path
+        self.max_queue = max_queue
+        self._created = False
+
+    # the database (and its directory) is created on first use, not when the queue is
+    # constructed at import time
+    def _connect(self):
+        if not self._created:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._created:
+            self._create_tables(conn)
+            self._created = True
+        return conn
+
+    def _create_tables(self, conn):
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress REAL NOT NULL DEFAULT 0,
+                input_path TEXT NOT NULL,
+                work_dir TEXT NOT NULL,
+                result_path TEXT,
+                error TEXT,
+                options TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        # databases created before jobs had options
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "options" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN options TEXT")
+        conn.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+
+    # options are the keyword arguments the job is processed with (e.g. output_format)
+    def enqueue(self, job_id, input_path, work_dir, options=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                active = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", ACTIVE_STATUSES
+                ).fetchone()[0]
+                if active >= self.max_queue:
+                    raise QueueFullError(f"Server is busy, {active} songs are already queued")
+                conn.execute(
+                    "INSERT INTO jobs (id, status, stage, input_path, work_dir, options, created_at, updated_at) "
+                    "VALUES (?, 'queued', 'Waiting in queue', ?, ?, ?, ?, ?)",
+                    (job_id, input_path, work_dir, json.dumps(options or {}), now, now),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    # atomically marks the oldest queued job as running and returns it, or None
+    def claim(self):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                    (time.time(), row["id"]),
+                )
+            conn.execute("COMMIT")
+        return dict(row) if row is not None else None
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def delete(self, job_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    # workers call this every HEARTBEAT_INTERVAL seconds while they run, so servers can tell
+    # whether anyone picks up the jobs they queue
+    def heartbeat(self, worker_id):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (id, seen_at) VALUES (?, ?)", (worker_id, time.time()))
+
+    # number of workers that sent a heartbeat in the last max_age seconds; the others are
+    # forgotten
+    def live_workers(self, max_age=3 * HEARTBEAT_INTERVAL):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM workers WHERE seen_at < ?", (time.time() - max_age,))
+            return conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+
+    # jobs left running by workers that died with the previous server are picked up again
+    def requeue_interrupted(self):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'",
+                (time.time(),),
+            )
+
+
+# progress sink handed to run_job: stores every message of the job as its current stage and
+# aborts the job once it has been cancelled through the API; the timing breakdown sent at the
+# end is not a stage, it is left to the metrics
+class _JobProgress(object):
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+
+    def put(self, message):
+        job = self.queue.get(self.job_id)
+        if job is None or job["status"] == "cancelled":
+            raise JobCancelledError(f"Job {self.job_id} was cancelled")
+        if message.get("status") == "profile":
+            return
+        self.queue.update(
+            self.job_id,
+            stage=message.get("message"),
+            progress=message.get("progress", job["progress"]),
+        )
+
+
+# sends the heartbeats of worker_id, on a thread so they go on while a job runs
+def _beat(queue, worker_id):
+    while True:
+        queue.heartbeat(worker_id)
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+# main loop of a worker process: claims queued jobs one at a time and runs fn on them, fn (or
+# its import path) is called like process_song(input_path, output_dir, send_message, archive_path=...)
+# concurrent_jobs is the number of workers running on the queue
+def run_worker(db_path, fn, timeout, poll_interval=0.5, concurrent_jobs=1):
+    queue = JobQueue(db_path)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    threading.Thread(target=_beat, args=(queue, worker_id), daemon=True).start()
+    init_worker(concurrent_jobs)
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        job_id = job["id"]
+        work_dir = job["work_dir"]
+        results_dir = os.path.join(work_dir, "samplebox")
+        status = "error"
+        try:
+            result_path = os.path.join(work_dir, f"{job_id}_samplebox.zip")
+            options = json.loads(job["options"] or "{}")
+            run_job(fn, (job["input_path"], results_dir), _JobProgress(queue, job_id), timeout,
+                    dict(options, archive_path=result_path, archive_root=results_dir))
+            queue.update(job_id, status="done", stage="Sample box generated", progress=1.0, result_path=result_path)
+            status = "done"
+        except JobCancelledError:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            status = "cancelled"
+        except Exception as e:
+            queue.update(job_id, status="error", stage="Failed", error=str(e))
+        metrics.inc("samplebox_jobs_total", status=status)
+        metrics.observe("samplebox_job_seconds", time.time() - job["created_at"])
+        metrics.flush()
+
+
+# starts workers processes running run_worker on the queue at db_path, once the jobs left
+# running by the previous ones are queued again; returns the processes
+def spawn_workers(db_path, fn, timeout, workers):
+    JobQueue(db_path).requeue_interrupted()
+    processes = []
+    for _ in range(workers):
+        # not daemonic, since the workers fork a child process per pipeline stage; the caller
+        # terminates them
+        process = multiprocessing.Process(target=run_worker, args=(db_path, fn, timeout),
+                                          kwargs={"concurrent_jobs": workers})
+        process.start()
+        processes.append(process)
+    return processes
@@ -0,0 +1,96 @@
+import numpy as np
+
+import feature_cache
+from quality import current_quality
+
+PITCHES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+KEYS = [pitch + ' major' for pitch in PITCHES] + [pitch + ' minor' for pitch in PITCHES]
+
+# Krumhansl-Schmuckler profiles of the major and minor keys, starting on the tonic
+MAJOR_PROFILE = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+MINOR_PROFILE = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+
+
+# Krumhansl-Schmuckler key finding for many chroma vectors at once: the 24 key profiles are
+# stored as one (12 x 24) matrix of standardized profiles, rotated to every tonic, so the
+# correlation of a chroma vector with every key is a single matrix product instead of 24
+# separate np.corrcoef calls; gives the same keys (and rounded correlations) as Tonal_Fragment
+# arguments:
+#     decimals: correlations are rounded to this many decimals before picking the best key,
+#               like Tonal_Fragment does, so near ties resolve to the same key
+class KeyDetector(object):
+    def __init__(self, decimals=3):
+        self.decimals = decimals
+        profiles = np.array([MAJOR_PROFILE, MINOR_PROFILE], dtype=np.float64)
+        profiles = (profiles - profiles.mean(axis=1, keepdims=True)) / profiles.std(axis=1, keepdims=True)
+        # column (tonic + 12 * mode) weighs pitch class c with the profile value of the
+        # interval between the tonic and c
+        rotation = (np.arange(12)[:, None] - np.arange(12)[None, :]) % 12
+        self.weights = np.hstack([profiles[0][rotation], profiles[1][rotation]]) / 12
+
+    # correlations of (n x 12) pitch class intensities with the 24 keys, as an (n x 24)
+    # matrix whose columns follow KEYS; silent (constant) rows correlate as nan
+    def scores(self, chroma_vals):
+        chroma_vals = np.atleast_2d(np.asarray(chroma_vals, dtype=np.float64))
+        mean = chroma_vals.mean(axis=1, keepdims=True)
+        std = chroma_vals.std(axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            standardized = (chroma_vals - mean) / std
+        return np.round(standardized @ self.weights, self.decimals)
+
+    # the key names of (n x 12) pitch class intensities, e.g. ["C# minor", "F major"]
+    def detect_batch(self, chroma_vals):
+        return [KEYS[i] for i in np.argmax(self.scores(chroma_vals), axis=1)]
+
+    # the key name of a single chroma, either 12 pitch class intensities or a whole
+    # (12 x frames) chromagram, which is summed over time first
+    def detect(self, chroma):
+        chroma = np.asarray(chroma)
+        if chroma.ndim == 2:
+            chroma = chroma.sum(axis=1)
+        return self.detect_batch(chroma[None, :])[0]
+
+    # the key names of the segments [frame_starts[i], frame_ends[i]) of a (12 x frames)
+    # chromagram, summing each segment's frames with one reduction instead of recomputing
+    # the chroma of every segment
+    def detect_segments(self, chromagram, frame_starts, frame_ends):
+        return self.detect_batch(feature_cache.segment_reduce(np.add, chromagram, frame_starts, frame_ends, axis=1).T)
+
+    # the cached chromagram of y at the current quality tier, constant-Q or STFT
+    def chromagram(self, y, sr):
+        tier = current_quality()
+        if tier.chroma == "stft":
+            return feature_cache.chroma_stft(y, sr, hop_length=tier.hop_length)
+        return feature_cache.chroma_cqt(y, sr, bins_per_octave=tier.bins_per_octave, hop_length=tier.hop_length)
+
+    # the key names of the sample ranges [starts[i], ends[i]) of y, scored from the cached
+    # chromagram of the whole of y
+    def detect_ranges(self, y, sr, starts, ends):
+        if not len(starts):
+            return []
+        chromagram = self.chromagram(y, sr)
+        hop_length = current_quality().hop_length
+        n_frames = chromagram.shape[1]
+        frame_starts = np.minimum(np.asarray(starts) // hop_length, n_frames - 1)
+        frame_ends = np.clip(np.asarray(ends) // hop_length, frame_starts + 1, n_frames)
+        return self.detect_segments(chromagram, frame_starts, frame_ends)
+
+    # the key name of a waveform, using its cached chromagram
+    def detect_audio(self, y, sr):
+        return self.detect(self.chromagram(y, sr))
+
+
+# "C# minor" -> "C#m", "F major" -> "F", the form used in file names and the chord chart
+def short_key_name(key):
+    return key.replace(" minor", "m").replace(" major", "")
+
+
+# the key n_steps semitones up (or down), in short form: transpose_key("C#m", 2) == "D#m";
+# fractional steps are rounded to the nearest semitone
+def transpose_key(key, n_steps):
+    minor = key.endswith("m")
+    tonic = key[:-1] if minor else key
+    return PITCHES[(PITCHES.index(tonic) + int(round(n_steps))) % 12] + ("m" if minor else "")
+
+
+key_detector = KeyDetector()
@@ -1,17 +1,23 @@
 import os
-import zipfile
 import uuid
 import shutil
-from fastapi import FastAPI, File, UploadFile, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
+import asyncio
 import time
 
 # Import custom modules
-from perc_splitter import process_song
-from wonky_sampler import main as wonky_sampler
+from archive import stream_archive
+from audio_output import check_format
+from quality import check_quality
+from job_api import router as jobs_router
+from job_executor import PROCESS_SONG, JobExecutor
+from metrics import metrics
+from storage import results_storage, storage
 
 app = FastAPI()
+executor = JobExecutor()
 
 # Add CORS middleware
 app.add_middleware(
@@ -22,21 +28,50 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def cleanup(path: str):
-    """Remove files and directories."""
-    time.sleep(10)
-    # if os.path.isdir(path):
-    #     shutil.rmtree(path)
-    # elif os.path.isfile(path):
-    #     os.remove(path)
+# POST /jobs, GET /jobs/{id}, GET /jobs/{id}/result and DELETE /jobs/{id}
+app.include_router(jobs_router)
 
+# the worker processes import the pipeline and warm it up while the server starts, the
+# server process itself never imports it
+@app.on_event("startup")
+def start_executor():
+    metrics.reset()
+    executor.start()
+    storage.start()
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    executor.shutdown()
+    storage.stop()
+
+# Prometheus metrics of this server and its worker processes
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# bytes and directories of the results, uploads and jobs, as of the last collection
+@app.get("/storage")
+def get_storage():
+    return storage.usage()
+
+# ?format=flac (or wav16, wav24, ogg) selects the format of the samples, ?quality=preview
+# (or standard, high) the analysis quality
 @app.post("/generate-samplebox")
-async def generate_samplebox(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def generate_samplebox(background_tasks: BackgroundTasks, file: UploadFile = File(...),
+                             output_format: str = Query(None, alias="format"), quality: str = Query(None)):
+    try:
+        output_format = check_format(output_format)
+        quality = check_quality(quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if storage.is_full():
+        raise HTTPException(status_code=503, detail="Server storage is full, try again later")
+
     # Generate a unique UUID for this upload
     upload_uuid = str(uuid.uuid4())
     
     # Create the results directory
-    results_dir1 = os.path.join("results", upload_uuid)
+    results_dir1 = results_storage.create(upload_uuid)
     results_dir = os.path.join(results_dir1, upload_uuid)
     os.makedirs(results_dir, exist_ok=True)
 
@@ -44,29 +79,33 @@ async def generate_samplebox(background_tasks: BackgroundTasks, file: UploadFile
     os.makedirs(f"{results_dir}/{filename}/stems")
     
     # Save the uploaded file
+    start = time.perf_counter()
     input_file_path = os.path.join(f"{results_dir}/{filename}/stems", file.filename)
     with open(input_file_path, "wb") as buffer:
         shutil.copyfileobj(file.file, buffer)
+    metrics.observe("samplebox_request_seconds", time.perf_counter() - start, endpoint="/generate-samplebox", phase="save")
     
-    # Process the song and generate samples
-    process_song(input_file_path, results_dir)
-    
-    # Create a zip file containing all generated samples
-    zip_path = os.path.join(results_dir, f"{upload_uuid}_samplebox.zip")
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for root, _, files in os.walk(results_dir1):
-            for file in files:
-                if file.endswith('.zip'):
-                    continue
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, results_dir1)
-                zipf.write(file_path, arcname)
+    if executor.is_full():
+        results_storage.remove(results_dir1)
+        raise HTTPException(status_code=503, detail="Server is busy, try again later")
+
+    # Process the song in a worker process, which writes the samplebox zip stage by stage;
+    # the response streams it while it grows
+    zip_path = os.path.join(results_dir1, f"{upload_uuid}_samplebox.zip")
+    job = asyncio.create_task(executor.run(PROCESS_SONG, input_file_path, results_dir, output_format=output_format,
+                                           quality=quality, archive_path=zip_path, archive_root=results_dir1))
     
-    # Schedule cleanup tasks
-    background_tasks.add_task(cleanup, results_dir)
+    # The results are deleted in the background once the response is sent, or, if the
+    # client goes away before, the results ttl after the job ended
+    job.add_done_callback(lambda _: results_storage.release(results_dir1))
+    background_tasks.add_task(results_storage.remove, results_dir1)
     
-    # Return the zip file
-    return FileResponse(zip_path, media_type="application/zip", filename=f"{upload_uuid}_samplebox.zip")
+    # Stream the zip file
+    return StreamingResponse(
+        stream_archive(zip_path, job),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{upload_uuid}_samplebox.zip"'},
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,258 @@
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# every process of a server (API, job workers) keeps its metrics in memory and writes them to
+# a file of its own in this directory after each job; /metrics merges the files, so stages
+# processed in worker processes show up in the server that serves the endpoint
+# the server empties it when it starts (see Metrics.reset), so give every server on a machine
+# a directory of its own
+METRICS_DIR = os.environ.get("SAMPLEBOX_METRICS_DIR", "metrics")
+
+# file the metrics of processes that exited are merged into, see Metrics.render
+RETIRED_FILE = "retired.json"
+
+# upper bounds (seconds) of the duration histograms
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+DESCRIPTIONS = {
+    "samplebox_stage_seconds": "Wall time of a pipeline stage or resource",
+    "samplebox_stage_cpu_seconds_total": "CPU time of a pipeline stage or resource",
+    "samplebox_stage_peak_rss_bytes": "Highest peak resident memory while a stage ran",
+    "samplebox_stage_audio_seconds_total": "Seconds of audio processed by a stage",
+    "samplebox_stage_items_total": "Files produced by a stage",
+    "samplebox_stage_runs_total": "Stage runs by status (done, cached, error)",
+    "samplebox_phase_seconds_total": "Wall time spent in a phase inside a stage",
+    "samplebox_phase_cpu_seconds_total": "CPU time spent in a phase inside a stage",
+    "samplebox_jobs_total": "Jobs by status (done, error, cancelled, rejected)",
+    "samplebox_job_seconds": "Wall time of a job, including time spent queued",
+    "samplebox_request_seconds": "Wall time of a phase of an API request",
+    "samplebox_storage_bytes": "Bytes of the working directories of a storage area",
+    "samplebox_storage_dirs": "Working directories of a storage area",
+    "samplebox_storage_evictions_total": "Working directories deleted by reason (ttl, quota)",
+}
+
+
+# counters, histograms and max gauges of one process, rendered in the Prometheus text format
+# together with those of the other processes of the server
+class Metrics(object):
+    def __init__(self, directory=METRICS_DIR):
+        self.directory = directory
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _add(self, kind, name, labels, value, merge):
+        key = (name, tuple(sorted(labels.items())), kind)
+        with self._lock:
+            self._values[key] = merge(self._values[key], value) if key in self._values else value
+
+    def inc(self, name, value=1, **labels):
+        self._add("counter", name, labels, value, lambda a, b: a + b)
+
+    # a gauge that keeps the highest value it was set to
+    def set_max(self, name, value, **labels):
+        self._add("gauge", name, labels, value, max)
+
+    # a gauge that keeps the last value it was set to
+    def set(self, name, value, **labels):
+        self._add("gauge", name, labels, value, lambda a, b: b)
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        for bound in buckets:
+            self._add("histogram", f"{name}_bucket", {**labels, "le": str(bound)}, int(value <= bound), lambda a, b: a + b)
+        self._add("histogram", f"{name}_bucket", {**labels, "le": "+Inf"}, 1, lambda a, b: a + b)
+        self._add("histogram", f"{name}_sum", labels, value, lambda a, b: a + b)
+        self._add("histogram", f"{name}_count", labels, 1, lambda a, b: a + b)
+
+    # the profile of a stage (see profile below) run on audio_seconds of audio
+    def record_stage(self, stage, profile, items=None, audio_seconds=None):
+        self.observe("samplebox_stage_seconds", profile["seconds"], stage=stage)
+        self.inc("samplebox_stage_cpu_seconds_total", profile["cpu_seconds"], stage=stage)
+        self.set_max("samplebox_stage_peak_rss_bytes", profile["peak_rss"], stage=stage)
+        self.inc("samplebox_stage_runs_total", stage=stage, status="done")
+        if items is not None:
+            self.inc("samplebox_stage_items_total", items, stage=stage)
+        if audio_seconds is not None:
+            self.inc("samplebox_stage_audio_seconds_total", audio_seconds, stage=stage)
+        for phase, (seconds, cpu_seconds) in profile.get("phases", {}).items():
+            self.inc("samplebox_phase_seconds_total", seconds, phase=phase)
+            self.inc("samplebox_phase_cpu_seconds_total", cpu_seconds, phase=phase)
+
+    # writes the metrics of this process to its file in the shared directory
+    def flush(self):
+        with self._lock:
+            values = [[name, dict(labels), kind, value] for (name, labels, kind), value in self._values.items()]
+        _write(os.path.join(self.directory, f"{os.getpid()}.json"), values)
+
+    # deletes the files left by an earlier run of the server, called when it starts (before
+    # its workers do)
+    def reset(self):
+        for file in _listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, file))
+            except FileNotFoundError:
+                continue
+
+    # the metrics of all processes of the server in the Prometheus text format; the files of
+    # processes that exited (e.g. recycled workers) are merged into RETIRED_FILE and removed,
+    # so their counts stay without the directory growing with every process
+    def render(self):
+        self.flush()
+        with self._lock:
+            retired = {}
+            retired_files = []
+            for file in _listdir(self.directory):
+                if file.endswith(".json") and file[:-len(".json")].isdigit() and not _is_alive(int(file[:-len(".json")])):
+                    _merge(retired, _read(os.path.join(self.directory, file)))
+                    retired_files.append(file)
+            if retired_files:
+                _merge(retired, _read(os.path.join(self.directory, RETIRED_FILE)))
+                _write(os.path.join(self.directory, RETIRED_FILE),
+                       [[name, dict(labels), kind, value] for (name, labels, kind), value in retired.items()])
+                for file in retired_files:
+                    os.remove(os.path.join(self.directory, file))
+
+        merged = {}
+        for file in sorted(_listdir(self.directory)):
+            if file.endswith(".json"):
+                _merge(merged, _read(os.path.join(self.directory, file)))
+
+        lines = []
+        described = set()
+        for (name, labels, kind), value in sorted(merged.items(), key=_sort_key):
+            family = _family(name, kind)
+            if family not in described:
+                described.add(family)
+                lines.append(f"# HELP {family} {DESCRIPTIONS.get(family, family)}")
+                lines.append(f"# TYPE {family} {kind}")
+            label_text = ",".join(f'{label}="{_escape(label_value)}"' for label, label_value in labels)
+            lines.append(f"{name}{{{label_text}}} {value!r}" if label_text else f"{name} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+# adds the values of a metrics file to merged: counters and histograms add up, gauges keep
+# the highest value
+def _merge(merged, values):
+    for name, labels, kind, value in values:
+        key = (name, tuple(sorted(labels.items())), kind)
+        if key not in merged:
+            merged[key] = value
+        else:
+            merged[key] = max(merged[key], value) if kind == "gauge" else merged[key] + value
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _write(path, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        json.dump(values, f)
+    os.replace(f.name, path)
+
+
+def _listdir(directory):
+    try:
+        return os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _family(name, kind):
+    if kind == "histogram":
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+    return name
+
+
+# families together, histogram buckets in increasing order
+def _sort_key(item):
+    (name, labels, kind), _ = item
+    bound = dict(labels).get("le")
+    bound = float(bound) if bound is not None else 0.0
+    return _family(name, kind), [label for label in labels if label[0] != "le"], name, bound
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+metrics = Metrics()
+
+
+# peak resident memory of this process in bytes since the last reset_peak_rss, or over the
+# whole life of the process where the peak cannot be reset
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+# restarts the peak of peak_rss at the current resident memory (Linux only), so the peak of a
+# stage is not the one of the parent it was forked from, or of the stages run before it
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+# wall and CPU seconds spent in each phase of the current stage in this process
+_phases = {}
+
+
+# measures a named phase of a stage (e.g. the bar analysis of the wonky sampler); phases
+# are reported with the profile of the stage they ran in
+@contextmanager
+def phase(name):
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        seconds, cpu_seconds = _phases.get(name, (0.0, 0.0))
+        _phases[name] = (seconds + time.perf_counter() - start, cpu_seconds + time.process_time() - cpu_start)
+
+
+# runs fn and returns its profile: wall and CPU seconds, peak RSS while it ran (see
+# reset_peak_rss) and the phases measured while it ran
+def profile(fn):
+    _phases.clear()
+    reset_peak_rss()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    fn()
+    result = {
+        "seconds": time.perf_counter() - start,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "peak_rss": peak_rss(),
+        "phases": dict(_phases),
+    }
+    _phases.clear()
+    return result
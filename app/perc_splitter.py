@@ -1,270 +1,544 @@
+import asyncio
 import librosa
-import soundfile as sf
 import numpy as np
 import os
-from Tonal_Fragment import Tonal_Fragment
+from key_detector import key_detector, short_key_name
 import random
-from scipy.stats import skew
 from scipy.signal import butter, filtfilt
 from wonky_sampler import main as wonky_sampler
-import json
+from song_context import SongContext, get_beat_grid, load_audio
+import feature_cache
+from result_cache import list_files, result_cache
+from archive import StreamingZipWriter
+import hashlib
+import shutil
+import tempfile
+from stage_graph import StageGraph, report
+from sample_metadata import SampleMetadata, sample_listener
+from audio_output import SampleWriter, current_format, use_output_format
+from quality import current_quality, use_quality
+from stem_separator import SEPARATOR_MODEL
+from metrics import metrics
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 def get_key_of_sample(sample, sr):
-    tonal_fragment = Tonal_Fragment(sample, sr)
-    return tonal_fragment.key.replace(" minor", "m").replace(" major", "")
+    return short_key_name(key_detector.detect_audio(sample, sr))
 
-def load_and_analyze(file_path):
-    y, sr = librosa.load(file_path)
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
+def load_and_analyze(source):
+    y, sr = load_audio(source)
+    tempo, beat_frames = feature_cache.beat_track(y, sr)
     return y, sr, tempo, beat_frames
 
-def extract_drum_hits(drum_stem_path, output_path, amplitude_threshold=0.1, max_samples_per_category=5):
-    y, sr = librosa.load(drum_stem_path)
+# index of the first frame in [starts[i], stops[i]) where values drops below thresholds[i],
+# or -1, for all i at once; searches windows of growing size so that hits ending early
+# (most of them) are resolved without materializing long frame ranges
+def first_frame_below(values, starts, stops, thresholds, window=32):
+    found = np.full(len(starts), -1)
+    pending = np.arange(len(starts))
+    offset = 0
+    while pending.size:
+        lo = starts[pending] + offset
+        width = np.minimum(stops[pending] - lo, window)
+        active = width > 0
+        pending, lo, width = pending[active], lo[active], width[active]
+        if not pending.size:
+            break
+        steps = np.arange(window)
+        frames = np.minimum(lo[:, None] + steps, len(values) - 1)
+        below = (steps < width[:, None]) & (values[frames] < thresholds[pending, None])
+        resolved = below.any(axis=1)
+        found[pending[resolved]] = lo[resolved] + below[resolved].argmax(axis=1)
+        pending = pending[~resolved]
+        offset += window
+        window *= 2
+    return found
+
+# batched per-hit spectral centroid, rolloff and zero crossing rate, each averaged over the
+# frames of the hit; equal to running librosa.feature.* on y[starts[i]:ends[i]] one by one,
+# but framing all hits into one buffer so the FFTs run over a few large frame matrices
+def hit_features(y, sr, starts, ends, n_fft=2048, hop_length=512, chunk_frames=2048):
+    lengths = ends - starts
+    pad = n_fft // 2
+    frame_counts = 1 + lengths // hop_length
+    # every hit is laid out padded by n_fft // 2 on both sides, like librosa centers frames
+    offsets = np.concatenate([[0], np.cumsum(lengths + 2 * pad)])
+    buffer = np.zeros(offsets[-1], dtype=y.dtype)
+    edge_buffer = np.empty_like(buffer)
+    for i in range(len(starts)):
+        hit = y[starts[i]:ends[i]]
+        buffer[offsets[i] + pad:offsets[i + 1] - pad] = hit
+        edge_buffer[offsets[i]:offsets[i + 1]] = np.pad(hit, pad, mode="edge")
+    
+    hit_index = np.repeat(np.arange(len(starts)), frame_counts)
+    frame_index = np.arange(len(hit_index)) - np.repeat(np.cumsum(frame_counts) - frame_counts, frame_counts)
+    frame_starts = offsets[hit_index] + frame_index * hop_length
+    
+    window = librosa.filters.get_window("hann", n_fft, fftbins=True)
+    frames = np.lib.stride_tricks.sliding_window_view(buffer, n_fft)
+    centroid = np.empty(len(frame_starts))
+    rolloff = np.empty(len(frame_starts))
+    for lo in range(0, len(frame_starts), chunk_frames):
+        chunk = frame_starts[lo:lo + chunk_frames]
+        S = np.abs(np.fft.rfft(frames[chunk] * window, axis=1)).T
+        centroid[lo:lo + chunk_frames] = librosa.feature.spectral_centroid(S=S, sr=sr, n_fft=n_fft)[0]
+        rolloff[lo:lo + chunk_frames] = librosa.feature.spectral_rolloff(S=S, sr=sr, n_fft=n_fft)[0]
+    
+    # zero crossings inside each frame, counted from a running sum over the whole buffer
+    signs = np.signbit(np.where(np.abs(edge_buffer) <= 1e-10, 0, edge_buffer))
+    crossings = np.concatenate([[0], np.cumsum(signs[1:] != signs[:-1])])
+    zcr = (crossings[frame_starts + n_fft - 1] - crossings[frame_starts]) / n_fft
+    
+    frame_offsets = np.cumsum(frame_counts) - frame_counts
+    return [np.add.reduceat(feature, frame_offsets) / frame_counts for feature in (centroid, rolloff, zcr)]
+
+def extract_drum_hits(drum_stem, output_path, amplitude_threshold=0.1, max_samples_per_category=5):
+    y, sr = load_audio(drum_stem)
+    hop_length = 512
     
     # Compute RMS energy
-    rms = librosa.feature.rms(y=y)[0]
+    rms = feature_cache.rms(y, hop_length=hop_length)[0]
     rms_normalized = (rms - np.min(rms)) / (np.max(rms) - np.min(rms))
     
     # Detect onsets
-    onset_frames = librosa.onset.onset_detect(y=y, sr=sr, wait=1, pre_avg=1, post_avg=1, pre_max=1, post_max=1)
-    onset_samples = librosa.frames_to_samples(onset_frames)
+    onset_frames = feature_cache.onset_detect(y, sr, hop_length=hop_length, wait=1, pre_avg=1, post_avg=1, pre_max=1, post_max=1)
+    onset_samples = librosa.frames_to_samples(onset_frames, hop_length=hop_length)
+    
+    # Each hit runs from its onset to the next onset (or the end of the stem), cut short at
+    # the first frame whose energy drops below half the energy at the onset
+    next_onsets = np.append(onset_samples[1:], len(y))
+    keep = rms_normalized[onset_samples // hop_length] >= amplitude_threshold
+    starts = onset_samples[keep]
+    ends = next_onsets[keep]
+    
+    frame_starts = starts // hop_length
+    decay_frames = first_frame_below(rms, frame_starts, ends // hop_length, 0.5 * rms[frame_starts])
+    ends = np.where(decay_frames >= 0, decay_frames * hop_length, ends)
+    ends = np.minimum(np.maximum(ends, starts + int(sr * 0.05)), len(y))
     
-    def classify_drum_hit(hit):
-        # Extract features
-        spectral_centroid = librosa.feature.spectral_centroid(y=hit, sr=sr)[0]
-        spectral_rolloff = librosa.feature.spectral_rolloff(y=hit, sr=sr)[0]
-        zero_crossing_rate = librosa.feature.zero_crossing_rate(hit)[0]
-        
-        # Simple classification based on spectral and temporal features
-        if np.mean(spectral_centroid) < 500 and np.mean(spectral_rolloff) < 2000:
-            return "kick"
-        elif np.mean(spectral_centroid) > 3000 and np.mean(zero_crossing_rate) > 0.1:
-            return "hi_hat"
-        elif np.mean(spectral_centroid) > 1000 and np.mean(spectral_centroid) < 3000 and skew(hit) > 0:
-            return "snare"
-        else:
-            return "other"
-
-    def get_low_frequency_amplitude(hit):
-        # Design a low-pass Butterworth filter
-        nyquist = 0.5 * sr
-        cutoff = 200 / nyquist
-        b, a = butter(4, cutoff, btype='low', analog=False)
-        
-        # Apply the filter
-        low_freq_hit = filtfilt(b, a, hit)
-        return np.max(np.abs(low_freq_hit))
-
     hits = {"kick": [], "snare": [], "hi_hat": [], "other": []}
     
-    for i, start in enumerate(onset_samples):
-        start_frame = librosa.samples_to_frames(start)
-        if rms_normalized[start_frame] < amplitude_threshold:
-            continue
+    if len(starts):
+        # Every hit is faded out over its last 10 ms in place, in onset order, and classified
+        # as it is right after its own fade; a hit running past the next onset thus also
+        # fades the start of the next one. The faded hits are laid out one after the other
+        # in hits_y, hit i at [hit_starts[i], hit_ends[i])
+        y = y.copy()
+        fade_lengths = np.minimum(int(sr * 0.01), ends - starts)
+        faded = []
+        for start, end, fade_length in zip(starts, ends, fade_lengths):
+            y[end - fade_length:end] *= np.linspace(1.0, 0.0, fade_length)
+            faded.append(y[start:end].copy())
+        hits_y = np.concatenate(faded)
+        hit_ends = np.cumsum(ends - starts)
+        hit_starts = hit_ends - (ends - starts)
         
-        if i < len(onset_samples) - 1:
-            end = onset_samples[i+1]
-        else:
-            end = len(y)
-        
-        frame_start = librosa.samples_to_frames(start)
-        frame_end = librosa.samples_to_frames(end)
-        energy_threshold = 0.5 * rms[frame_start]
-        
-        for frame in range(frame_start, frame_end):
-            if rms[frame] < energy_threshold:
-                end = librosa.frames_to_samples(frame)
-                break
-        
-        hit = y[start:end]
+        # Extract spectral features for all hits with one batched STFT, framing every hit on
+        # its own (zero padded like librosa does) so the features match those of the hit
+        # taken in isolation rather than bleeding into the next one
+        spectral_centroid, spectral_rolloff, zero_crossing_rate = hit_features(hits_y, sr, hit_starts, hit_ends,
+                                                                               hop_length=hop_length)
         
-        if len(hit) < int(sr * 0.05):
-            end = start + int(sr * 0.05)
-            hit = y[start:end]
+        # skew of each hit from its raw moments, as scipy.stats.skew computes it
+        y64 = hits_y.astype(np.float64)
+        n = hit_ends - hit_starts
+        mean = feature_cache.segment_reduce(np.add, y64, hit_starts, hit_ends) / n
+        m2 = feature_cache.segment_reduce(np.add, y64 ** 2, hit_starts, hit_ends) / n - mean ** 2
+        m3 = feature_cache.segment_reduce(np.add, y64 ** 3, hit_starts, hit_ends) / n - 3 * mean * (m2 + mean ** 2) + 2 * mean ** 3
+        with np.errstate(divide="ignore", invalid="ignore"):
+            skewness = np.where(m2 > 0, m3 / np.maximum(m2, 1e-30) ** 1.5, 0.0)
         
-        fade_length = min(int(sr * 0.01), len(hit))
-        fade_out = np.linspace(1.0, 0.0, fade_length)
-        hit[-fade_length:] *= fade_out
+        # Simple classification based on spectral and temporal features; the zero crossing
+        # threshold is per sample at 22050 Hz, scaled so songs decoded at other rates (see
+        # quality.py) classify alike
+        drum_types = np.select(
+            [
+                (spectral_centroid < 500) & (spectral_rolloff < 2000),
+                (spectral_centroid > 3000) & (zero_crossing_rate > 0.1 * 22050 / sr),
+                (spectral_centroid > 1000) & (spectral_centroid < 3000) & (skewness > 0),
+            ],
+            ["kick", "hi_hat", "snare"],
+            default="other",
+        )
         
-        # Classify the drum hit
-        drum_type = classify_drum_hit(hit)
+        # Rank kicks by the amplitude of their low-pass filtered hit, everything else by
+        # regular amplitude; the Butterworth filter is designed once
+        amplitudes = feature_cache.segment_reduce(np.maximum, np.abs(hits_y), hit_starts, hit_ends).astype(np.float64)
+        kicks = np.flatnonzero(drum_types == "kick")
+        if len(kicks):
+            nyquist = 0.5 * sr
+            b, a = butter(4, 200 / nyquist, btype='low', analog=False)
+            amplitudes[kicks] = [np.max(np.abs(filtfilt(b, a, faded[i]))) for i in kicks]
         
-        # Store hit along with its low frequency amplitude for kicks, regular amplitude for harmonicss
-        if drum_type == "kick":
-            hits[drum_type].append((hit, get_low_frequency_amplitude(hit)))
-        else:
-            hits[drum_type].append((hit, np.max(np.abs(hit))))
-    
-    # Sort and filter hits
-    for drum_type in hits:
-        if len(hits[drum_type]) > max_samples_per_category:
-            hits[drum_type].sort(key=lambda x: x[1], reverse=True)
-            hits[drum_type] = hits[drum_type][:max_samples_per_category]
+        # Sort and filter hits; the hits kept are cut out once every fade was applied, later
+        # fades included
+        for drum_type in hits:
+            selected = np.flatnonzero(drum_types == drum_type)
+            if len(selected) > max_samples_per_category:
+                order = np.argsort(-amplitudes[selected], kind="stable")
+                selected = selected[order[:max_samples_per_category]]
+            for i in selected:
+                hits[drum_type].append((y[starts[i]:ends[i]].copy(), amplitudes[i]))
     
     # Save hits for each category
     os.makedirs(output_path, exist_ok=True)
-    for drum_type, samples in hits.items():
-        for i, (hit, _) in enumerate(samples, 1):
-            sf.write(f"{output_path}/{drum_type}_{i}.wav", hit, sr)
+    with SampleWriter() as writer:
+        for drum_type, samples in hits.items():
+            for i, (hit, _) in enumerate(samples, 1):
+                writer.write(f"{output_path}/{drum_type}_{i}.wav", hit, sr)
     
-    print(f"Extracted drum hits to {output_path}:")
-    for drum_type, samples in hits.items():
-        print(f"  {drum_type}: {len(samples)}")
+    logger.info("Extracted drum hits to %s: %s", output_path,
+                ", ".join(f"{drum_type} {len(samples)}" for drum_type, samples in hits.items()))
+    return hits
 
 
-def extract_harmonic_samples(harmonics_stem_path, output_path, amplitude_threshold=-100, max_samples=18, creative_mode=True):
-    y, sr = librosa.load(harmonics_stem_path)
+def extract_harmonic_samples(harmonics_stem, output_path, amplitude_threshold=-100, max_samples=18, creative_mode=True):
+    y, sr = load_audio(harmonics_stem)
    
-    # Estimate tempo and beat frames
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-    beat_samples = librosa.frames_to_samples(beat_frames)
+    # Samples of 8 bars (assuming 4/4 time signature) as (start, end) ranges of the stem,
+    # cut from the beat grid of the song, with the RMS of each
+    bar_starts, bar_ends = get_beat_grid(harmonics_stem, y, sr).bars(8)
+    if len(bar_starts):
+        bar_rms = np.sqrt(feature_cache.segment_reduce(np.add, np.square(y, dtype=np.float64), bar_starts, bar_ends) / (bar_ends - bar_starts))
+    else:
+        bar_rms = np.empty(0)
+    logger.debug("sample_rms: %s", bar_rms)
    
-    # Calculate samples per bar (assuming 4/4 time signature)
-    samples_per_bar = 32 * (beat_samples[1] - beat_samples[0])
-   
-    # Extract one-bar samples
-    samples = []
-    for i in range(0, len(y) - samples_per_bar, samples_per_bar):
-        sample = y[i:i+samples_per_bar]
-        sample_rms = np.sqrt(np.mean(sample**2))
-        print("sample_rms: ", sample_rms)
-        if sample_rms >= amplitude_threshold:
-            sample = np.tile(sample, 2)
-            samples.append((sample, i/sr, sample_rms))
+    # Sort samples by RMS amplitude and keep only the top max_samples, the audio of the kept
+    # ones is only cut out (and tiled) here
+    kept = np.flatnonzero(bar_rms >= amplitude_threshold)
+    kept = kept[np.argsort(-bar_rms[kept], kind="stable")][:max_samples]
+    # the key of every kept sample comes from one chromagram of the stem
+    keys = key_detector.detect_ranges(y, sr, bar_starts[kept], bar_ends[kept])
+    samples = [(np.tile(y[bar_starts[i]:bar_ends[i]], 2), bar_starts[i]/sr, SampleMetadata(0, short_key_name(key)))
+               for i, key in zip(kept, keys)]
    
-    # Sort samples by RMS amplitude and keep only the top max_samples
-    samples.sort(key=lambda x: x[2], reverse=True)
-    samples = samples[:max_samples]
-   
-    # Creative processing function
-    def creative_process(sample):
+    # Creative processing function, also returns the metadata updated for the transforms
+    tier = current_quality()
+    def creative_process(sample, metadata):
         if np.random.random() < 0.27:  # 35% chance of reverse
             sample = sample[::-1]
         if np.random.random() < 0.35:  # 20% chance of pitch shift
-            sample = librosa.effects.pitch_shift(sample, sr=sr, n_steps=np.random.randint(-6, 5))
+            n_steps = np.random.randint(-6, 5)
+            sample = librosa.effects.pitch_shift(sample, sr=sr, n_steps=n_steps, n_fft=tier.n_fft, res_type=tier.res_type)
+            metadata = metadata.pitch_shifted(n_steps)
         if np.random.random() < 0.05:  # 5% chance of time stretch
-            sample = librosa.effects.time_stretch(sample, rate=np.random.uniform(0.8, 1.2))
-        return sample
+            sample = librosa.effects.time_stretch(sample, rate=np.random.uniform(0.8, 1.2), n_fft=tier.n_fft)
+        return sample, metadata
    
     # Save samples
     os.makedirs(output_path, exist_ok=True)
-    for i, (sample, start_time, _) in enumerate(samples):
-        if creative_mode:
-            sample = creative_process(sample)
-       
-        key = get_key_of_sample(sample, sr)
-        # print("tempo_melodic:", np.around(list(tempo)[0], decimals=0))
-        filename = f"{str(key).replace("#","-sharp")}.wav".replace("sharpm", "sharp-m")
-        sf.write(os.path.join(output_path, filename), sample, sr)
+    with SampleWriter() as writer:
+        for i, (sample, start_time, metadata) in enumerate(samples):
+            if creative_mode:
+                sample, metadata = creative_process(sample, metadata)
+           
+            metadata.verify(sample, sr, f"harmonic sample {i}")
+            key = metadata.key
+            # print("tempo_melodic:", np.around(list(tempo)[0], decimals=0))
+            filename = f"{str(key).replace("#","-sharp")}.wav".replace("sharpm", "sharp-m")
+            writer.write(os.path.join(output_path, filename), sample, sr, metadata)
    
-    print(f"Extracted {len(samples)} one-bar melodic samples to {output_path}")
+    logger.info("Extracted %d one-bar melodic samples to %s", len(samples), output_path)
 
 
-def create_percussive_loops_from_original(percs_file, output_dir, num_loops=5, bars_per_loop=2):
+def create_percussive_loops_from_original(percs, output_dir, num_loops=5, bars_per_loop=2):
     # Load the drum stem
-    y, sr = librosa.load(percs_file)
-    
-    # Estimate tempo and beat frames
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-    beat_samples = librosa.frames_to_samples(beat_frames)
+    y, sr = load_audio(percs)
     
-    # Calculate samples per bar (assuming 4/4 time signature)
-    samples_per_bar = 8 * (beat_samples[1] - beat_samples[0])
-    
-    # Extract bar-length segments
-    bar_segments = []
-    for i in range(0, len(y) - samples_per_bar, samples_per_bar):
-        bar_segments.append(y[i:i+samples_per_bar])
+    # Segments of 2 bars (assuming 4/4 time signature), as the start of each in the stem,
+    # cut from the beat grid of the song
+    beat_grid = get_beat_grid(percs, y, sr)
+    bar_starts, bar_ends = beat_grid.bars(2)
+    samples_per_bar = bar_ends[0] - bar_starts[0] if len(bar_starts) else 0
     
     # Create loops
-    if len(bar_segments) < 4:
-        print(f"Cannot generate drum loops from {percs_file}")
-        print(len(bar_segments))
+    tier = current_quality()
+    if len(bar_starts) < 4:
+        logger.warning("Cannot generate drum loops from %s, only %d bars", percs, len(bar_starts))
         return
-    for i in range(num_loops):
-        # Randomly select consecutive bars
-        start_bar = random.randint(0, len(bar_segments) - bars_per_loop)
-        loop = np.concatenate(bar_segments[start_bar:start_bar + bars_per_loop])
-        
-        # Apply some subtle variations
-        if random.random() < 0.1:
-            # Slight tempo variation
-            loop = librosa.effects.time_stretch(loop, rate=random.uniform(0.98, 1.02))
-        
-        if random.random() < 0.2:
-            # Subtle pitch variation
-            loop = librosa.effects.pitch_shift(loop, sr=sr, n_steps=random.uniform(-0.5, 0.5))
-        
-        # Normalize the loop
-        loop = loop / np.max(np.abs(loop))
-        try:
-            tempo, _ = librosa.beat.beat_track(y=loop, sr=sr)
-            print("tempo:", np.int32(list(tempo)[0]))
-            tempo = np.int32(list(tempo)[0])
-        except:
-            tempo = "unknown"
-        # Save the loop
-        filename = f"{tempo}_{i}.wav"
-        sf.write(os.path.join(output_dir, filename), loop, sr)
+    with SampleWriter() as writer:
+        for i in range(num_loops):
+            # Randomly select consecutive bars
+            start_bar = random.randint(0, len(bar_starts) - bars_per_loop)
+            # consecutive bars are one range of the stem, a view until the loop gets processed
+            loop = y[bar_starts[start_bar]:bar_starts[start_bar] + bars_per_loop * samples_per_bar]
+            metadata = SampleMetadata(beat_grid.tempo)
+            
+            # Apply some subtle variations
+            if random.random() < 0.1:
+                # Slight tempo variation
+                rate = random.uniform(0.98, 1.02)
+                loop = librosa.effects.time_stretch(loop, rate=rate, n_fft=tier.n_fft)
+                metadata = metadata.time_stretched(rate)
+            
+            if random.random() < 0.2:
+                # Subtle pitch variation
+                loop = librosa.effects.pitch_shift(loop, sr=sr, n_steps=random.uniform(-0.5, 0.5), n_fft=tier.n_fft,
+                                                   res_type=tier.res_type)
+            
+            # Normalize the loop
+            loop = loop / np.max(np.abs(loop))
+            # The tempo of the loop is the song tempo, carried through the stretch
+            metadata.verify(loop, sr, f"percussion loop {i}")
+            tempo = metadata.bpm
+            logger.debug("tempo: %s", tempo)
+            # Save the loop
+            filename = f"{tempo}_{i}.wav"
+            writer.write(os.path.join(output_dir, filename), loop, sr, metadata)
     
-    print(f"Created {num_loops} drum loops in {output_dir}")
+    logger.info("Created %d drum loops in %s", num_loops, output_dir)
 
-async def process_song(input_file, output_dir, send_message):
+# parameters of every stage of process_song, part of the result cache key of that stage so
+# changing one of them only reruns the stage it belongs to; bump PIPELINE_VERSION when the
+# code of a stage changes its output
+PIPELINE_VERSION = 6
+PIPELINE_CONFIG = {
+    "stems": {"model": SEPARATOR_MODEL},
+    "percussions": {"num_loops": 5, "bars_per_loop": 2},
+    "drums": {"amplitude_threshold": 0.1, "max_samples_per_category": 5},
+    "harmonic stuff": {"amplitude_threshold": -100, "max_samples": 18, "creative_mode": True},
+    "wonky original": {},
+    "wonky harmonics": {},
+}
+
+# seeds random and np.random for one stage, so a stage's output only depends on the seed
+# and not on which other stages ran (or were restored from the cache) before it
+def seed_stage(seed, name):
+    stage_seed = int(hashlib.sha256(f"{seed}:{name}".encode()).hexdigest()[:8], 16)
+    random.seed(stage_seed)
+    np.random.seed(stage_seed)
+
+# the output format of the samples and the quality tier are the ones set for the running
+# job (see process_song)
+def stage_cache_key(song, name, seed):
+    return result_cache.key("stage", PIPELINE_VERSION, song.content_hash, song.sr, name, PIPELINE_CONFIG[name], seed,
+                            current_format(), current_quality().as_dict())
+
+# samples a stage wrote, as {"name": path in the stage folder, "bpm": ..., "key": ...}
+def stage_samples_key(song, name, seed):
+    return result_cache.key("samples", stage_cache_key(song, name, seed))
+
+# runs a stage into its own scratch directory and stores the files it wrote in the result
+# cache, along with the list of its samples; called in the child process the stage graph
+# forks for the stage
+# with stream_samples every sample is reported to the graph, audio included, as soon as the
+# stage has written it
+def run_stage(song, name, scratch_dir, seed, run, stream_samples=False):
+    seed_stage(seed, name)
+    samples = []
+
+    def on_sample(path, metadata):
+        sample = {"name": os.path.relpath(path, scratch_dir), "bpm": None, "key": None}
+        if metadata is not None:
+            sample.update(metadata.as_dict())
+        samples.append(sample)
+        if stream_samples:
+            with open(path, "rb") as f:
+                report(dict(sample, audio=f.read()))
+
+    with sample_listener(on_sample):
+        run(scratch_dir)
+    result_cache.store_tree(stage_cache_key(song, name, seed), scratch_dir)
+    result_cache.put_json(stage_samples_key(song, name, seed), samples)
+
+# samples of a stage restored from the cache, read from its folder; files of stages cached
+# before their samples were recorded come without metadata
+def cached_samples(song, name, seed, stage_dir):
+    samples = result_cache.get_json(stage_samples_key(song, name, seed))
+    if samples is None:
+        entry_dir = result_cache.get(stage_cache_key(song, name, seed))
+        samples = [{"name": path, "bpm": None, "key": None} for path in sorted(list_files(entry_dir or stage_dir))]
+    for sample in samples:
+        try:
+            with open(os.path.join(stage_dir, sample["name"]), "rb") as f:
+                yield dict(sample, audio=f.read())
+        except FileNotFoundError:
+            continue
+
+# moves the output of a finished stage into its folder of the samplebox and adds its files to
+# the archive; returns the number of files the stage produced
+def publish_stage(scratch_dir, stage_dir, archive=None):
+    paths = list_files(scratch_dir)
+    for path in paths:
+        os.makedirs(os.path.dirname(os.path.join(stage_dir, path)), exist_ok=True)
+        os.replace(os.path.join(scratch_dir, path), os.path.join(stage_dir, path))
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    if archive is not None:
+        archive.add_files(stage_dir, paths)
+    return len(paths)
+
+def write_stems(song, stems_dir, model="hpss"):
+    with SampleWriter() as writer:
+        for name, stem in (("harmonics", song.harmonic), ("percs", song.percussive)):
+            writer.write_stream(os.path.join(stems_dir, f"{name}.wav"), stem.y, song.sr)
+        if model != "hpss":
+            for name, stem in song.model_stems(model).items():
+                writer.write_stream(os.path.join(stems_dir, f"{name}.wav"), stem.y, song.sr)
+    logger.info("Extracted harmonic and percussive components")
+    if model != "hpss":
+        logger.info("Extracted %s stems", model)
+
+# when archive_path is given, the samplebox zip is written there while the stages run (paths
+# relative to archive_root, output_dir by default), so it can be streamed before the end
+# the last message sent is {"status": "profile", "profile": ...} with the timing breakdown of
+# the job (see job_profile), which callers may pass on or drop
+# decoded_file and content_hash are passed on to SongContext.from_file, for uploads that were
+# decoded and hashed while they arrived
+# with stream_samples, every sample file is also sent as soon as its stage wrote it, as
+# {"status": "sample", "stage": ..., "category": samplebox folder, "name": path in the folder,
+# "bpm": ..., "key": ..., "audio": bytes of the file}; samples of cached stages are sent when
+# the stage is restored
+# output_format is the format every sample is written in, see audio_output.OUTPUT_FORMATS
+# quality is the tier the song is analysed at, see quality.QUALITY_TIERS; "preview" gives a
+# rough samplebox in a fraction of the time of "standard"
+async def process_song(input_file, output_dir, send_message, seed=0, archive_path=None, archive_root=None,
+                       decoded_file=None, content_hash=None, stream_samples=False, output_format=None, quality=None):
+    archive = None
+    if archive_path is not None:
+        archive = StreamingZipWriter(archive_path, archive_root or output_dir)
+    try:
+        with use_output_format(output_format), use_quality(quality):
+            return await _process_song(input_file, output_dir, send_message, seed, archive, decoded_file, content_hash,
+                                       stream_samples)
+    finally:
+        if archive is not None:
+            archive.close()
+        metrics.flush()
+        # the analyses of this song are of no use to the next job of the worker
+        feature_cache.feature_cache.clear()
+
+# sends the (stage, sample) pairs queued by _process_song as sample messages, until None
+async def forward_samples(samples, folders, send_message):
+    while True:
+        item = await samples.get()
+        if item is None:
+            return
+        name, sample = item
+        await send_message(dict(sample, status="sample", stage=name, category=folders[name]))
+
+# per-job timing breakdown: wall seconds of the job, and the profile of every stage that ran
+# (restored stages are listed as cached) and of every resource that had to be computed
+def job_profile(graph, stages, items, seconds, audio_seconds):
+    stage_profiles = {}
+    for name, _, _, _, _, _ in stages:
+        if name in items:
+            stage_profiles[name] = dict(graph.profiles[name], items=items[name], audio_seconds=audio_seconds)
+        else:
+            stage_profiles[name] = {"cached": True}
+    resources = {name: stage_profile for name, stage_profile in graph.profiles.items() if name not in stage_profiles}
+    return {"seconds": seconds, "stages": stage_profiles, "resources": resources}
+
+async def _process_song(input_file, output_dir, send_message, seed, archive, decoded_file=None, content_hash=None,
+                        stream_samples=False):
+    start = time.perf_counter()
     # Create results directory
     filename = os.path.basename(input_file).replace(".wav", "").replace(".mp3", "")
     results_dir = os.path.join(output_dir, filename)
     os.makedirs(results_dir, exist_ok=True)
 
-    # Load the audio file
-    y, sr = librosa.load(input_file)
-    
-    # Get the song key
-    song_key = get_key_of_sample(y, sr)
-    print(f"Song key: {song_key}")
-
-    await send_message(json.dumps({"status": "processing", "message": "Extracting stems ..."}))
+    # Decode the audio file once (and only if some stage is not cached), every stage below
+    # works from this context
+    song = SongContext.from_file(input_file, decoded_path=decoded_file, content_hash=content_hash)
 
-    # Separate harmonic and percussive components
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
-    stems_dir = os.path.join(results_dir, "stems")
-    os.makedirs(stems_dir, exist_ok=True)
-
-    sf.write(os.path.join(stems_dir, "harmonics.wav"), y_harmonic, sr)
-    sf.write(os.path.join(stems_dir, "percs.wav"), y_percussive, sr)
-    print("Extracted harmonic and percussive components")
-
-    await send_message(json.dumps({"status": "processing", "message": "Creating percussion loops ..."}))
-    # Create drum loops
-    percussive_loops_dir = os.path.join(results_dir, "percussions")
-    os.makedirs(percussive_loops_dir, exist_ok=True)
+    # Samples reported by running stages are queued by the graph and sent on from here
+    samples = asyncio.Queue()
 
-    percs_file = os.path.join(stems_dir, "percs.wav")
-    create_percussive_loops_from_original(percs_file, percussive_loops_dir)
+    # Everything the stages read is computed once, in this process, and only when a stage
+    # that is not cached needs it
+    graph = StageGraph(on_report=lambda name, sample: samples.put_nowait((name, sample)))
+    graph.add_resource("waveform", lambda: song.y)
+    graph.add_resource("key", lambda: song.key, inputs=("waveform",))
+    graph.add_resource("harmonic", lambda: song.harmonic, inputs=("waveform",))
+    graph.add_resource("percussive", lambda: song.percussive, inputs=("waveform",))
+    graph.add_resource("beats", lambda: song.beat_grid, inputs=("waveform",))
+    # separated by the warm separators of this worker process, so never in a stage child
+    stem_model = PIPELINE_CONFIG["stems"]["model"]
+    graph.add_resource("model stems", lambda: song.model_stems(stem_model) if stem_model != "hpss" else None, inputs=("waveform",))
 
-    await send_message({"status": "processing", "message": "Extracting drum hits ..."})
-    # Extract drum hits
-    drum_dir = os.path.join(results_dir, "drums")
-    os.makedirs(drum_dir, exist_ok=True)
-    extract_drum_hits(os.path.join(stems_dir, "percs.wav"), drum_dir, amplitude_threshold=0.1)
+    # name, samplebox folder, progress message, progress, inputs, stage
+    # both wonky stages write to the same folder, their files are told apart by a prefix
+    stages = [
+        ("stems", "stems", "Extracting stems ...", 0.1, ("harmonic", "percussive", "model stems"),
+         lambda out: write_stems(song, out, stem_model)),
+        ("percussions", "percussions", "Creating percussion loops ...", 0.3, ("percussive", "beats"),
+         lambda out: create_percussive_loops_from_original(song.percussive, out, **PIPELINE_CONFIG["percussions"])),
+        ("drums", "drums", "Extracting drum hits ...", 0.45, ("percussive",),
+         lambda out: extract_drum_hits(song.percussive, out, **PIPELINE_CONFIG["drums"])),
+        ("harmonic stuff", "harmonic stuff", "Getting harmonic loops ...", 0.55, ("harmonic", "beats"),
+         lambda out: extract_harmonic_samples(song.harmonic, out, **PIPELINE_CONFIG["harmonic stuff"])),
+        ("wonky original", "wonky stuff", "Generating wonky loops from original audio ...", 0.65, ("waveform", "key", "beats"),
+         lambda out: wonky_sampler(song, out, song_key=song.key, name_prefix="original_")),
+        ("wonky harmonics", "wonky stuff", "Generating wonky loops from harmonics ... (this gon take a min)", 0.8, ("harmonic", "key", "beats"),
+         lambda out: wonky_sampler(song.harmonic, out, song_key=song.key, name_prefix="harmonics_")),
+    ]
 
-    await send_message({"status": "processing", "message": "Getting harmonic loops ..."})
-    # Extract melodic samples
-    melodic_dir = os.path.join(results_dir, "harmonic stuff")
-    os.makedirs(melodic_dir, exist_ok=True)
-    extract_harmonic_samples(os.path.join(stems_dir, "harmonics.wav"), melodic_dir)
+    folders = {name: folder for name, folder, _, _, _, _ in stages}
+    forwarder = asyncio.create_task(forward_samples(samples, folders, send_message))
 
-    await send_message({"status": "processing", "message": "Generating wonky loops from original audio ..."})
-    # Generate wonky samples
-    melody_sample = os.path.join(stems_dir, "harmonics.wav")
-    instrumental_wonky_output_folder = os.path.join(results_dir, "wonky stuff")
-    original_wonky_output_folder = os.path.join(results_dir, "wonky stuff")
+    # Stages found in the result cache are restored, the others are handed to the graph,
+    # which runs independent ones at the same time; results are published in stage order
+    scratch_dirs = {}
 
-    wonky_sampler(input_file, original_wonky_output_folder, song_key=song_key)
+    def add_stage(name, inputs, run):
+        scratch_dirs[name] = tempfile.mkdtemp(prefix=".stage-", dir=results_dir)
+        graph.add_stage(name, lambda: run_stage(song, name, scratch_dirs[name], seed, run, stream_samples), inputs)
 
-    await send_message({"status": "processing", "message": "Generating wonky loops from harmonics ... (this gon take a min)"})
-    wonky_sampler(melody_sample, instrumental_wonky_output_folder, song_key=song_key)
+    for name, folder, _, _, inputs, run in stages:
+        if result_cache.get(stage_cache_key(song, name, seed)) is None:
+            add_stage(name, inputs, run)
+    graph.start()
+    # number of files of every stage that ran
+    items = {}
+    try:
+        for name, folder, message, progress, inputs, run in stages:
+            await send_message({"status": "processing", "message": message, "progress": progress})
+            stage_dir = os.path.join(results_dir, folder)
+            os.makedirs(stage_dir, exist_ok=True)
+            restored = None
+            if name not in scratch_dirs:
+                restored = result_cache.restore_tree(stage_cache_key(song, name, seed), stage_dir)
+                if restored is None:
+                    # evicted since we looked, run it like the stages that were not cached
+                    add_stage(name, inputs, run)
+            if name in scratch_dirs:
+                try:
+                    await graph.wait(name)
+                except Exception:
+                    metrics.inc("samplebox_stage_runs_total", stage=name, status="error")
+                    raise
+                items[name] = publish_stage(scratch_dirs[name], stage_dir, archive)
+            else:
+                logger.debug("Restored %s from cache", name)
+                metrics.inc("samplebox_stage_runs_total", stage=name, status="cached")
+                if stream_samples:
+                    for sample in cached_samples(song, name, seed, stage_dir):
+                        samples.put_nowait((name, sample))
+                if archive is not None:
+                    archive.add_files(stage_dir, restored)
+                continue
+            metrics.record_stage(name, graph.profiles[name], items=items[name], audio_seconds=song.duration)
+    except BaseException:
+        forwarder.cancel()
+        raise
+    finally:
+        graph.close()
+        for scratch_dir in scratch_dirs.values():
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    # samples still queued go out before the job is done
+    samples.put_nowait(None)
+    await forwarder
 
-    print(f"Processed song and generated samples in {results_dir}")
+    logger.info("Processed song and generated samples in %s", results_dir)
+    logger.debug("Stage timings: %s", ", ".join(f"{name} {seconds:.1f}s" for name, seconds in graph.timings.items()))
+    logger.debug("Feature cache: %s", feature_cache.feature_cache.stats())
+    for name, resource_profile in graph.profiles.items():
+        if name not in items:
+            metrics.record_stage(name, resource_profile)
+    audio_seconds = song.duration if items else None
+    await send_message({"status": "profile", "profile": job_profile(graph, stages, items, time.perf_counter() - start, audio_seconds)})
     return results_dir
 
 if __name__ == "__main__":
@@ -276,13 +550,11 @@ if __name__ == "__main__":
     results_dir = os.path.join(output_dir, filename)
     os.makedirs(results_dir, exist_ok=True)
 
-    y, sr = librosa.load(input_file)
-    song_key = get_key_of_sample(y, sr)
+    song = SongContext.from_file(input_file)
+    song_key = song.key
     print(f"song key: {song_key}")
    
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
-    sf.write(os.path.join(results_dir, "harmonics.wav"), y_harmonic, sr)
-    sf.write(os.path.join(results_dir, "percs.wav"), y_percussive, sr)
+    write_stems(song, results_dir)
     # separate_stems(input_file, output_dir)
     print("extracted everything")
     
@@ -291,23 +563,21 @@ if __name__ == "__main__":
     percussive_loops_dir = os.path.join(results_dir, "percussions")
     os.makedirs(percussive_loops_dir, exist_ok=True)
 
-    percs_file = os.path.join(results_dir, "percs.wav")
-    create_percussive_loops_from_original(percs_file, percussive_loops_dir)
+    create_percussive_loops_from_original(song.percussive, percussive_loops_dir)
     
     # Extract drum hits
     drum_dir = os.path.join(results_dir, "drums")
     os.makedirs(drum_dir, exist_ok=True)
-    extract_drum_hits(os.path.join(results_dir, "percs.wav"), drum_dir, amplitude_threshold=0.1)
+    extract_drum_hits(song.percussive, drum_dir, amplitude_threshold=0.1)
    
     # Extract melodic samples
     melodic_dir = os.path.join(results_dir, "harmonic_samples")
     os.makedirs(melodic_dir, exist_ok=True)
-    extract_harmonic_samples(os.path.join(results_dir, "harmonics.wav"), melodic_dir)
+    extract_harmonic_samples(song.harmonic, melodic_dir)
     
-    melody_sample = os.path.join(results_dir, "harmonics.wav")
     instrumental_wonky_output_folder = os.path.join(results_dir, "wonky_samples_harmonic")
     
     original_wonky_output_folder = os.path.join(results_dir, "wonky_samples_original")
 
-    wonky_sampler(input_file, original_wonky_output_folder, song_key=song_key)
-    wonky_sampler(melody_sample, instrumental_wonky_output_folder, song_key=song_key)
\ No newline at end of file
+    wonky_sampler(song, original_wonky_output_folder, song_key=song_key)
+    wonky_sampler(song.harmonic, instrumental_wonky_output_folder, song_key=song_key)
\ No newline at end of file
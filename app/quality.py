@@ -0,0 +1,70 @@
+import os
+from contextlib import contextmanager
+
+
+# analysis settings of a quality tier
+# arguments:
+#     sr: sampling rate songs are decoded at, and so the rate of the samples written
+#     hop_length: hop of the beat tracking and of the chromagrams the keys come from
+#     chroma: "cqt" for constant-Q chromagrams of bins_per_octave bins, "stft" for the much
+#             cheaper chromagram of the STFT
+#     n_fft: FFT size of the harmonic/percussive separation and of the phase vocoder behind
+#            pitch shifts and time stretches, which hop by a quarter of it
+#     hpss_kernel: median filter size of the harmonic/percussive separation
+#     res_type: resampler of pitch shifts
+class QualityTier(object):
+    def __init__(self, name, sr, hop_length, chroma, bins_per_octave, n_fft, hpss_kernel, res_type):
+        self.name = name
+        self.sr = sr
+        self.hop_length = hop_length
+        self.chroma = chroma
+        self.bins_per_octave = bins_per_octave
+        self.n_fft = n_fft
+        self.hpss_kernel = hpss_kernel
+        self.res_type = res_type
+
+    # the settings, for cache keys
+    def as_dict(self):
+        return dict(vars(self))
+
+
+# standard is what the pipeline always did; preview analyses half the samples with hops
+# twice as long in time, swaps the constant-Q chroma for the STFT one and halves the work of
+# the separation and the phase vocoder, for a rough samplebox in a fraction of the time;
+# high keeps the full bandwidth of CD audio with the time and frequency resolution of standard
+QUALITY_TIERS = {
+    "preview": QualityTier("preview", 11025, 1024, "stft", 12, 1024, 15, "soxr_qq"),
+    "standard": QualityTier("standard", 22050, 512, "cqt", 24, 2048, 31, "soxr_hq"),
+    "high": QualityTier("high", 44100, 1024, "cqt", 36, 4096, 31, "soxr_vhq"),
+}
+DEFAULT_QUALITY = os.environ.get("SAMPLEBOX_QUALITY", "standard")
+
+
+# the tier name, checked, for values coming from requests
+def check_quality(name):
+    name = name or DEFAULT_QUALITY
+    if name not in QUALITY_TIERS:
+        raise ValueError(f"Unknown quality {name}, expected one of {', '.join(QUALITY_TIERS)}")
+    return name
+
+
+# tier the analyses of this process run at, see use_quality
+_quality = DEFAULT_QUALITY
+
+
+def current_quality():
+    return QUALITY_TIERS[_quality]
+
+
+# runs the analyses of the block at tier name, in this process and in the stage processes
+# forked from it; None keeps the tier already in use
+@contextmanager
+def use_quality(name):
+    global _quality
+    previous = _quality
+    if name is not None:
+        _quality = check_quality(name)
+    try:
+        yield
+    finally:
+        _quality = previous
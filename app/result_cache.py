@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# content-addressed on-disk cache for pipeline results, shared by every server process
+# each entry is a directory named after the sha256 of its key parts (audio hash, stage
+# config, seed, ...), holding json values, numpy arrays or the output files of a stage;
+# entries are touched when read and the least recently used are evicted over max_bytes
+# arguments:
+#     root: directory the entries are stored in
+#     max_bytes: total size of all entries before the least recently used get evicted
+#     evict_interval: seconds after which a put walks the whole cache again, to account for
+#                     the entries other processes stored meanwhile
+class ResultCache(object):
+    def __init__(self, root, max_bytes=2 * 1024 * 1024 * 1024, evict_interval=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        # created by the first put, not when the cache is constructed at import time
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        # size of all entries as of the last eviction, plus the entries stored since by this
+        # process; None until the first eviction
+        self._bytes = None
+        self._evicted_at = 0
+
+    def key(self, *parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    # returns the entry directory for key, or None, and marks the entry as recently used
+    def get(self, key):
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return None
+        os.utime(entry_dir)
+        return entry_dir
+
+    # creates the entry for key by calling fill(directory); the entry only becomes visible
+    # once fill returned, so concurrent readers never see a half written entry. Errors of fill
+    # (a full disk, say) are raised
+    def put(self, key, fill):
+        entry_dir = self._entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            fill(tmp_dir)
+            size = _tree_size(tmp_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                raise
+            # another process stored the same entry first
+            return
+        self._stored(size)
+
+    # evicts only once the entries stored since the last eviction may have filled the cache,
+    # or every evict_interval seconds, instead of walking the cache after every put
+    def _stored(self, size):
+        if self._bytes is None or time.time() - self._evicted_at > self.evict_interval:
+            self.evict()
+            return
+        self._bytes += size
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    def get_json(self, key):
+        entry_dir = self.get(key)
+        if entry_dir is None:
+            return None
+        with open(os.path.join(entry_dir, "value.json")) as f:
+            return json.load(f)
+
+    def put_json(self, key, value):
+        def fill(entry_dir):
+            with open(os.path.join(entry_dir, "value.json"), "w") as f:
+                json.dump(value, f)
+
+        self.put(key, fill)
+
+    # mmap_mode="r" maps the arrays instead of reading them, so every process using the
+    # entry shares the same pages; a mapping stays valid if the entry is evicted meanwhile
+    def get_arrays(self, key, mmap_mode=None):
+        entry_dir = self.get(key)
+        if entry_dir is None:
+            return None
+        return {
+            name[:-len(".npy")]: np.load(os.path.join(entry_dir, name), mmap_mode=mmap_mode)
+            for name in os.listdir(entry_dir)
+        }
+
+    def put_arrays(self, key, **arrays):
+        def fill(entry_dir):
+            for name, array in arrays.items():
+                np.save(os.path.join(entry_dir, f"{name}.npy"), array)
+
+        self.put(key, fill)
+
+    # copies the files of a stored stage output into output_dir; returns the paths of the files
+    # restored (relative to output_dir), or None if the entry did not exist
+    # files are copied rather than hard linked because later stages may overwrite an output
+    # file in place, which must not change the cached copy
+    def restore_tree(self, key, output_dir):
+        entry_dir = self.get(key)
+        if entry_dir is None:
+            return None
+        try:
+            paths = list_files(entry_dir)
+            shutil.copytree(entry_dir, output_dir, dirs_exist_ok=True)
+        except (OSError, shutil.Error):
+            # evicted by another process while we were copying it
+            return None
+        return paths
+
+    # stores the files of output_dir, except those listed in skip (paths relative to
+    # output_dir, e.g. files that existed before the stage ran)
+    def store_tree(self, key, output_dir, skip=()):
+        def fill(entry_dir):
+            for path in list_files(output_dir):
+                if path in skip:
+                    continue
+                os.makedirs(os.path.join(entry_dir, os.path.dirname(path)), exist_ok=True)
+                shutil.copy2(os.path.join(output_dir, path), os.path.join(entry_dir, path))
+
+        self.put(key, fill)
+
+    def usage(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.listdir(self.root):
+            if prefix == "tmp":
+                continue
+            prefix_dir = os.path.join(self.root, prefix)
+            for name in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, name)
+                try:
+                    entries.append((os.path.getmtime(entry_dir), _tree_size(entry_dir), entry_dir))
+                except OSError:
+                    # evicted by another process in the meantime
+                    continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.usage())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+        self._bytes = total
+        self._evicted_at = time.time()
+
+    # removes every entry
+    def clear(self):
+        for _, _, entry_dir in self.usage():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        self._bytes = 0
+
+
+# paths of all files below directory, relative to it
+def list_files(directory):
+    if not os.path.isdir(directory):
+        return set()
+    return {
+        os.path.relpath(os.path.join(root, file), directory)
+        for root, _, files in os.walk(directory)
+        for file in files
+    }
+
+
+# bytes of the files below directory
+def _tree_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, path)) for path in list_files(directory))
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+result_cache = ResultCache(
+    os.environ.get("SAMPLEBOX_CACHE_DIR", "cache"),
+    max_bytes=int(os.environ.get("SAMPLEBOX_CACHE_MB", 2048)) * 1024 * 1024,
+)
@@ -0,0 +1,85 @@
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+import feature_cache
+from key_detector import key_detector, short_key_name, transpose_key
+
+# set SAMPLEBOX_VERIFY_METADATA=1 to analyse every generated sample again and report where
+# the propagated tempo or key disagrees with what the analysis finds
+VERIFY_METADATA = os.environ.get("SAMPLEBOX_VERIFY_METADATA", "0") == "1"
+
+
+# tempo and key of a generated sample, derived from the analysis of the audio it was cut
+# from and the transforms applied to it on the way, so the outputs never have to be beat
+# tracked or key detected again just to name their files
+# arguments:
+#     tempo: tempo in BPM, 0 if unknown
+#     key: key in short form (e.g. "C#m"), None if unknown
+class SampleMetadata(object):
+    def __init__(self, tempo, key=None):
+        self.tempo = float(tempo)
+        self.key = key
+
+    # pitch shifting by n_steps semitones transposes the key and keeps the tempo
+    def pitch_shifted(self, n_steps):
+        key = transpose_key(self.key, n_steps) if self.key is not None else None
+        return SampleMetadata(self.tempo, key)
+
+    # stretching with rate plays rate times as fast, the key stays the same
+    def time_stretched(self, rate):
+        return SampleMetadata(self.tempo * rate, self.key)
+
+    # the tempo as it goes into file names, "unknown" if there is none
+    @property
+    def bpm(self):
+        if self.tempo <= 0:
+            return "unknown"
+        return int(round(self.tempo))
+
+    # the values as they go into a streamed sample message
+    def as_dict(self):
+        return {"bpm": self.bpm if self.tempo > 0 else None, "key": self.key}
+
+    # with SAMPLEBOX_VERIFY_METADATA=1, compares the known values with a fresh analysis of
+    # y and prints any difference (tempos within tolerance, as a fraction, count as equal);
+    # a no-op otherwise
+    def verify(self, y, sr, name, tolerance=0.03):
+        if not VERIFY_METADATA:
+            return
+        mismatches = []
+        if self.tempo > 0:
+            tempo, _ = feature_cache.beat_track(y, sr)
+            tempo = float(np.atleast_1d(tempo)[0])
+            if abs(tempo - self.tempo) > tolerance * self.tempo:
+                mismatches.append(f"tempo {self.bpm} BPM, analysed {tempo:.0f} BPM")
+        if self.key is not None:
+            key = short_key_name(key_detector.detect_audio(y, sr))
+            if key != self.key:
+                mismatches.append(f"key {self.key}, analysed {key}")
+        if mismatches:
+            print(f"Metadata of {name}: " + "; ".join(mismatches))
+
+
+# called with the path and the SampleMetadata (or None) of every sample file written in this
+# process while set, see sample_listener
+_listener = None
+
+
+# calls listener(path, metadata) for every sample_written inside the block, e.g. to stream
+# the samples of a stage while the stage is still running
+@contextmanager
+def sample_listener(listener):
+    global _listener
+    previous, _listener = _listener, listener
+    try:
+        yield
+    finally:
+        _listener = previous
+
+
+# reports a sample file that was just written; a no-op without a listener
+def sample_written(path, metadata=None):
+    if _listener is not None:
+        _listener(path, metadata)
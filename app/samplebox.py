@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from audio_output import DEFAULT_FORMAT, OUTPUT_FORMATS
+from job_executor import PROCESS_SONG, init_worker, run_job
+from job_queue import spawn_workers
+from quality import DEFAULT_QUALITY, QUALITY_TIERS
+from perc_splitter import process_song
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aiff", ".aif")
+
+
+# input songs as (path, normalised path relative to the input root), either every audio file
+# below a directory or the paths listed in a manifest file (one per line, relative to the
+# manifest, lines starting with # are ignored); the manifest is the root of its entries, so
+# an entry outside its folder comes with a relative path starting with ..
+def find_songs(source):
+    if os.path.isdir(source):
+        songs = []
+        for root, _, files in os.walk(source):
+            for file in sorted(files):
+                if file.lower().endswith(AUDIO_EXTENSIONS):
+                    path = os.path.join(root, file)
+                    songs.append((path, os.path.relpath(path, source)))
+        return sorted(songs, key=lambda song: song[1])
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    songs = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = os.path.normpath(os.path.join(base_dir, line))
+            songs.append((path, os.path.relpath(path, base_dir)))
+    return songs
+
+
+# folder the samplebox of song (a path from find_songs) is written to: its path below
+# output_dir, file name and extension included, so songs keep their folder structure and
+# x.mp3 and x.wav next to each other do not collide; None for songs outside the input root
+def song_output_dir(output_dir, song):
+    output_dir = os.path.abspath(output_dir)
+    path = os.path.normpath(os.path.join(output_dir, song))
+    if os.path.commonpath([output_dir, path]) != output_dir or path == output_dir:
+        return None
+    return path
+
+
+# checkpoint of a batch run: one json line per finished song, appended as soon as the song
+# is done, so an interrupted run picks up where it stopped; the last line of a song wins
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the line being written when the previous run was killed
+                        continue
+                    self.records[record["song"]] = record
+
+    def is_done(self, song):
+        return self.records.get(song, {}).get("status") == "done"
+
+    def add(self, record):
+        self.records[record["song"]] = record
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# progress sink for run_job that prints the messages of one song
+class _PrintProgress(object):
+    def __init__(self, song):
+        self.song = song
+
+    def put(self, message):
+        if message.get("status") == "profile":
+            return
+        print(f"[{self.song}] {message.get('message')}", flush=True)
+
+
+# runs in a worker process of the pool
+def _process_one(path, song, output_dir, seed, timeout, output_format, quality):
+    start = time.time()
+    results_dir = run_job(process_song, (path, output_dir), _PrintProgress(song), timeout,
+                          {"seed": seed, "output_format": output_format, "quality": quality})
+    return results_dir, time.time() - start
+
+
+def run_batch(source, output_dir, workers=None, seed=0, timeout=900, output_format=None, quality=None):
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(output_dir, "checkpoint.jsonl"))
+    songs = find_songs(source)
+    pending = [(path, song) for path, song in songs if not checkpoint.is_done(song)]
+    print(f"{len(songs)} songs, {len(songs) - len(pending)} already done, {len(pending)} to process")
+
+    start = time.time()
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(workers,)) as pool:
+        futures = {}
+        for path, song in pending:
+            song_dir = song_output_dir(output_dir, song)
+            if song_dir is None:
+                checkpoint.add({"song": song, "status": "error", "error": "outside of the input folder"})
+                print(f"[{song}] error: outside of the input folder")
+                continue
+            futures[pool.submit(_process_one, path, song, song_dir, seed, timeout, output_format, quality)] = song
+        for future in as_completed(futures):
+            song = futures[future]
+            try:
+                results_dir, seconds = future.result()
+                record = {"song": song, "status": "done", "results_dir": results_dir, "seconds": round(seconds, 2)}
+            except Exception as e:
+                record = {"song": song, "status": "error", "error": f"{type(e).__name__}: {e}"}
+            checkpoint.add(record)
+            print(f"[{song}] {record['status']}" + (f" in {record['seconds']}s" if "seconds" in record else f": {record['error']}"))
+
+    records = [checkpoint.records[song] for _, song in songs if song in checkpoint.records]
+    summary = {
+        "songs": len(songs),
+        "done": sum(record["status"] == "done" for record in records),
+        "failed": sum(record["status"] == "error" for record in records),
+        "skipped": len(songs) - len(pending),
+        "wall_seconds": round(time.time() - start, 2),
+        "results": records,
+    }
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"{summary['done']} of {summary['songs']} songs done, {summary['failed']} failed, summary in {output_dir}/summary.json")
+    return summary
+
+
+# runs the jobs queued through the /jobs API of the servers (whose SAMPLEBOX_QUEUE_WORKERS is
+# 0 by default) until interrupted
+def run_queue_workers(db_path, workers=None, timeout=900):
+    processes = spawn_workers(db_path, PROCESS_SONG, timeout, workers or os.cpu_count() or 1)
+    print(f"{len(processes)} workers processing the jobs of {db_path}")
+    # set after the workers were forked, so they keep the default handler
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="samplebox", description="Generate sample boxes from songs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch = commands.add_parser("batch", help="generate sample boxes for a directory or manifest of songs")
+    batch.add_argument("source", help="directory of songs, or manifest file with one song path per line")
+    batch.add_argument("-o", "--output", default="results", help="output directory (default: results)")
+    batch.add_argument("-w", "--workers", type=int, default=None, help="songs processed at the same time (default: number of CPUs)")
+    batch.add_argument("--seed", type=int, default=0, help="seed of the random stages (default: 0)")
+    batch.add_argument("--format", choices=list(OUTPUT_FORMATS), default=DEFAULT_FORMAT,
+                       help=f"format of the samples (default: {DEFAULT_FORMAT})")
+    batch.add_argument("--quality", choices=list(QUALITY_TIERS), default=DEFAULT_QUALITY,
+                       help=f"analysis quality, preview is fastest (default: {DEFAULT_QUALITY})")
+    batch.add_argument("--timeout", type=float, default=float(os.environ.get("SAMPLEBOX_JOB_TIMEOUT", 900)),
+                       help="seconds a single song may take (default: 900)")
+
+    worker = commands.add_parser("worker", help="process the jobs queued through the /jobs API")
+    worker.add_argument("--db", default=os.environ.get("SAMPLEBOX_JOBS_DB", os.path.join(os.environ.get("SAMPLEBOX_JOBS_DIR", "jobs"), "jobs.db")),
+                        help="job database of the servers (default: jobs/jobs.db)")
+    worker.add_argument("-w", "--workers", type=int, default=None, help="jobs processed at the same time (default: number of CPUs)")
+    worker.add_argument("--timeout", type=float, default=float(os.environ.get("SAMPLEBOX_JOB_TIMEOUT", 900)),
+                        help="seconds a single job may take (default: 900)")
+
+    args = parser.parse_args(argv)
+    if args.command == "batch":
+        summary = run_batch(args.source, args.output, workers=args.workers, seed=args.seed, timeout=args.timeout,
+                            output_format=args.format, quality=args.quality)
+        return 1 if summary["failed"] else 0
+    if args.command == "worker":
+        return run_queue_workers(args.db, workers=args.workers, timeout=args.timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
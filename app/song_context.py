@@ -0,0 +1,167 @@
+import os
+
+import librosa
+import numpy as np
+
+import feature_cache
+from beat_grid import BeatGrid
+from result_cache import file_hash, result_cache
+from streaming_hpss import separate_to_files
+from key_detector import key_detector, short_key_name
+from quality import current_quality
+from stem_separator import get_separator_pool
+
+# class that holds a decoded song in memory together with everything derived from it
+# (harmonic/percussive stems, key, ...), so the pipeline decodes an upload once and every
+# stage works from the same arrays instead of re-loading a file from disk
+# when the context knows the content hash of the file it was decoded from, the stems and
+# the key are also looked up in (and stored to) the on-disk result cache, and the file is
+# only decoded once something actually needs the waveform; cached stems are memory mapped
+# read-only, so all processes working on the song share one copy, and stages must copy a
+# range of a stem before modifying it
+# arguments:
+#     y: the waveform, as returned by librosa.load
+#     sr: sampling rate of the waveform
+#     path: optional path the waveform was decoded from, used for log messages
+#     parent: for a stem, the song it was separated from, whose beat grid it shares
+class SongContext(object):
+    def __init__(self, y, sr, path=None, parent=None):
+        self._y = y
+        self.sr = sr
+        self.path = path
+        self.parent = parent
+        self.content_hash = None
+        self.decoded_path = None
+        self._harmonic = None
+        self._percussive = None
+        self._model_stems = {}
+        self._key = None
+        self._beat_grid = None
+
+    # decoded_path: optional copy of the file already decoded (e.g. while it was uploaded),
+    # read instead of the file; content_hash: sha256 of the file, if already known; sr is
+    # the one of the current quality tier by default
+    @classmethod
+    def from_file(cls, path, sr=None, decoded_path=None, content_hash=None):
+        song = cls(None, sr or current_quality().sr, path=path)
+        song.decoded_path = decoded_path
+        song.content_hash = content_hash or file_hash(path)
+        return song
+
+    @property
+    def y(self):
+        if self._y is None:
+            self._y, _ = librosa.load(self.decoded_path or self.path, sr=self.sr)
+        return self._y
+
+    def _cache_key(self, name):
+        if self.content_hash is None:
+            return None
+        return result_cache.key(name, self.content_hash, self.sr, current_quality().as_dict())
+
+    def __str__(self):
+        if self.path is not None:
+            return str(self.path)
+        return "<in-memory audio>"
+
+    @property
+    def duration(self):
+        return len(self.y) / self.sr
+
+    def _separate(self):
+        if self._harmonic is None:
+            tier = current_quality()
+            cache_key = self._cache_key("stems")
+            stems = result_cache.get_arrays(cache_key, mmap_mode="r") if cache_key else None
+            if stems is None and cache_key:
+                # separated block by block straight into the cache entry, so long uploads
+                # never hold a full-length STFT
+                result_cache.put(cache_key, lambda entry_dir: separate_to_files(
+                    self.y, self.sr, os.path.join(entry_dir, "harmonic.npy"), os.path.join(entry_dir, "percussive.npy"),
+                    n_fft=tier.n_fft, hop_length=tier.n_fft // 4, kernel_size=tier.hpss_kernel))
+                stems = result_cache.get_arrays(cache_key, mmap_mode="r")
+            if stems is not None:
+                y_harmonic, y_percussive = stems["harmonic"], stems["percussive"]
+            else:
+                # no content hash, or evicted right away because the cache is too small
+                y_harmonic, y_percussive = feature_cache.hpss(self.y, n_fft=tier.n_fft, kernel_size=tier.hpss_kernel)
+            self._harmonic = SongContext(y_harmonic, self.sr, parent=self)
+            self._percussive = SongContext(y_percussive, self.sr, parent=self)
+
+    # the harmonic stem, as a SongContext of its own so it can be handed to any stage
+    @property
+    def harmonic(self):
+        self._separate()
+        return self._harmonic
+
+    # the percussive stem, as a SongContext of its own so it can be handed to any stage
+    @property
+    def percussive(self):
+        self._separate()
+        return self._percussive
+
+    # the stems of a source separation model such as "spleeter:4stems", as a dict of stem
+    # name -> SongContext; separated by the warm separator pool of this process and cached
+    # (and memory mapped) like the harmonic and percussive stems
+    def model_stems(self, model):
+        if model not in self._model_stems:
+            cache_key = self._cache_key(f"stems {model}")
+            stems = result_cache.get_arrays(cache_key, mmap_mode="r") if cache_key else None
+            if stems is None:
+                stems = get_separator_pool(model).separate(self.y, self.sr)
+                if cache_key:
+                    result_cache.put(cache_key, lambda entry_dir: [
+                        np.save(os.path.join(entry_dir, f"{name}.npy"), stem) for name, stem in stems.items()])
+            self._model_stems[model] = {name: SongContext(stem, self.sr, parent=self) for name, stem in stems.items()}
+        return self._model_stems[model]
+
+    # the key of the whole waveform in short form, e.g. "C#m" or "F"
+    @property
+    def key(self):
+        if self._key is None:
+            cache_key = self._cache_key("key")
+            self._key = result_cache.get_json(cache_key) if cache_key else None
+            if self._key is None:
+                self._key = short_key_name(key_detector.detect_audio(self.y, self.sr))
+                if cache_key:
+                    result_cache.put_json(cache_key, self._key)
+        return self._key
+
+    # the beat grid of the song, tracked once on the full mix and shared by its stems, so
+    # every sampler cuts its bars from the same grid
+    @property
+    def beat_grid(self):
+        if self.parent is not None:
+            return self.parent.beat_grid
+        if self._beat_grid is None:
+            cache_key = self._cache_key("beat_grid")
+            values = result_cache.get_json(cache_key) if cache_key else None
+            if values is not None:
+                self._beat_grid = BeatGrid.from_dict(values)
+            else:
+                self._beat_grid = BeatGrid.track(self.y, self.sr, hop_length=current_quality().hop_length)
+                if cache_key:
+                    result_cache.put_json(cache_key, self._beat_grid.to_dict())
+        return self._beat_grid
+
+
+# returns (y, sr) for either a SongContext or a path to an audio file, so stages can be
+# called with whatever the caller has at hand; files are decoded at the rate of the current
+# quality tier
+def load_audio(source):
+    if isinstance(source, SongContext):
+        return source.y, source.sr
+    return librosa.load(source, sr=current_quality().sr)
+
+
+# the beat grid of a SongContext, or the one tracked in y for any other source
+def get_beat_grid(source, y, sr):
+    if isinstance(source, SongContext):
+        return source.beat_grid
+    return BeatGrid.track(y, sr, hop_length=current_quality().hop_length)
+
+
+def as_song_context(source):
+    if isinstance(source, SongContext):
+        return source
+    return SongContext.from_file(source)
@@ -0,0 +1,238 @@
+import asyncio
+import multiprocessing
+import os
+import traceback
+
+from metrics import profile
+
+
+class StageError(Exception):
+    pass
+
+
+# songs the pool of this process runs at the same time, see set_concurrent_jobs
+_concurrent_jobs = 1
+
+
+# called once in every process that runs jobs, with the number of jobs its pool runs at once,
+# so the stages of a song share the cores left to it instead of all cores
+def set_concurrent_jobs(jobs):
+    global _concurrent_jobs
+    _concurrent_jobs = max(1, jobs)
+
+
+# stages of one song running at the same time: SAMPLEBOX_STAGE_WORKERS, or the cores per
+# concurrent job, at most one per stage of process_song
+def default_stage_workers():
+    if "SAMPLEBOX_STAGE_WORKERS" in os.environ:
+        return int(os.environ["SAMPLEBOX_STAGE_WORKERS"])
+    return max(1, min(6, (os.cpu_count() or 1) // _concurrent_jobs))
+
+
+# scheduler for the stages of process_song: each stage declares the resources it reads
+# (waveform, stems, key, beats, ...), every resource is computed once in this process as soon
+# as a pending stage needs it, and each stage runs in a forked child process once its inputs
+# are ready, so stages that do not depend on each other overlap; the children inherit the
+# computed resources and the warm feature cache from the fork, nothing has to be pickled
+# stages write their output to disk, so the scheduler only reports when they are done;
+# without fork (or with a single worker) the stages run one after another in this process
+# timings holds the wall seconds of every stage and resource, profiles their full profile
+# (wall and CPU seconds, peak RSS, phases, see metrics.profile)
+# arguments:
+#     max_workers: number of stages running at the same time, default_stage_workers() by default
+#     on_report: called with the stage name and the value for every report() of a running
+#                stage, in this process and while the stage is still running
+class StageGraph(object):
+    def __init__(self, max_workers=None, on_report=None):
+        self.max_workers = max_workers or default_stage_workers()
+        self.on_report = on_report
+        self.timings = {}
+        self.profiles = {}
+        self._resources = {}
+        self._resolved = set()
+        self._stages = []
+        self._done = {}
+        self._running = {}
+        self._driver = None
+        try:
+            self._context = multiprocessing.get_context("fork")
+        except ValueError:
+            self._context = None
+
+    # compute() is called in this process once, before the first stage that needs it runs
+    def add_resource(self, name, compute, inputs=()):
+        self._resources[name] = (compute, tuple(inputs))
+
+    # run() is called in a child process once all inputs are resolved; stages start in the
+    # order they were added whenever several are ready; a stage added after start() is
+    # scheduled like the others, even once all earlier ones are done
+    def add_stage(self, name, run, inputs=()):
+        self._stages.append((name, run, tuple(inputs)))
+        self._done[name] = asyncio.get_running_loop().create_future()
+        if self._driver is not None and self._driver.done():
+            self.start()
+
+    def start(self):
+        self._driver = asyncio.create_task(self._drive())
+
+    # waits until stage name has finished, raises StageError if it failed
+    async def wait(self, name):
+        await asyncio.wait([self._done[name], self._driver], return_when=asyncio.FIRST_COMPLETED)
+        if not self._done[name].done():
+            # the driver itself failed (e.g. while computing a resource)
+            self._driver.result()
+        return self._done[name].result()
+
+    # stops the scheduler and kills the stages that are still running
+    def close(self):
+        if self._driver is not None:
+            self._driver.cancel()
+        for process, _ in self._running.values():
+            process.kill()
+            process.join()
+        self._running.clear()
+        for done in self._done.values():
+            if not done.done():
+                done.cancel()
+
+    def _inline(self):
+        return self._context is None or self.max_workers <= 1
+
+    # first resource needed for name that is not resolved yet, with its own inputs resolved
+    def _next_missing(self, name):
+        if name in self._resolved:
+            return None
+        for dependency in self._resources[name][1]:
+            missing = self._next_missing(dependency)
+            if missing is not None:
+                return missing
+        return name
+
+    # unresolved resources name depends on, including itself
+    def _unresolved(self, name):
+        if name in self._resolved:
+            return set()
+        unresolved = {name}
+        for dependency in self._resources[name][1]:
+            unresolved |= self._unresolved(dependency)
+        return unresolved
+
+    # next resource to compute, for the pending stage closest to being ready (the earliest
+    # added one on ties), so cheap stages get going while expensive resources are computed
+    def _next_resource(self, pending):
+        waiting = [(len(set().union(*(self._unresolved(name) for name in inputs))), i, inputs)
+                   for i, (_, _, inputs) in enumerate(pending)]
+        waiting = [entry for entry in waiting if entry[0]]
+        if not waiting:
+            return None
+        _, _, inputs = min(waiting)
+        for name in inputs:
+            missing = self._next_missing(name)
+            if missing is not None:
+                return missing
+        return None
+
+    def _resolve(self, name):
+        self._record(name, profile(self._resources[name][0]))
+        self._resolved.add(name)
+
+    def _record(self, name, stage_profile):
+        self.profiles[name] = stage_profile
+        self.timings[name] = stage_profile["seconds"]
+
+    # runs until no stage is waiting or running; self._stages holds the stages not started yet
+    async def _drive(self):
+        pending = self._stages
+        while pending or self._running:
+            for stage in list(pending):
+                if len(self._running) >= self.max_workers:
+                    break
+                name, run, inputs = stage
+                if self._resolved.issuperset(inputs):
+                    pending.remove(stage)
+                    self._launch(name, run)
+                    # let wait() callers publish inline stages before the next one runs
+                    await asyncio.sleep(0)
+
+            missing = self._next_resource(pending)
+            if missing is not None:
+                self._resolve(missing)
+                continue
+
+            self._poll()
+            if self._running:
+                await asyncio.sleep(0.05)
+
+    def _report(self, name, value):
+        if self.on_report is not None:
+            self.on_report(name, value)
+
+    def _launch(self, name, run):
+        global _reporter
+        if self._inline():
+            _reporter = lambda value: self._report(name, value)
+            try:
+                self._record(name, profile(run))
+            except Exception as e:
+                # also stops the driver, like an exception in process_song stops the pipeline
+                self._done[name].set_exception(e)
+                raise
+            finally:
+                _reporter = None
+            self._done[name].set_result(self.timings[name])
+            return
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_run_stage, args=(run, sender), name=f"stage {name}")
+        process.start()
+        sender.close()
+        self._running[name] = (process, receiver)
+
+    def _poll(self):
+        for name, (process, receiver) in list(self._running.items()):
+            # checked before the pipe, so a child that exited has sent everything it will
+            alive = process.is_alive()
+            status = None
+            while status is None and receiver.poll():
+                try:
+                    status, value = receiver.recv()
+                except EOFError:
+                    process.join()
+                    status, value = "error", f"exited with code {process.exitcode}"
+                if status == "report":
+                    self._report(name, value)
+                    status = None
+            if status is None:
+                if alive:
+                    continue
+                status, value = "error", f"exited with code {process.exitcode}"
+            process.join()
+            receiver.close()
+            del self._running[name]
+            if status == "done":
+                self._record(name, value)
+                self._done[name].set_result(self.timings[name])
+            else:
+                self._done[name].set_exception(StageError(f"Stage {name} failed: {value}"))
+
+
+# sends the values of report() to the graph, set while a stage runs in this process
+_reporter = None
+
+
+# reports value to the on_report callback of the graph running the current stage, e.g. a
+# sample the stage has just written; a no-op outside of a stage
+def report(value):
+    if _reporter is not None:
+        _reporter(value)
+
+
+# entry point of the forked child running a single stage
+def _run_stage(run, sender):
+    global _reporter
+    _reporter = lambda value: sender.send(("report", value))
+    try:
+        sender.send(("done", profile(run)))
+    except BaseException:
+        sender.send(("error", traceback.format_exc()))
+    finally:
+        sender.close()
@@ -0,0 +1,152 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import librosa
+import numpy as np
+
+# sampling rate and channel count the spleeter models are trained on
+SEPARATOR_SR = 44100
+
+# source separation used for the stems folder of the samplebox: "hpss" for the harmonic and
+# percussive stems only, or a spleeter model (e.g. "spleeter:4stems") whose stems are added
+SEPARATOR_MODEL = os.environ.get("SAMPLEBOX_STEM_MODEL", "hpss")
+
+
+# warm spleeter separators shared by everything that separates stems in this process:
+# building a Separator loads the TensorFlow graph and the model weights, which takes several
+# seconds, so every separator of the pool is built (and run once) up front and then serves
+# separations of in-memory waveforms for the lifetime of the process
+# requests arriving while a separator is busy are batched, i.e. joined into one waveform
+# with silence in between and separated by a single prediction
+# arguments:
+#     model: spleeter model description, e.g. "spleeter:4stems"
+#     size: number of separators, i.e. predictions running at the same time
+#     max_batch: number of requests separated by one prediction
+#     batch_wait: seconds a separator waits for more requests before it starts a batch
+class SeparatorPool(object):
+    def __init__(self, model="spleeter:4stems", size=None, max_batch=None, batch_wait=0.05):
+        self.model = model
+        self.size = size or int(os.environ.get("SAMPLEBOX_SEPARATORS", 1))
+        self.max_batch = max_batch or int(os.environ.get("SAMPLEBOX_SEPARATOR_BATCH", 4))
+        self.batch_wait = batch_wait
+        self._requests = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    # loads the separators, a no-op once they are loaded
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                separator = self._load()
+                thread = threading.Thread(target=self._serve, args=(separator,), daemon=True,
+                                          name=f"separator {len(self._threads)}")
+                thread.start()
+                self._threads.append(thread)
+
+    def _load(self):
+        # imported here, spleeter pulls in TensorFlow and is only needed for model stems
+        from spleeter.separator import Separator
+
+        start = time.time()
+        separator = Separator(self.model, multiprocess=False)
+        # the graph and the weights are only loaded by the first prediction
+        separator.separate(np.zeros((SEPARATOR_SR, 2), dtype=np.float32))
+        print(f"Loaded separator {self.model} in {time.time() - start:.1f}s")
+        return separator
+
+    # stems of y (mono, or channels first like librosa.load(mono=False)) at sampling rate sr,
+    # as a dict of stem name -> waveform with the shape and sampling rate of y
+    def separate(self, y, sr):
+        return self.submit(y, sr).result()
+
+    # like separate, but returns a concurrent.futures.Future of the stems
+    def submit(self, y, sr):
+        self.start()
+        future = Future()
+        self._requests.put((_to_separator_input(y, sr), y.shape, sr, future))
+        return future
+
+    def _serve(self, separator):
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            batch = [request for request in batch if request[3].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = _separate_batch(separator, [waveform for waveform, _, _, _ in batch])
+                for (_, shape, sr, future), stems in zip(batch, results):
+                    future.set_result({name: _from_separator_output(stem, shape, sr) for name, stem in stems.items()})
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+# one prediction for all waveforms; a second of silence between them keeps the STFT frames
+# of one request from overlapping the next
+def _separate_batch(separator, waveforms):
+    gap = np.zeros((SEPARATOR_SR, 2), dtype=np.float32)
+    parts = []
+    bounds = []
+    position = 0
+    for waveform in waveforms:
+        if parts:
+            parts.append(gap)
+            position += len(gap)
+        parts.append(waveform)
+        bounds.append((position, position + len(waveform)))
+        position += len(waveform)
+    stems = separator.separate(np.concatenate(parts))
+    return [{name: stem[start:end] for name, stem in stems.items()} for start, end in bounds]
+
+
+# (samples, 2) float32 waveform at SEPARATOR_SR, the input layout of spleeter
+def _to_separator_input(y, sr):
+    y = np.asarray(y, dtype=np.float32)
+    if sr != SEPARATOR_SR:
+        y = librosa.resample(y, orig_sr=sr, target_sr=SEPARATOR_SR)
+    if y.ndim == 1:
+        y = np.stack([y, y])
+    elif y.shape[0] == 1:
+        y = np.concatenate([y, y])
+    return np.ascontiguousarray(y[:2].T)
+
+
+# a stem back in the layout of the request: channels first (or mono) at sr, same length
+def _from_separator_output(stem, shape, sr):
+    stem = stem.T
+    if len(shape) == 1:
+        stem = stem.mean(axis=0)
+    elif shape[0] == 1:
+        stem = stem.mean(axis=0, keepdims=True)
+    if sr != SEPARATOR_SR:
+        stem = librosa.resample(stem, orig_sr=SEPARATOR_SR, target_sr=sr)
+    return librosa.util.fix_length(stem, size=shape[-1])
+
+
+_pools = {}
+
+
+# the separator pool of this process for model; a forked child gets pools of its own, the
+# threads and TensorFlow sessions of the parent do not survive the fork
+def get_separator_pool(model="spleeter:4stems"):
+    key = (os.getpid(), model)
+    if key not in _pools:
+        _pools[key] = SeparatorPool(model)
+    return _pools[key]
+
+
+# loads the separators of the configured model, so the first song of a worker process does
+# not pay for it; a no-op when the stems come from hpss
+def warm_up(model=SEPARATOR_MODEL):
+    if model != "hpss":
+        get_separator_pool(model).start()
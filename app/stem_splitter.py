@@ -1,7 +1,6 @@
 import librosa
 import soundfile as sf
 import numpy as np
-from spleeter.separator import Separator
 import os
 from Tonal_Fragment import Tonal_Fragment
 import random
@@ -9,6 +8,7 @@ from scipy.stats import skew
 from scipy.signal import butter, filtfilt
 from wonky_sampler import main as wonky_sampler
 import gc
+from stem_separator import SEPARATOR_SR, get_separator_pool
 
 def get_key_of_sample(sample, sr):
     tonal_fragment = Tonal_Fragment(sample, sr)
@@ -19,10 +19,15 @@ def load_and_analyze(file_path):
     tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
     return y, sr, tempo, beat_frames
 
+# writes the 4 stems of file_path to output_path/<song name>/<stem>.wav like spleeter's
+# separate_to_file, but with the warm separators of this process instead of a new model
 def separate_stems(file_path, output_path):
-    separator = Separator('spleeter:4stems')
-    separator.separate_to_file(file_path, output_path)
-    del seperator
+    y, sr = librosa.load(file_path, sr=SEPARATOR_SR, mono=False)
+    stems = get_separator_pool('spleeter:4stems').separate(y, sr)
+    stems_dir = os.path.join(output_path, os.path.splitext(os.path.basename(file_path))[0])
+    os.makedirs(stems_dir, exist_ok=True)
+    for name, stem in stems.items():
+        sf.write(os.path.join(stems_dir, f"{name}.wav"), stem.T, sr)
 
 def extract_drum_hits(drum_stem_path, output_path, amplitude_threshold=0.1, max_samples_per_category=5):
     y, sr = librosa.load(drum_stem_path)
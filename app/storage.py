@@ -0,0 +1,298 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from metrics import metrics
+
+# total size of the working directories of all areas; over it the idle ones are evicted,
+# those expiring first first, and requests are turned away while the directories in use
+# alone take more (see StorageManager.is_full)
+STORAGE_MB = int(os.environ.get("SAMPLEBOX_STORAGE_MB", 10240))
+# seconds between two collections; removing a directory starts one right away
+GC_SECONDS = float(os.environ.get("SAMPLEBOX_STORAGE_GC_SECONDS", 30))
+# working directories of the requests of /ws, /generate-samplebox and /sample, kept
+# RESULTS_TTL seconds at most after the request; point it at a tmpfs (e.g.
+# /dev/shm/samplebox) to keep the files of the stages off the disk altogether
+RESULTS_DIR = os.environ.get("SAMPLEBOX_RESULTS_DIR", "results")
+RESULTS_TTL = float(os.environ.get("SAMPLEBOX_RESULTS_TTL", 3600))
+
+# evicted directories are renamed to this prefix first and deleted outside the lock
+TRASH_PREFIX = ".trash-"
+
+
+class _Entry(object):
+    def __init__(self, area, in_use, expires_at):
+        self.area = area
+        self.in_use = in_use
+        self.expires_at = expires_at
+        self.size = None
+
+
+# a directory of working directories sharing a lifetime, see StorageManager.add_area
+class StorageArea(object):
+    def __init__(self, manager, name, root, ttl, in_use=None, on_evict=None):
+        self.manager = manager
+        self.name = name
+        self.root = root
+        self.ttl = ttl
+        self.in_use = in_use
+        self.on_evict = on_evict
+
+    # a new working directory, named name (a fresh uuid by default), in use until released;
+    # the root of the area is created along with the first one
+    def create(self, name=None):
+        path = os.path.join(self.root, name or str(uuid.uuid4()))
+        os.makedirs(path)
+        self.manager._track(self, path)
+        return path
+
+    # marks an existing directory as in use again, returns False if it is gone or evicted
+    def acquire(self, path):
+        return self.manager._acquire(self, path)
+
+    # the directory is no longer in use and expires ttl seconds from now (the ttl of the
+    # area by default); releasing an idle directory never postpones its expiry
+    def release(self, path, ttl=None):
+        self.manager._release(self, path, self.ttl if ttl is None else ttl)
+
+    # the directory is deleted by the next collection, which starts right away
+    def remove(self, path):
+        self.release(path, ttl=0)
+
+    # postpones the expiry of an idle directory to the ttl of the area from now, e.g. when
+    # its result is downloaded
+    def touch(self, path):
+        self.manager._touch(self, path)
+
+
+# owns the working directories of a server: every area is a root directory whose
+# subdirectories are deleted ttl seconds after they were released (or, when nothing tracks
+# them, e.g. after a restart, after they were last modified), and idle directories are
+# evicted, those expiring first first, while all areas together take more than max_bytes
+# a background task on the event loop of the server collects in a thread, so request paths
+# only ever mark directories and never wait for the disk
+# arguments:
+#     max_bytes: total size of the directories of all areas
+#     interval: seconds between two collections
+class StorageManager(object):
+    def __init__(self, max_bytes, interval=GC_SECONDS):
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.areas = []
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._usage = {"max_bytes": max_bytes, "used_bytes": 0, "in_use_bytes": 0, "areas": {}}
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    # in_use(name) tells whether an idle directory is still needed for another reason (e.g.
+    # its job is queued), such directories expire the ttl after they stopped being needed;
+    # on_evict(name) is called once an idle directory was deleted, by the collector or by
+    # someone else
+    def add_area(self, name, root, ttl, in_use=None, on_evict=None):
+        area = StorageArea(self, name, root, ttl, in_use=in_use, on_evict=on_evict)
+        self.areas.append(area)
+        return area
+
+    # starts collecting on the running event loop
+    def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = self._loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._loop = None
+
+    # starts a collection right away, from any thread
+    def wake(self):
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # the loop closed with the server
+                pass
+
+    # whether the directories in use alone take max_bytes, as of the last collection
+    def is_full(self):
+        return self._usage["in_use_bytes"] >= self.max_bytes
+
+    # bytes and directories of every area, as of the last collection
+    def usage(self):
+        return dict(self._usage, areas={name: dict(area) for name, area in self._usage["areas"].items()})
+
+    def _track(self, area, path):
+        with self._lock:
+            self._entries[path] = _Entry(area, True, time.time() + area.ttl)
+        if self._usage["used_bytes"] > self.max_bytes:
+            self.wake()
+
+    def _acquire(self, area, path):
+        with self._lock:
+            # evictions rename under the lock, so the directory cannot go away after this
+            if not os.path.isdir(path):
+                return False
+            entry = self._entries.setdefault(path, _Entry(area, True, time.time() + area.ttl))
+            entry.in_use = True
+            entry.size = None
+        return True
+
+    def _release(self, area, path, ttl):
+        expires_at = time.time() + ttl
+        with self._lock:
+            entry = self._entries.setdefault(path, _Entry(area, False, expires_at))
+            if entry.in_use or expires_at < entry.expires_at:
+                entry.expires_at = expires_at
+            entry.in_use = False
+        if ttl <= 0:
+            self.wake()
+
+    def _touch(self, area, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and not entry.in_use:
+                entry.expires_at = max(entry.expires_at, time.time() + area.ttl)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await asyncio.to_thread(self.collect)
+            except Exception as e:
+                print(f"Storage collection failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    # one collection: picks up untracked directories, measures the ones that may have
+    # changed, deletes the expired idle ones and then evicts idle ones over max_bytes
+    def collect(self):
+        now = time.time()
+        with self._lock:
+            tracked = set(self._entries)
+        found = []
+        leftovers = []
+        present = set()
+        for area in self.areas:
+            for dir_entry in _scandir(area.root):
+                if dir_entry.name.startswith(TRASH_PREFIX):
+                    leftovers.append(dir_entry.path)
+                    continue
+                present.add(dir_entry.path)
+                if not dir_entry.name.startswith(".") and dir_entry.path not in tracked and dir_entry.is_dir():
+                    try:
+                        found.append((area, dir_entry.path, dir_entry.stat().st_mtime))
+                    except FileNotFoundError:
+                        continue
+        with self._lock:
+            for area, path, mtime in found:
+                self._entries.setdefault(path, _Entry(area, False, mtime + area.ttl))
+            entries = list(self._entries.items())
+
+        # the disk (and whatever in_use asks) is only touched outside the lock; directories
+        # in use keep growing, idle ones are measured once, and idle ones the scan did not
+        # find are gone
+        busy = set()
+        sizes = {}
+        for path, entry in entries:
+            if not entry.in_use and entry.area.in_use is not None and entry.area.in_use(os.path.basename(path)):
+                busy.add(path)
+            if not entry.in_use and path not in present:
+                sizes[path] = None
+            elif entry.size is None or entry.in_use or path in busy:
+                sizes[path] = _dir_size(path)
+
+        evicted = []
+        gone = []
+        with self._lock:
+            for path, entry in entries:
+                if self._entries.get(path) is not entry or path not in sizes:
+                    continue
+                if sizes[path] is None and not entry.in_use:
+                    # deleted by someone else, e.g. a worker cleaning up a cancelled job
+                    del self._entries[path]
+                    if path not in busy:
+                        gone.append((entry.area, path))
+                    continue
+                entry.size = sizes[path] or 0
+                if path in busy:
+                    entry.expires_at = max(entry.expires_at, now + entry.area.ttl)
+            total = sum(entry.size or 0 for entry in self._entries.values())
+            idle = sorted((entry.expires_at, path) for path, entry in self._entries.items()
+                          if not entry.in_use and path not in busy)
+            for expires_at, path in idle:
+                if expires_at > now and total <= self.max_bytes:
+                    break
+                entry = self._entries.pop(path)
+                total -= entry.size or 0
+                trash = os.path.join(entry.area.root, TRASH_PREFIX + str(uuid.uuid4()))
+                try:
+                    os.rename(path, trash)
+                except FileNotFoundError:
+                    gone.append((entry.area, path))
+                    continue
+                leftovers.append(trash)
+                evicted.append((entry.area, path, "ttl" if expires_at <= now else "quota"))
+            self._usage = self._measure(busy)
+
+        for path in leftovers:
+            shutil.rmtree(path, ignore_errors=True)
+        for area, path, reason in evicted:
+            metrics.inc("samplebox_storage_evictions_total", area=area.name, reason=reason)
+            gone.append((area, path))
+        for area, path in gone:
+            if area.on_evict is not None:
+                area.on_evict(os.path.basename(path))
+        for name, area_usage in self._usage["areas"].items():
+            metrics.set("samplebox_storage_bytes", area_usage["bytes"], area=name)
+            metrics.set("samplebox_storage_dirs", area_usage["dirs"], area=name)
+
+    # usage of the tracked directories, called with the lock held
+    def _measure(self, busy):
+        areas = {area.name: {"root": area.root, "ttl": area.ttl, "bytes": 0, "dirs": 0, "in_use": 0}
+                 for area in self.areas}
+        in_use_bytes = 0
+        for path, entry in self._entries.items():
+            area_usage = areas[entry.area.name]
+            area_usage["bytes"] += entry.size or 0
+            area_usage["dirs"] += 1
+            if entry.in_use or path in busy:
+                area_usage["in_use"] += 1
+                in_use_bytes += entry.size or 0
+        used_bytes = sum(area_usage["bytes"] for area_usage in areas.values())
+        return {"max_bytes": self.max_bytes, "used_bytes": used_bytes, "in_use_bytes": in_use_bytes, "areas": areas}
+
+
+def _scandir(directory):
+    try:
+        with os.scandir(directory) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+# bytes of the files below directory, None if it is gone
+def _dir_size(directory):
+    if not os.path.isdir(directory):
+        return None
+    size = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                continue
+    return size
+
+
+storage = StorageManager(STORAGE_MB * 1024 * 1024)
+results_storage = storage.add_area("results", RESULTS_DIR, RESULTS_TTL)
@@ -0,0 +1,106 @@
+import librosa
+import numpy as np
+import soundfile as sf
+
+# harmonic/percussive separation of long recordings in blocks of STFT frames, so memory is
+# bounded by the block size instead of the length of the track (a full-song complex STFT of
+# an hour long DJ mix, plus its median filters and masks, is several GB)
+# every block is analysed with kernel_size // 2 frames of context on both sides, so the
+# median filters along time see the same neighbours as on the full STFT, and is inverted
+# with a running overlap-add; the output equals librosa.effects.hpss up to float rounding
+
+
+# yields (harmonic, percussive) blocks of samples that, concatenated, are the stems of y;
+# same defaults as librosa.effects.hpss (centered, zero padded hann STFT, soft masks)
+def iter_hpss(y, block_frames=1024, n_fft=2048, hop_length=512, kernel_size=31):
+    if len(y) < n_fft:
+        # a single frame with padding on both sides, nothing to bound
+        yield librosa.effects.hpss(y, kernel_size=kernel_size, n_fft=n_fft, hop_length=hop_length)
+        return
+    pad = n_fft // 2
+    n_frames = 1 + len(y) // hop_length
+    context = kernel_size // 2
+    window = librosa.filters.get_window("hann", n_fft, fftbins=True)
+    carry = np.zeros((3, n_fft - hop_length))
+
+    for f0 in range(0, n_frames, block_frames):
+        f1 = min(f0 + block_frames, n_frames)
+        c0 = max(0, f0 - context)
+        c1 = min(n_frames, f1 + context)
+
+        # samples under the frames [c0, c1), zero outside the signal like the centered STFT
+        seg_start = c0 * hop_length - pad
+        seg_end = (c1 - 1) * hop_length + pad
+        segment = np.zeros(seg_end - seg_start, dtype=y.dtype)
+        lo, hi = max(seg_start, 0), min(seg_end, len(y))
+        segment[lo - seg_start:hi - seg_start] = y[lo:hi]
+
+        D = librosa.stft(segment, n_fft=n_fft, hop_length=hop_length, center=False)
+        D_harmonic, D_percussive = librosa.decompose.hpss(D, kernel_size=kernel_size)
+        del D
+
+        # overlap-add the frames [f0, f1) (and the squared window, for the normalization)
+        # into the padded samples [f0 * hop_length, (f1 - 1) * hop_length + n_fft)
+        count = f1 - f0
+        local = np.zeros((3, (count - 1) * hop_length + n_fft))
+        frames = [
+            np.fft.irfft(D_harmonic[:, f0 - c0:f1 - c0], n=n_fft, axis=0) * window[:, None],
+            np.fft.irfft(D_percussive[:, f0 - c0:f1 - c0], n=n_fft, axis=0) * window[:, None],
+            np.repeat(window[:, None] ** 2, count, axis=1),
+        ]
+        del D_harmonic, D_percussive
+        for j in range(0, n_fft, hop_length):
+            for k, block in enumerate(frames):
+                local[k, j:j + count * hop_length] += block[j:j + hop_length].T.reshape(-1)
+        local[:, :carry.shape[1]] += carry
+
+        # samples before the first frame of the next block receive no more contributions
+        final = count * hop_length if f1 < n_frames else local.shape[1]
+        carry = local[:, final:]
+        out = local[:, :final]
+
+        # back from padded to signal coordinates, dropping the padding
+        start = f0 * hop_length - pad
+        lo, hi = max(start, 0), min(start + final, len(y))
+        if hi <= lo:
+            continue
+        out = out[:, lo - start:hi - start]
+        norm = out[2]
+        nonzero = norm > np.finfo(y.dtype).tiny
+        harmonic, percussive = out[0], out[1]
+        harmonic[nonzero] /= norm[nonzero]
+        percussive[nonzero] /= norm[nonzero]
+        yield harmonic.astype(y.dtype), percussive.astype(y.dtype)
+
+
+# writes the stems of y block by block to harmonic_path and percussive_path; .npy paths
+# are written as float arrays through a memory map, anything else through soundfile
+def separate_to_files(y, sr, harmonic_path, percussive_path, **kwargs):
+    writers = [_open_writer(path, len(y), y.dtype, sr) for path in (harmonic_path, percussive_path)]
+    try:
+        for blocks in iter_hpss(y, **kwargs):
+            for writer, block in zip(writers, blocks):
+                writer.write(block)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def _open_writer(path, length, dtype, sr):
+    if str(path).endswith(".npy"):
+        return _NpyWriter(path, length, dtype)
+    return sf.SoundFile(path, "w", samplerate=sr, channels=1)
+
+
+class _NpyWriter(object):
+    def __init__(self, path, length, dtype):
+        self._array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(length,))
+        self._position = 0
+
+    def write(self, block):
+        self._array[self._position:self._position + len(block)] = block
+        self._position += len(block)
+
+    def close(self):
+        self._array.flush()
+        del self._array
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+from fastapi import WebSocketDisconnect
+
+from storage import storage
+
+# framed upload protocol of /ws, so large songs never travel as one giant websocket frame:
+#
+#     client: {"type": "upload", "filename": "song.mp3", "size": 12345678}
+#             (plus "upload_id" to resume an upload after a reconnect)
+#     server: {"status": "ready", "upload_id": ..., "next_seq": 0, "chunk_size": ..., "window": ...}
+#     client: binary chunks, each a 4 byte big-endian sequence number followed by chunk_size
+#             bytes of the file (the last one shorter), starting at next_seq, with at most
+#             window chunks sent but not acknowledged yet
+#     server: {"status": "ack", "seq": n} once chunk n is stored
+#     client: {"type": "end"} after the last chunk
+#
+# chunks are written to disk as they arrive, so a client that reconnects sends the header
+# with its upload_id and continues at the next_seq of the ready message; while the upload
+# arrives it is hashed and, with ffmpeg installed, decoded, so both are done when it ends
+# an interrupted upload can be resumed for UPLOAD_TTL seconds, then the storage manager
+# deletes it
+UPLOADS_DIR = os.environ.get("SAMPLEBOX_UPLOADS_DIR", "uploads")
+UPLOAD_TTL = float(os.environ.get("SAMPLEBOX_UPLOAD_TTL", 3600))
+CHUNK_SIZE = int(os.environ.get("SAMPLEBOX_UPLOAD_CHUNK_KB", 256)) * 1024
+WINDOW = int(os.environ.get("SAMPLEBOX_UPLOAD_WINDOW", 8))
+MAX_UPLOAD_MB = int(os.environ.get("SAMPLEBOX_MAX_UPLOAD_MB", 1024))
+FFMPEG = shutil.which("ffmpeg")
+
+# formats soundfile reads directly, decoding them ahead gains nothing
+DIRECT_FORMATS = (".wav",)
+
+uploads_storage = storage.add_area("uploads", UPLOADS_DIR, UPLOAD_TTL)
+
+
+class UploadError(Exception):
+    pass
+
+
+# decodes an upload while it arrives: the bytes are piped into ffmpeg, which writes them as a
+# float wav at the original sampling rate and channels, so the pipeline only has to downmix
+# and resample it like librosa.load does; formats ffmpeg cannot decode from a pipe (e.g. mp4
+# with the index at the end) just fail here, and the pipeline decodes the upload itself
+class EarlyDecoder(object):
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.failed = False
+        self._process = None
+
+    async def start(self):
+        self._process = await asyncio.create_subprocess_exec(
+            FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+            "-vn", "-c:a", "pcm_f32le", "-f", "wav", "-y", self.output_path,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+
+    # waits while ffmpeg is behind, which holds back the acks and so the client
+    async def feed(self, data):
+        if self.failed:
+            return
+        try:
+            self._process.stdin.write(data)
+            await self._process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self.failed = True
+
+    # path of the decoded file, or None if decoding failed
+    async def finish(self):
+        if not self.failed:
+            try:
+                self._process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        returncode = await self._process.wait()
+        if self.failed or returncode != 0:
+            return None
+        return self.output_path
+
+    async def abort(self):
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+            await self._process.wait()
+
+
+# an upload in progress, in UPLOADS_DIR/<upload_id>: the file as received so far and an
+# upload.json with its name and size, so it can be resumed even after a server restart
+class Upload(object):
+    def __init__(self, upload_id, filename, size, chunk_size=CHUNK_SIZE):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.dir = os.path.join(UPLOADS_DIR, upload_id)
+        self.path = os.path.join(self.dir, "upload")
+        self.received = 0
+        self.decoded_path = None
+        self._digest = hashlib.sha256()
+        self._file = None
+        self._decoder = None
+
+    @property
+    def next_seq(self):
+        return self.received // self.chunk_size
+
+    @property
+    def content_hash(self):
+        return self._digest.hexdigest()
+
+    @classmethod
+    def create(cls, filename, size):
+        upload = cls(str(uuid.uuid4()), filename, size)
+        uploads_storage.create(upload.id)
+        with open(os.path.join(upload.dir, "upload.json"), "w") as f:
+            json.dump({"filename": filename, "size": size, "chunk_size": upload.chunk_size}, f)
+        return upload
+
+    # an upload left by an earlier connection (or server), None if there is none or it
+    # expired; in use until suspended or removed
+    @classmethod
+    def load(cls, upload_id):
+        # ids come from the client, but the server made them: anything but a uuid (".." say)
+        # is not an upload
+        try:
+            upload_id = str(uuid.UUID(str(upload_id)))
+        except ValueError:
+            return None
+        try:
+            with open(os.path.join(UPLOADS_DIR, upload_id, "upload.json")) as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            return None
+        upload = cls(upload_id, values["filename"], values["size"], values["chunk_size"])
+        if not uploads_storage.acquire(upload.dir):
+            return None
+        return upload
+
+    # opens the file for appending: only whole chunks count as received, and what is already
+    # on disk is hashed and fed to a new decoder first
+    async def open(self):
+        if self._file is not None:
+            return
+        self._file = open(self.path, "ab")
+        self.received = self._file.tell() - self._file.tell() % self.chunk_size
+        self._file.truncate(self.received)
+        if FFMPEG and not self.filename.lower().endswith(DIRECT_FORMATS):
+            self._decoder = EarlyDecoder(os.path.join(self.dir, "decoded.wav"))
+            await self._decoder.start()
+        with open(self.path, "rb") as f:
+            for data in iter(lambda: f.read(self.chunk_size), b""):
+                self._digest.update(data)
+                if self._decoder is not None:
+                    await self._decoder.feed(data)
+
+    async def write(self, data):
+        if self.received + len(data) > self.size:
+            raise UploadError(f"Upload {self.id} is larger than announced")
+        self._file.write(data)
+        self._digest.update(data)
+        self.received += len(data)
+        if self._decoder is not None:
+            await self._decoder.feed(data)
+
+    async def finish(self):
+        if self.received != self.size:
+            raise UploadError(f"Upload {self.id} ended after {self.received} of {self.size} bytes")
+        self._file.close()
+        self._file = None
+        if self._decoder is not None:
+            self.decoded_path = await self._decoder.finish()
+
+    # the connection dropped, the upload stays on disk to be resumed for UPLOAD_TTL seconds
+    async def suspend(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._decoder is not None:
+            await self._decoder.abort()
+            self._decoder = None
+        self._digest = hashlib.sha256()
+        uploads_storage.release(self.dir)
+
+    # deleted in the background by the storage manager
+    async def remove(self):
+        await self.suspend()
+        uploads_storage.remove(self.dir)
+
+
+# runs the upload protocol on websocket after its header message; returns the finished
+# Upload, or raises UploadError (the upload is dropped) or WebSocketDisconnect (the upload
+# is kept for the client to resume)
+async def receive_upload(websocket, header):
+    filename = os.path.basename(str(header.get("filename") or "upload"))
+    size = int(header.get("size", -1))
+    if size < 0 or size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise UploadError(f"Upload size must be between 0 and {MAX_UPLOAD_MB} MB")
+
+    upload = Upload.load(header["upload_id"]) if header.get("upload_id") else None
+    if upload is not None and (upload.size != size or upload.filename != filename):
+        # another file, the old upload expires as if it had not been resumed
+        uploads_storage.release(upload.dir)
+        upload = None
+    if upload is None:
+        upload = Upload.create(filename, size)
+    await upload.open()
+    await websocket.send_text(json.dumps({
+        "status": "ready", "upload_id": upload.id, "next_seq": upload.next_seq,
+        "chunk_size": upload.chunk_size, "window": WINDOW,
+    }))
+
+    finished = False
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                data = message["bytes"]
+                seq = int.from_bytes(data[:4], byteorder="big")
+                if seq < upload.next_seq:
+                    # sent again after a reconnect, already stored
+                    await websocket.send_text(json.dumps({"status": "ack", "seq": seq}))
+                    continue
+                if seq > upload.next_seq:
+                    raise UploadError(f"Chunk {seq} arrived before chunk {upload.next_seq}")
+                if len(data) - 4 > upload.chunk_size:
+                    raise UploadError(f"Chunks must not be larger than {upload.chunk_size} bytes")
+                await upload.write(data[4:])
+                await websocket.send_text(json.dumps({"status": "ack", "seq": seq}))
+            elif json.loads(message["text"]).get("type") == "end":
+                await upload.finish()
+                finished = True
+                return upload
+            else:
+                raise UploadError("Expected an upload chunk or the end of the upload")
+    except WebSocketDisconnect:
+        raise
+    except Exception:
+        await upload.remove()
+        raise
+    finally:
+        # disconnected (or cancelled with the server), keep what arrived
+        if not finished:
+            await upload.suspend()
@@ -1,50 +1,50 @@
 import numpy as np
 import librosa
-import soundfile as sf
 from pydub import AudioSegment
-from Tonal_Fragment import Tonal_Fragment
+from key_detector import key_detector, short_key_name
 import random
 import os
-
-def get_bpm_and_bars(file_path, song_key=None):
-    y, sr = librosa.load(file_path)
+from song_context import SongContext, get_beat_grid, load_audio
+import feature_cache
+from sample_metadata import SampleMetadata
+from audio_output import SampleWriter
+from metrics import phase
+from quality import current_quality, use_quality
+import logging
+
+logger = logging.getLogger(__name__)
+
+def get_bpm_and_bars(source, song_key=None):
+    y, sr = load_audio(source)
     if song_key == None:
         song_key = get_key_of_bar(y, sr)
-    print('get_key_of_bar(y, sr):', song_key)
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-    
-    # assuming 4/4 time signature
-    bar_duration = 60 / tempo  # in seconds
-    
-    bar_duration = bar_duration
+    logger.debug('get_key_of_bar(y, sr): %s', song_key)
+    beat_grid = get_beat_grid(source, y, sr)
+    tempo = beat_grid.tempo
     
-    total_duration = librosa.get_duration(y=y, sr=sr)
-    num_bars = int(total_duration // bar_duration)
-    
-    bars = []
-    for i in range(num_bars):
-        start = int(i * bar_duration * sr)
-        end = int((i + 1) * bar_duration * sr)
-        bars.append(y[start:end])
+    # every chord of a progression gets one bar of the song
+    bar_starts, bar_ends = beat_grid.bars(1)
+    bar_keys = get_keys_of_bars(y, sr, bar_starts, bar_ends)
+    bars = [(y[start:end], key) for start, end, key in zip(bar_starts, bar_ends, bar_keys)]
     
     return tempo, bars, sr, song_key
 
 def get_key_of_bar(bar, sr):
-    tonal_fragment = Tonal_Fragment(bar, sr)
-    key = tonal_fragment.key
-    if 'minor' in key:
-        return key.replace(' minor', 'm')
-    else:
-        return key.replace(' major', '')
+    return short_key_name(key_detector.detect_audio(bar, sr))
+
+# keys of the bars [bar_starts[i], bar_ends[i]) of y, all scored from the one chromagram of
+# the whole track (shared with the song key above) by summing the chroma frames of each bar
+def get_keys_of_bars(y, sr, bar_starts, bar_ends):
+    return [short_key_name(key) for key in key_detector.detect_ranges(y, sr, bar_starts, bar_ends)]
 
 def get_chord_progression(song_key):
     chord_numerals = []
     if 'm' == song_key[-1]:
-        print("minor key:", song_key)
+        logger.debug("minor key: %s", song_key)
         chord_numerals = random.choice(minor_chord_progressions)
     else:
         chord_numerals = random.choice(major_chord_progressions)
-    print(chord_numerals)
+    logger.debug("chord numerals: %s", chord_numerals)
     chord_progression = [chord_chart[song_key][i-1] for i in chord_numerals]
     
     return [chord_progression]
@@ -118,7 +118,10 @@ def transpose_bar(bar, sr, from_key, to_key):
         return bar  # Return original bar if key types don't match
     
     semitones = (notes.index(to_note) - notes.index(from_note)) % 12
-    return librosa.effects.pitch_shift(bar, sr=sr, n_steps=semitones)
+    if semitones == 0:
+        return bar
+    tier = current_quality()
+    return feature_cache.pitch_shift(bar, sr, semitones, n_fft=tier.n_fft, res_type=tier.res_type)
 
 def create_new_song_segment(bars, sr, song_key):
     new_song = []
@@ -144,7 +147,7 @@ def create_new_song_segment(bars, sr, song_key):
                 # If no matching key type, just use a random bar without transposing
                 chosen_bar, _ = random.choice(bars)
         if np.random.random() < 0.3:
-            chosen_bar = librosa.effects.time_stretch(chosen_bar, rate=random.choice([0.5,1]))
+            chosen_bar = feature_cache.time_stretch(chosen_bar, random.choice([0.5,1]), n_fft=current_quality().n_fft)
         chosen_bar = creative_process(chosen_bar, sr)
         new_song.append(chosen_bar)
     return np.concatenate(new_song), progression[0]
@@ -154,43 +157,66 @@ def creative_process(sample, sr):
         sample = sample[::-1]
     return sample
 
-def creative_process2(sample, sr):
+# the transforms of a full song segment; applied to the segment before it is tiled, which
+# gives the same result as transforming the tiled segment at a quarter of the cost
+# also returns the metadata of the result, updated for the transforms applied; every segment
+# is new, so its transforms are not memoized
+def creative_process2(sample, sr, metadata):
+    tier = current_quality()
     if np.random.random() < 0.25:  # 30% chance of reverse
         sample = sample[::-1]
     if np.random.random() < 0.5:  # 20% chance of pitch shift
-        sample = librosa.effects.pitch_shift(sample, sr=sr, n_steps=np.random.randint(-8, 5))
+        n_steps = np.random.randint(-8, 5)
+        sample = librosa.effects.pitch_shift(sample, sr=sr, n_steps=n_steps, n_fft=tier.n_fft, res_type=tier.res_type)
+        metadata = metadata.pitch_shifted(n_steps)
     if np.random.random() < 0.1:  # 10% chance of time stretch
-        sample = librosa.effects.time_stretch(sample, rate=np.random.uniform(0.8, 1.2))
-    return sample
-
-def create_full_song(bars, sr, output_folder, song_key):
-
-    for i in range(4):
-        segment, _ = create_new_song_segment(bars, sr, song_key=song_key)
-        segment = np.tile(segment, 4)
-        segment = creative_process2(segment, sr)
-        tempo = "unknown"
-        try:
-            tempo, _ = librosa.beat.beat_track(y=segment, sr=sr)
-            # print("tempo:", np.around(list(tempo)[0], decimals=0))
-            tempo = np.int32(list(tempo)[0])
-        except:
-            continue
-        key = get_key_of_bar(segment,sr)
-        sf.write(output_folder + f"/{tempo}_{str(key).replace("#","-sharp")}_{i}.wav".replace("sharpm", "sharp-m"), segment, sr)
-
-def main(input_file, output_folder, song_key=None, instrumental=False):
-
-    tempo, bar_audio, sr, song_key = get_bpm_and_bars(input_file, song_key=song_key)
-    # print(f'Estimated BPM: {tempo}')
-    
-    # Get the key for each bar
-    bars_with_keys = [(bar, get_key_of_bar(bar, sr)) for bar in bar_audio]
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    # Create and save the new song
-    create_full_song(bars_with_keys, sr, output_folder, song_key)
-    print(f'New song saved as {output_folder}')
+        rate = np.random.uniform(0.8, 1.2)
+        sample = librosa.effects.time_stretch(sample, rate=rate, n_fft=tier.n_fft)
+        metadata = metadata.time_stretched(rate)
+    return sample, metadata
+
+# the tempo and key in the file names come from the song's beat grid and the key of the
+# progression, carried through the transforms, rather than from analysing every segment
+# the segments are encoded on the encoder threads while the next one is created
+# name_prefix starts every file name, so runs writing to the same folder never collide
+def create_full_song(bars, sr, output_folder, song_key, tempo, name_prefix=""):
+
+    with SampleWriter() as writer:
+        for i in range(4):
+            with phase("wonky_sampler.segment"):
+                segment, segment_key = create_new_song_segment(bars, sr, song_key=song_key)
+            with phase("wonky_sampler.creative"):
+                segment, metadata = creative_process2(segment, sr, SampleMetadata(tempo, segment_key))
+            segment = np.tile(segment, 4)
+            metadata.verify(segment, sr, f"wonky segment {i}")
+            key = metadata.key
+            with phase("wonky_sampler.write"):
+                writer.write(output_folder + f"/{name_prefix}{metadata.bpm}_{str(key).replace("#","-sharp")}_{i}.wav".replace("sharpm", "sharp-m"), segment, sr, metadata)
+
+# quality is the tier the bars are analysed and transformed at (see quality.QUALITY_TIERS), the
+# tier in use by default
+def main(source, output_folder, song_key=None, instrumental=False, quality=None, name_prefix=""):
+    with use_quality(quality):
+        # Split into bars and get the key for each bar
+        with phase("wonky_sampler.bars"):
+            tempo, bars_with_keys, sr, song_key = get_bpm_and_bars(source, song_key=song_key)
+        # print(f'Estimated BPM: {tempo}')
+        
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        # Create and save the new song
+        create_full_song(bars_with_keys, sr, output_folder, song_key, tempo, name_prefix=name_prefix)
+        logger.info("New song saved as %s", output_folder)
+
+# entry point of the /sample endpoint of app.py, run in a worker process of its JobExecutor:
+# decodes the song at input_file and writes its wonky samples to output_folder
+def sample_song(input_file, output_folder, send_message, quality=None):
+    try:
+        with use_quality(quality):
+            song = SongContext.from_file(input_file)
+            main(song, output_folder, song_key=song.key)
+    finally:
+        feature_cache.feature_cache.clear()
 
 if __name__ == '__main__':
     input_file = 'more.mp3'
@@ -72,6 +72,42 @@ ipcMain.handle('save-and-extract-samplebox', async (event, arrayBuffer) => {
     }
 });
 
+// last pending write of every sample path, so writes of the same path happen one after the
+// other, in the order the samples arrived, and the last one sent is the one on disk
+const sampleWrites = new Map();
+
+function writeSample(filePath, buffer) {
+    const previous = sampleWrites.get(filePath) || Promise.resolve();
+    const write = previous.catch(() => {}).then(async () => {
+        await jetpack.dirAsync(path.dirname(filePath));
+        await fs.writeFile(filePath, buffer);
+    });
+    sampleWrites.set(filePath, write);
+    write.catch(() => {}).finally(() => {
+        if (sampleWrites.get(filePath) === write) {
+            sampleWrites.delete(filePath);
+        }
+    });
+    return write;
+}
+
+// saves a sample streamed by the server at its path inside the samplebox folder, the same
+// place it would have been extracted to from the samplebox zip
+ipcMain.handle('save-sample', async (event, samplePath, arrayBuffer) => {
+    try {
+        const sampleboxDir = path.join(app.getPath('appData'), 'samplebox');
+        const filePath = path.resolve(sampleboxDir, samplePath);
+        if (!filePath.startsWith(sampleboxDir + path.sep)) {
+            throw new Error(`invalid sample path ${samplePath}`);
+        }
+        await writeSample(filePath, Buffer.from(arrayBuffer));
+        return { success: true, extractPath: sampleboxDir };
+    } catch (error) {
+        console.error('Error in save-sample:', error);
+        return { success: false, error: "save-sample: " + error.message };
+    }
+});
+
 app.on('window-all-closed', () => {
     if (process.platform !== 'darwin') {
         app.quit();
@@ -104,7 +140,7 @@ async function scanDirectory(dir) {
             } else {
                 results[item.name] = await scanDirectory(subDir);
             }
-        } else if (item.isFile() && ['.mp3', '.wav'].includes(path.extname(item.name).toLowerCase())) {
+        } else if (item.isFile() && ['.mp3', '.wav', '.flac', '.ogg'].includes(path.extname(item.name).toLowerCase())) {
             const parentDir = path.basename(dir);
             if (!results[parentDir]) {
                 results[parentDir] = [];
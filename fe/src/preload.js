@@ -4,6 +4,7 @@ contextBridge.exposeInMainWorld('electron', {
     startDrag: (filePath) => ipcRenderer.send('ondragstart', filePath),
     saveDialog: () => ipcRenderer.invoke('save-dialog'),
     saveAndExtractSamplebox: (arrayBuffer) => ipcRenderer.invoke('save-and-extract-samplebox', arrayBuffer),
+    saveSample: (samplePath, arrayBuffer) => ipcRenderer.invoke('save-sample', samplePath, arrayBuffer),
     scanSamples: (extractPath) => ipcRenderer.invoke('scan-samples', extractPath),
     getAudioPath: (uuid, songName, category, filename) => ipcRenderer.invoke('get-audio-path', uuid, songName, category, filename),
     
@@ -1,14 +1,35 @@
 let isGenerating = false;
 let ws;
 let pendingFile = null;
-
-function connectWebSocket() {
+// the server streams every sample as soon as it is generated, as a binary message of type
+// SAMPLE (see sample_frame in app/3main.py), followed by a "complete" status; binary messages
+// of type ZIP_CHUNK carry the samplebox zip, which is not requested (zip=0)
+const ZIP_CHUNK = 1;
+const SAMPLE = 2;
+let zipChunks = [];
+// samples being written to the samplebox folder, all saved before the browser opens
+let pendingSaves = [];
+// the song being uploaded in chunks (see app/uploads.py), kept across reconnects so an
+// interrupted upload resumes where it stopped
+let upload = null;
+// the song sent last and its quality tier, so a preview can be rendered again in full quality
+let lastSong = null;
+// the quality tier of the open connection, the server takes it from the url
+let wsQuality = null;
+
+function connectWebSocket(quality) {
     if (ws && ws.readyState === WebSocket.OPEN) {
-        return Promise.resolve(); // WebSocket is already connected
+        if (wsQuality === quality) {
+            return Promise.resolve(); // WebSocket is already connected
+        }
+        ws.onclose = null;
+        ws.close();
     }
 
     return new Promise((resolve, reject) => {
-        ws = new WebSocket('ws://localhost:8000/ws');
+        wsQuality = quality;
+        ws = new WebSocket(`ws://localhost:8000/ws?samples=1&zip=0&format=flac&quality=${quality}`);
+        ws.binaryType = 'arraybuffer';
 
         ws.onopen = () => {
             console.log('WebSocket connection established');
@@ -16,12 +37,73 @@ function connectWebSocket() {
         };
 
         ws.onmessage = async (event) => {
-            if (event.data instanceof Blob) {
-                // This is the zip file
-                const arrayBuffer = await event.data.arrayBuffer();
-                const result = await window.electron.saveAndExtractSamplebox(arrayBuffer);
+            if (event.data instanceof ArrayBuffer) {
+                const type = new Uint8Array(event.data, 0, 1)[0];
+                if (type === SAMPLE) {
+                    const headerLength = new DataView(event.data).getUint32(1);
+                    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(event.data, 5, headerLength)));
+                    const audio = event.data.slice(5 + headerLength);
+                    pendingSaves.push(window.electron.saveSample(header.path, audio));
+                    showSample(header, audio);
+                } else if (type === ZIP_CHUNK) {
+                    // This is the next chunk of the zip file
+                    zipChunks.push(event.data.slice(1));
+                }
+                return;
+            }
+
+            // This is a status message
+            const data = JSON.parse(event.data);
+            if (data.status === 'ready') {
+                // the server is ready for the chunks, from next_seq on when resuming
+                upload.id = data.upload_id;
+                upload.chunkSize = data.chunk_size;
+                upload.window = data.window;
+                upload.nextSeq = data.next_seq;
+                upload.acked = data.next_seq;
+                sendChunks();
+                return;
+            }
+            if (data.status === 'ack') {
+                upload.acked = Math.max(upload.acked, data.seq + 1);
+                const percent = Math.round(100 * Math.min(upload.acked * upload.chunkSize, upload.file.size) / (upload.file.size || 1));
+                document.getElementById('result').innerHTML = `
+                <p class="text-yellow-400">Uploading... ${percent}%</p>
+            `;
+                sendChunks();
+                return;
+            }
+
+            console.log(event.data);
+            if (data.status === 'complete' || data.status === 'error') {
+                upload = null;
+            }
+            if (data.status === 'complete') {
+                let result;
+                if (zipChunks.length) {
+                    const arrayBuffer = await new Blob(zipChunks).arrayBuffer();
+                    zipChunks = [];
+                    result = await window.electron.saveAndExtractSamplebox(arrayBuffer);
+                } else {
+                    const saved = await Promise.all(pendingSaves);
+                    pendingSaves = [];
+                    const failed = saved.find((save) => !save.success);
+                    result = failed || saved[0] || { success: true, extractPath: '' };
+                }
 
-                if (result.success) {
+                if (result.success && lastSong && lastSong.quality === 'preview') {
+                    // stay on the preview, the user decides whether it is worth a full render
+                    document.getElementById('result').innerHTML = `
+                    <p class="text-green-400">Preview generated!</p>
+                    <p class="text-sm text-gray-400">Samples saved to: ${result.extractPath}</p>
+                    <button id="fullQualityBtn" class="mt-2 bg-white text-black font-bold py-2 px-4 rounded-full hover:bg-gray-200 transition duration-300">
+                        Render in full quality
+                    </button>
+                `;
+                    document.getElementById('fullQualityBtn').addEventListener('click', () => {
+                        handleFileUpload(lastSong.file, 'standard');
+                    });
+                } else if (result.success) {
                     document.getElementById('result').innerHTML = `
                     <p class="text-green-400">Sample box generated and extracted successfully!</p>
                     <p class="text-sm text-gray-400">Samples saved to: ${result.extractPath}</p>
@@ -36,9 +118,10 @@ function connectWebSocket() {
                     throw new Error(result.error);
                 }
             } else {
-                // This is a status message
-                console.log(event.data);
-                const data = JSON.parse(event.data);
+                if (data.status === 'error') {
+                    zipChunks = [];
+                    pendingSaves = [];
+                }
                 document.getElementById('result').innerHTML = `
                 <p class="text-yellow-400">${data.message}</p>
             `;
@@ -55,14 +138,110 @@ function connectWebSocket() {
 
         ws.onclose = () => {
             console.log('WebSocket connection closed');
+            if (upload && !upload.ended) {
+                // the server keeps the chunks it has, reconnect and continue the upload
+                document.getElementById('result').innerHTML = `
+                <p class="text-yellow-400">Connection lost, resuming upload...</p>
+            `;
+                setTimeout(() => connectWebSocket(wsQuality).then(sendUploadHeader).catch(() => {}), 1000);
+                return;
+            }
             isGenerating = false;
             updateBrowseButton();
         };
     });
 }
 
-// Function to handle file upload
-async function handleFileUpload(file) {
+// MIME type of a sample, from the extension of the format the server wrote it in
+const AUDIO_TYPES = { '.flac': 'audio/flac', '.ogg': 'audio/ogg', '.wav': 'audio/wav' };
+function audioType(path) {
+    return AUDIO_TYPES[path.slice(path.lastIndexOf('.')).toLowerCase()] || 'audio/wav';
+}
+
+// element with the given tag, class and text
+function makeElement(tag, className, text) {
+    const element = document.createElement(tag);
+    if (className) {
+        element.className = className;
+    }
+    if (text !== undefined) {
+        element.textContent = text;
+    }
+    return element;
+}
+
+// adds a streamed sample to the list of the samples generated so far, grouped by category;
+// a later sample with the same path replaces the earlier one, like in the samplebox folder
+// names and categories come from the server (and so from the uploaded file name), they are
+// set as text, never parsed as HTML
+function showSample(header, audio) {
+    const liveSamples = document.getElementById('liveSamples');
+    let category = [...liveSamples.children].find((element) => element.dataset.category === header.category);
+    if (!category) {
+        category = makeElement('div', 'mb-4');
+        category.dataset.category = header.category;
+        category.appendChild(makeElement('h3', 'text-lg font-bold mb-2', header.category));
+        category.appendChild(makeElement('ul', 'list-disc pl-5'));
+        liveSamples.appendChild(category);
+    }
+    const details = [header.bpm && `${header.bpm} BPM`, header.key].filter(Boolean).join(', ');
+    const item = makeElement('li', 'mb-2');
+    item.dataset.path = header.path;
+    const name = makeElement('p', null, header.name);
+    if (details) {
+        name.append(' ', makeElement('span', 'text-sm text-gray-400', `(${details})`));
+    }
+    const player = makeElement('audio');
+    player.controls = true;
+    player.src = URL.createObjectURL(new Blob([audio], { type: audioType(header.path) }));
+    item.append(name, player);
+    const list = category.querySelector('ul');
+    const previous = [...list.children].find((element) => element.dataset.path === header.path);
+    if (previous) {
+        URL.revokeObjectURL(previous.querySelector('audio').src);
+        list.replaceChild(item, previous);
+    } else {
+        list.appendChild(item);
+    }
+}
+
+// announces the upload, the server answers with a "ready" message
+function sendUploadHeader() {
+    const header = { type: 'upload', filename: upload.file.name, size: upload.file.size };
+    if (upload.id) {
+        header.upload_id = upload.id;
+    }
+    ws.send(JSON.stringify(header));
+}
+
+// sends the next chunks, each a 4 byte sequence number followed by a slice of the file, while
+// fewer than window chunks are unacknowledged; the file is read a chunk at a time
+async function sendChunks() {
+    if (upload.sending) {
+        return;
+    }
+    upload.sending = true;
+    try {
+        const count = Math.ceil(upload.file.size / upload.chunkSize);
+        while (upload.nextSeq < count && upload.nextSeq - upload.acked < upload.window && ws.readyState === WebSocket.OPEN) {
+            const seq = upload.nextSeq++;
+            const data = await upload.file.slice(seq * upload.chunkSize, (seq + 1) * upload.chunkSize).arrayBuffer();
+            const frame = new Uint8Array(4 + data.byteLength);
+            new DataView(frame.buffer).setUint32(0, seq);
+            frame.set(new Uint8Array(data), 4);
+            ws.send(frame);
+        }
+        if (upload.acked === count && !upload.ended && ws.readyState === WebSocket.OPEN) {
+            upload.ended = true;
+            ws.send(JSON.stringify({ type: 'end' }));
+        }
+    } finally {
+        upload.sending = false;
+    }
+}
+
+// Function to handle file upload, at the quality tier picked in the page unless given one
+async function handleFileUpload(file, quality = document.getElementById('quality').value) {
     if (!file) {
         alert('Please select a song file');
         return;
@@ -77,39 +256,18 @@ async function handleFileUpload(file) {
         updateBrowseButton();
 
         // Connect WebSocket before sending the file
-        await connectWebSocket();
+        lastSong = { file, quality };
+        await connectWebSocket(quality);
 
         document.getElementById('result').innerHTML = `
             <p class="text-yellow-400">Generating sample box... Please wait.</p>
         `;
 
-        const reader = new FileReader();
-        reader.onload = function(e) {
-            const arrayBuffer = e.target.result;
-            if (ws.readyState === WebSocket.OPEN) {
-                // Create a new ArrayBuffer with filename and file data
-                const filenameBuffer = new TextEncoder().encode(file.name);
-                const combinedBuffer = new ArrayBuffer(4 + filenameBuffer.byteLength + arrayBuffer.byteLength);
-                const combinedView = new DataView(combinedBuffer);
-
-                // Write filename length (4 bytes)
-                combinedView.setUint32(0, filenameBuffer.byteLength);
-
-                // Write filename
-                new Uint8Array(combinedBuffer).set(filenameBuffer, 4);
+        document.getElementById('liveSamples').innerHTML = '';
 
-                // Write file data
-                new Uint8Array(combinedBuffer).set(new Uint8Array(arrayBuffer), 4 + filenameBuffer.byteLength);
-
-                ws.send(combinedBuffer);
-            } else {
-                console.error('WebSocket is not open. ReadyState:', ws.readyState);
-                document.getElementById('result').innerHTML = `
-                    <p class="text-red-400">Error: WebSocket is not open. Please try again.</p>
-                `;
-            }
-        };
-        reader.readAsArrayBuffer(file);
+        // the file is sent in acknowledged chunks instead of one message of its whole size
+        upload = { file, id: null, chunkSize: 0, window: 0, nextSeq: 0, acked: 0, sending: false, ended: false };
+        sendUploadHeader();
 
     } catch (error) {
         console.error('Error:', error);